@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# check a whole tree of Sloop upload directories in one go, and optionally zip up the photos of the ones that pass
+# does what check_zip_sites.sh -> check_zip_surveys.sh -> check_zip.sh do
+# a survey directory is any directory in the tree holding a .xls or .xlsx file (e.g. site/survey/), which should be the
+# Sloop upload workbook for the .jpg files alongside it: its photos sheet should name exactly those files
+# survey directories are checked in parallel by a pool of worker processes
+
+# usage:
+# check_uploads.py [-j n] [--report report.json] [--archive] [directory]
+# -j n sets the number of worker processes (default: one per cpu)
+# --archive zips up the .jpg files of each survey that passes, into name.zip (name.xls or name.xlsx being the workbook) in the
+#           survey directory; photos are stored, not compressed (JPEGs don't compress), and an existing archive is
+#           only added to, or rewritten if photos have changed or gone since it was made
+# --report file writes the results for every survey as JSON to file (default: upload_report.json in the directory checked)
+# directory is the top of the tree to check (default: current directory)
+# prints one line for each survey with problems followed by totals; the surveys that failed are also listed on stderr
+# exit status is 1 if any survey failed
+
+# the report has, for each survey directory:
+#	missing    - names used in the photos sheet with no .jpg file (<xxxy.jpg in check_zip.sh's diff)
+#	extra      - .jpg files whose names aren't used in the photos sheet (>xxxz.jpg in check_zip.sh's diff)
+#	misspelled - [sheet name, file name] pairs from missing and extra that are probably the same photo,
+#	             misspelled in one place or the other
+#	duplicates - names used more than once in the photos sheet
+#	error      - why the survey couldn't be checked at all (no workbook, more than one, no photos sheet...)
+#	archive    - with --archive, for surveys that passed: the archive, what was done to it
+#	             (created/appended/rewritten/unchanged), the bytes of photos written to it and seconds taken
+
+import sys	# so we can get at the command line
+import os	# directory scanning
+import json	# report format
+import difflib	# close matches between missing and extra names
+import argparse	# command line options
+import multiprocessing	# worker pool
+import zipfile	# photo archives
+import time	# archive timings and file times
+import get_files	# reads the photos sheet
+
+workbook_suffixes = (".xls", ".xlsx")	# upload workbooks, either of which sloop_workbook reads
+misspelling_cutoff = 0.8	# how alike (0-1) a missing and an extra name have to be to be called a misspelling
+
+
+# directories under root holding an upload workbook, in sorted order
+def find_surveys(root):
+	surveys = []
+	for directory, subdirs, files in os.walk(root):
+		subdirs.sort()
+		if [f for f in files if f.endswith(workbook_suffixes)] != []:
+			surveys.append(directory)
+	return surveys
+
+
+# a photos sheet cell as the file name get_files.py would print
+def cell_name(value):
+	if isinstance(value, unicode):
+		return value.encode("utf-8")
+	return str(value)
+
+
+# a file's modification time as a zip entry holds it (local time, to 2 seconds)
+def zip_time(mtime):
+	t = time.localtime(mtime)[0:6]
+	return t[0:5] + (t[5] // 2 * 2,)
+
+
+# zip up the photos of a survey into archive; files are the photo names
+# returns what was done to the archive and the bytes of photos written to it
+def archive_photos(directory, archive, files):
+	wanted = {}	# photo name -> (size, zip time) as it is on disk now
+	for name in files:
+		st = os.stat(os.path.join(directory, name))
+		wanted[name] = (st.st_size, zip_time(st.st_mtime))
+	action = "created"
+	if os.path.exists(archive):
+		try:
+			z = zipfile.ZipFile(archive)
+			held = dict([(i.filename, (i.file_size, i.date_time, i.compress_type)) for i in z.infolist()])
+			z.close()
+		except zipfile.BadZipfile:
+			held = None	# start again
+		if held is not None:
+			stale = [name for name in held if name not in wanted or held[name] != wanted[name] + (zipfile.ZIP_STORED,)]
+			if stale == []:
+				added = sorted([name for name in wanted if name not in held])
+				if added == []:
+					return "unchanged", 0
+				z = zipfile.ZipFile(archive, "a", zipfile.ZIP_STORED, allowZip64=True)
+				for name in added:
+					z.write(os.path.join(directory, name), name)
+				z.close()
+				return "appended", sum([wanted[name][0] for name in added])
+		action = "rewritten"
+	# write a new archive alongside, then swap it in, so a failure never leaves a half-written archive
+	tmp_archive = archive + ".tmp"
+	z = zipfile.ZipFile(tmp_archive, "w", zipfile.ZIP_STORED, allowZip64=True)	# surveys can run past 2GB
+	for name in sorted(wanted):
+		z.write(os.path.join(directory, name), name)
+	z.close()
+	os.rename(tmp_archive, archive)
+	return action, sum([size for size, t in wanted.values()])
+
+
+# compare the photos sheet with the .jpg files in one survey directory, and archive them if they agree and we're asked to
+# job is (directory, whether to archive)
+def check_survey(job):
+	directory, archive = job
+	result = {"directory": directory, "xls": None, "ok": False, "photos": 0, "files": 0,
+		"missing": [], "extra": [], "misspelled": [], "duplicates": [], "error": None, "archive": None}
+	try:
+		names = os.listdir(directory)
+	except OSError, e:
+		result["error"] = str(e)
+		return result
+	xls = sorted([n for n in names if n.endswith(workbook_suffixes)])
+	if len(xls) != 1:
+		result["error"] = "expected one .xls or .xlsx file, found " + str(len(xls))
+		return result
+	result["xls"] = xls[0]
+	try:
+		listed = [cell_name(v) for v in get_files.photo_files(os.path.join(directory, xls[0]))]
+	except Exception, e:	# xlrd has its own error types, and a missing sheet is one of them
+		result["error"] = "can't read photos sheet: " + str(e)
+		return result
+	listed = [n for n in listed if n != ""]	# blank cells
+	sheet = set(listed)
+	files = set([n for n in names if n.endswith(".jpg") and not n.startswith(".")])	# as ls *.jpg sees them
+	missing = sorted(sheet - files)
+	extra = sorted(files - sheet)
+	result["photos"] = len(sheet)
+	result["files"] = len(files)
+	result["missing"] = missing
+	result["extra"] = extra
+	counts = {}
+	for n in listed:
+		counts[n] = counts.get(n, 0) + 1
+	result["duplicates"] = sorted([n for n in counts if counts[n] > 1])
+	for name in missing:
+		close = difflib.get_close_matches(name, extra, 1, misspelling_cutoff)
+		if close != []:
+			result["misspelled"].append([name, close[0]])
+	result["ok"] = missing == [] and extra == []
+	if archive and result["ok"]:	# only ever archive photos that match the sheet
+		start = time.time()
+		archive_name = os.path.join(directory, os.path.splitext(xls[0])[0] + ".zip")
+		try:
+			action, written = archive_photos(directory, archive_name, files)
+		except (IOError, OSError, zipfile.BadZipfile, zipfile.LargeZipFile), e:
+			result["error"] = "can't archive photos: " + str(e)
+			result["ok"] = False
+			return result
+		result["archive"] = {"file": archive_name, "action": action, "bytes": written, "seconds": round(time.time() - start, 3)}
+	return result
+
+
+# totals over all surveys, for the report and the printed summary
+def summarise(results):
+	summary = {"surveys": len(results), "ok": 0, "failed": 0, "errors": 0, "missing": 0, "extra": 0, "misspelled": 0,
+		"archives": {}, "archive_bytes": 0, "archive_seconds": 0.0}
+	for result in results:
+		if result["ok"]:
+			summary["ok"] += 1
+		else:
+			summary["failed"] += 1
+		if result["error"] is not None:
+			summary["errors"] += 1
+		for key in ("missing", "extra", "misspelled"):
+			summary[key] += len(result[key])
+		if result["archive"] is not None:
+			action = result["archive"]["action"]
+			summary["archives"][action] = summary["archives"].get(action, 0) + 1
+			summary["archive_bytes"] += result["archive"]["bytes"]
+			summary["archive_seconds"] += result["archive"]["seconds"]
+	return summary
+
+
+# print the surveys with problems and any archiving, then the totals
+def print_summary(results, summary):
+	for result in results:
+		if result["archive"] is not None and result["archive"]["action"] != "unchanged":
+			print "%s: %s %s, %.1f MB in %.2f s" % (result["directory"], result["archive"]["action"],
+				os.path.basename(result["archive"]["file"]), result["archive"]["bytes"] / 1e6, result["archive"]["seconds"])
+		if result["error"] is not None:
+			print "%s: %s" % (result["directory"], result["error"])
+		elif not result["ok"]:
+			print "%s: %d missing, %d extra, %d probably misspelled" % (result["directory"],
+				len(result["missing"]), len(result["extra"]), len(result["misspelled"]))
+			for sheet_name, file_name in result["misspelled"]:
+				print "	%s in sheet, %s on disk?" % (sheet_name, file_name)
+	print "%d surveys: %d ok, %d failed (%d could not be checked); %d missing, %d extra, %d probably misspelled" % (
+		summary["surveys"], summary["ok"], summary["failed"], summary["errors"], summary["missing"],
+		summary["extra"], summary["misspelled"])
+	if summary["archives"] != {}:
+		print "archives: %s; %.1f MB in %.2f s" % (", ".join(["%d %s" % (n, action) for action, n in sorted(summary["archives"].items())]),
+			summary["archive_bytes"] / 1e6, summary["archive_seconds"])
+
+
+def main():
+	parser = argparse.ArgumentParser(usage="check_uploads.py [-j n] [--report report.json] [--archive] [directory]")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--report", default=None)
+	parser.add_argument("--archive", action="store_true")
+	parser.add_argument("directory", nargs="?", default=".")
+	options = parser.parse_args()
+	report_file = options.report
+	if report_file is None:
+		report_file = os.path.join(options.directory, "upload_report.json")
+
+	surveys = find_surveys(options.directory)
+	pool = multiprocessing.Pool(options.jobs)
+	results = pool.map(check_survey, [(directory, options.archive) for directory in surveys])
+	pool.close()
+	pool.join()
+
+	summary = summarise(results)
+	f = open(report_file, "w")
+	json.dump({"root": options.directory, "summary": summary, "surveys": results}, f, indent=1, sort_keys=True)
+	f.close()
+	print_summary(results, summary)
+	for result in results:	# failure messages on stderr, as check_zip.sh does
+		if not result["ok"]:
+			print >> sys.stderr, result["directory"]
+	if summary["failed"] > 0:
+		sys.exit(1)
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
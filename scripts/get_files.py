@@ -6,12 +6,14 @@
 # usage: get_files filename.xls > photos.txt
 
 
-import xlrd
 import sys
+import sloop_workbook	# loads just the sheet we want (and reads .xlsx uploads too)
 
-book = xlrd.open_workbook(sys.argv[1]) 
-sheet = book.sheet_by_name('photos')
-filenames = sheet.col_slice(1,1)	# 2nd column, starting from 2nd row
-for filename in filenames:
-	print filename.value
+# the cells of the 2nd column of the photos sheet, without the column header
+# (also used by check_uploads.py)
+def photo_files(filename):
+	return sloop_workbook.Workbook(filename).Column('photos', 1, 1)	# 2nd column, starting from 2nd row
 
+if __name__ == "__main__":
+	for filename in photo_files(sys.argv[1]):
+		print filename
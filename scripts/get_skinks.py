@@ -6,11 +6,8 @@
 # usage: get_files filename.xls > skinkids.txt
 
 
-import xlrd
 import sys
+import sloop_workbook	# loads just the sheet we want (and reads .xlsx uploads too)
 
-book = xlrd.open_workbook(sys.argv[1]) 
-sheet = book.sheet_by_name('sightings')
-for skink in sheet.col_slice(1,1):	# 2nd column, starting from 2nd row
-	print skink.value
-
+for skink in sloop_workbook.Workbook(sys.argv[1]).Column('sightings', 1, 1):	# 2nd column, starting from 2nd row
+	print skink
@@ -6,170 +6,183 @@
 # generates:
 #     site_species_newbies.csv - one line per newbie, each line has all sightings of that newbie (named by sl_id)
 #     site_species - directory containing .jpg images named by sl_id, corresponding to entries in .csv file
+#     site_species_photos.csv - one line per photo looked for: file name, linked/copied/present/missing/failed, bytes
 # manual process is required to cut down to best left/right image for each newbie before adding to SkinkPics
 
 # usage:
 # harvest_newbies.py [options] species site surveyfile.xls
+# harvest_newbies.py [options] --all-sites species[,species...] surveyfile.xls
 # options:
 # -v causes details of processing to be dumped to standard error
+# --all-sites harvests every site column in the sheet for each species, reading the workbook once and
+#             sharing one database connection per species; photo copying and file writing for each site
+#             run in a pool of worker processes, and a table of per-site counts and timings is printed at the end
+# -j n sets the number of worker processes for --all-sites (default: one per cpu)
+# --refresh brings the local sightings cache up to date from the live database, then works from the cache
+# --offline works from the local sightings cache without touching the live database
+# --cache-dir dir puts the sightings cache, and the cache of survey calendars read from workbooks, in dir (default: ~/.sloop_cache)
+# --copy-threads n sets the number of threads copying photos for each site (default: 8)
+# --no-link always copies photos; otherwise they are hard linked when Sloop's photo store is on the same filesystem
+#           as the output (BEWARE: a hard linked photo *is* Sloop's original, so never edit harvested photos in place)
+# --photo-index looks photos up in the photo index (kept in the cache directory, see sloop_photo_index.py), updating it
+#               first, rather than checking Sloop's photo store for each one
+# --stats json|text reports the time spent in each stage (workbook parse, database connect and queries, newbie selection,
+#         photo copying...) and counts of rows fetched, newbies, photos copied and bytes, on stderr
+# --stats-file file puts the --stats report in file instead
+# --profile file writes a cProfile dump of the run to file (of the main process: not of --all-sites workers)
+# --legacy-newbies fetches every sighting at each site and picks out the newbies here, as harvests used to;
+#                  otherwise the database picks them out from each animal's first sighting, for all sites of a species
+#                  in one query, and only the newbies' sightings are fetched
+# --changed-only (with --all-sites) only harvests sites whose inputs have changed since they were last harvested:
+#                the hash of each site's survey calendar, the rows fetched for it, the options that change the outputs
+#                and the code is kept with the hash of its outputs (the photo directory by its listing) in
+#                harvest_newbies_build.json (see sloop_build.py), and a site is redone if any of them differ or its outputs
+#                are missing; without --photo-index, sites with missing photos are always redone in case the photos
+#                have turned up since (with it, the index entries of the site's photos are part of the inputs), as are
+#                sites where photos failed to copy; a line per site says which
+# --dry-run (with --changed-only) prints which sites would be redone, and why, without harvesting anything
+# --pipeline overlaps the stages of the harvest rather than doing them one after another: the newbies' sightings are
+#            streamed from the database, and each sighting's photos are queued for copying as soon as it arrives;
+#            once a site's sightings are all in its files are written as its copying finishes, while the next site's
+#            sightings are fetched (see HarvestPipeline); the outputs are the same
+# --fetch-threads n (with --pipeline) fetches n species at once, each on its own database connection (default: 1)
+# --copy-sites n (with --pipeline) copies photos for at most n sites at once, each with --copy-threads threads;
+#                fetching waits when there are that many (default: 2)
+# --pipeline can't be used with --legacy-newbies (which needs all of a site's sightings before any newbie is known)
+#            or --changed-only (whose plan needs a site's sightings before its photos are copied)
+# --review writes the .csv files of newbies but copies no photos: instead each newbie gets a contact sheet of its
+#          photos (shrunk, in a pool of -j worker processes) in the site_species_review directory, with an index.html
+#          to pick the photos to keep from; sloop_review.py --fetch then copies just those (see sloop_review.py)
+#          (can't be used with --pipeline or --changed-only, and --copy-threads, --no-link and --photo-index are ignored)
+# a photo directory left by an earlier harvest is reused: photos already there with the same size and time are skipped
+# the .csv files are written aside and renamed into place, so an interrupted harvest never leaves half of one
 
 # Note: errors and warnings go to stderr, verbose output goes to stdout
 
-import psycopg2	# postgres interface package
-import xlrd	# .xls decoder package
 import sys	# so we can get at the command line
+import cStringIO	# .csv files are assembled in memory before writing
 import datetime	# to get date conversion functions
-import shutil	# file copy utilities
 import os	# directory create utilities
+import time	# for the batch summary timings
+import argparse	# command line options
+import multiprocessing	# worker pool for batch harvests
+import threading	# --pipeline stages
+import Queue	# --pipeline hands sites from fetching to finishing
+import sloop_sightings	# survey calendar and sightings store shared with sloop_to_mark.py
+import sloop_db	# database connections shared with sloop_to_mark.py
+import sloop_workbook	# survey workbook reading, with a cache of survey calendars
+import sloop_cache	# local sightings cache shared with sloop_to_mark.py
+import sloop_photos	# threaded photo copying
+import sloop_photo_index	# index of the photos in Sloop's image store
+import sloop_stats	# timing and counting for --stats
+import sloop_build	# --changed-only build records
+import sloop_review	# --review contact sheets
 
 verbose = False	# global to turn on debug/information output
 
+# where Sloop keeps the original photos for each species
+species_photo_src = dict([(species, images + "originals/") for species, images in sloop_photo_index.species_image_dir.items()])
+build_file = "harvest_newbies_build.json"	# --changed-only build record, in the output directory
 
-class SurveySeries:
-	'Class to manage skink sightings for a survey series'
 
-	def __init__(self, site):
-		self.site = site		# not sure if we'll ever use this
-		self.surveys = []		# list of lists of dates
-		self.current_series = []	# list of dates in current series during assembly
-		self.skinks = []		# list of skinks seen in the survey series
-		self.dates = []			# and list of lists of dates
-		self.sloop_ids = []		# and list of lists of sloop ids
- 
-	def AddSurvey(self, date):	# add survey on given date to current series
-		self.current_series.append(date)
-
-
-	def EndSeries(self):	# mark that all surveys in current series have been added
-		self.surveys.append(self.current_series)
-		self.current_series = []
-
-	def SurveyDates(self):	# generator to return each date in turn
-		for series in self.surveys:
-			for date in series:
-				yield date
+class NewbieSeries(sloop_sightings.SurveySeries):
+	'Survey series holding sloop ids of every sighting, for newbie harvesting'
 
 	def AddSkink(self, date, skink_id, sloop_id):	# put a skink sighting into the survey records
 		# note that we keep all sightings in order to pick up all photos of newbies
 		# the manual process that follows selects the best one to add to SkinkPics
 
+		occasion = self.occasion[date]	# which survey this sighting belongs to
 		if skink_id == "SINGLETON_SO_FAR":		# anonymous singletons have been seen exactly once by definition, don't want to combine them
-			# add new entry with this date and size
-			self.skinks.append(skink_id)	# append skink to list
-			self.dates.append([date])	# append list containing date to list
-			self.sloop_ids.append([sloop_id])	# ditto for sloop id
+			# add new entry with this date and sloop id
+			self.NewIndividual(skink_id).Add(occasion, sloop_id)
 		elif skink_id == "NEVER_COMPARED":		# Unexpected in production use: indicates that Sloop matching has not been checked for this animal
 			# might be running the script for test or other purposes when Sloop matching incomplete
 			# warn the user, keep this animal to allow manual checking
 			print >> sys.stderr, "Warning: adding NEVER_COMPARED animal as newbie"
-			# add new entry with this date and size
-			self.skinks.append(skink_id)	# append skink to list
-			self.dates.append([date])	# append list containing date to list
-			self.sloop_ids.append([sloop_id])	# ditto for sloop id
-		else:	# a skink with an id
-			if skink_id in self.skinks:	# is this skink already in the list?
-				i=self.skinks.index(skink_id)	# yes: pick up its index
-				self.dates[i].append(date)	# append new date to list of dates for this skink
-				self.sloop_ids[i].append(sloop_id)	# ditto for sloop id
-			else:	# not in list, new entry on the end
-				self.skinks.append(skink_id)	# append skink to list
-				self.dates.append([date])	# append list containing date to list
-				self.sloop_ids.append([sloop_id])	# ditto for sloop id
+			# add new entry with this date and sloop id
+			self.NewIndividual(skink_id).Add(occasion, sloop_id)
+		else:	# a skink with an id: existing entry, or a new one on the end
+			self.FindIndividual(skink_id).Add(occasion, sloop_id)
 
 
 	def CollectNewbies(self):		# return a list of newbies; each list element is skink_id plus list of sloop_ids
 		newbies = []
-		for i in range(len(self.dates)):	# go through all of the capture histories we've built up
-			new_animal = True		# presume this guys is new for now
-			for survey in self.surveys[:-1]:	# go through all the prior surveys
-				for date in survey:		# and each date in each of them
-					if date in self.dates[i]:	# was this animal seen on a survey date before this year?
-						new_animal = False	# not a newbie
+		if self.surveys == []:	# no surveys, so nobody to find
+			return newbies
+		latest = self.series_start[-1]	# occasions before this are in prior surveys
+		for animal in self.individuals:	# go through all of the capture histories we've built up
 			# ASSUMPTION: if the animal has a capture history then it was seen at least once
 			#	      so if it wasn't  seen before it must have been seen in the most recent survey series
-			if new_animal:	# it's a newbie so all sightings must be this year and it must have been seen at least once
-				newbies.append((self.skinks[i],self.sloop_ids[i]))
+			if min(animal.occasions) >= latest:	# it's a newbie so all sightings must be this year and it must have been seen at least once
+				newbies.append((animal.skink_id,animal.values))
 		return newbies
-				
 
-
-	def DumpSurveys(self):	# debug function to dump assembled survey series
-		for i in self.surveys:
-			print i
-
-	def DumpSkinks(self):	# debug function to dump list of skinks in surveys
-		for i in range(len(self.skinks)):
-			print self.skinks[i], self.dates[i], self.sloop_ids[i]
+	def NewbieCalendar(self):	# each survey date, and whether it's in the most recent survey series, for query_newbies
+		if self.surveys == []:
+			return []
+		latest = self.series_start[-1]
+		return [(date, occasion >= latest) for date, occasion in sorted(self.occasion.items())]
+				
 
 
 
 
+usage = "harvest_newbies.py [-v] species site surveyfile.xls\n       harvest_newbies.py [-v] [-j jobs] --all-sites species[,species...] surveyfile.xls\n       options: [--refresh | --offline] [--cache-dir dir] [--copy-threads n] [--no-link] [--photo-index]\n       [--stats json|text] [--stats-file file] [--profile file] [--legacy-newbies] [--changed-only [--dry-run]]\n       [--pipeline [--fetch-threads n] [--copy-sites n]] [--review]"
 
 # complain and quit
 def usage_exit():
-	print >> sys.stderr, "usage: harvest_newbies.py [-v] species site surveyfile.xls"
+	print >> sys.stderr, "usage: " + usage
 	sys.exit()
 
-# find the column headed by a cell containing the supplied string, complain and exit if we don't find it
-def find_column(sheet,header):
-	for col in range(sheet.ncols):
-		if sheet.cell(0,col).value == header:
-			return col
-	# if we got to here, we ran out of columns without finding the heading
-	# should perhaps raise an exception and let the caller deal with the problem?
-	print >> sys.stderr, "Error: No surveys found for site ", header, " for requested species"
-	sys.exit()
-
-# pull the survey out of the supplied column and assemble the object that will hold the sightings data
-def extract_surveys(book,sheet,site):
-	column = find_column(sheet,site)
-	survey = SurveySeries(site)
-	in_survey = False	# just consume blank cells until we hit a date
-	for row in range(2, sheet.nrows):
-		if sheet.cell(row,column).value == "":	# consume blank cells, delimit survey series
-			if in_survey:	# first blank cell after date(s) delimits survey series
-				survey.EndSeries()
-				in_survey = False	# just consume blank cells until we hit another date
-		else:	# slice pulls out year, month, day from datetime tuple
-			survey.AddSurvey(xlrd.xldate_as_tuple(sheet.cell(row,column).value,book.datemode)[0:3])
-			in_survey = True	# put dates into a survey series until we hit blank cell(s)
-	if in_survey:	# if last cell was a date we've just hit the end of the last series
+# pull the site's survey calendar out of the workbook and assemble the object that will hold the sightings data
+# complain and exit if the species sheet has no column for the site
+def extract_surveys(book,species,site):
+	calendar = book.Calendar(species,site)
+	if calendar is None:
+		print >> sys.stderr, "Error: No surveys found for site ", site, " for requested species"
+		sys.exit()
+	survey = NewbieSeries(site)	# don't need the size 1 flag here
+	for dates in calendar[1]:	# each series of dates was delimited by blank cell(s) in the sheet
+		for date in dates:
+			survey.AddSurvey(date)
 		survey.EndSeries()
 	return survey
 
-# convert date tuple to string format for SQL query
-# this isn't pretty, but it works which is enough for now...
-def make_query_date(date):
-	dt=datetime.datetime(date[0],date[1],date[2])
-	return dt.strftime("%Y-%m-%d")
-
-# pull the skinks out of the survey records in the database, add them to the local survey object
-def query_skinks(db_conn, db_cur, surveys, site):
-	for date in surveys.SurveyDates():	# work through all of the survey dates
-		# note that postgres requires quoting to prevent identifiers being folded to lower case
-		# query is built in a string with " round db identifiers and ' round string literals in SQL, all \ quoted for Python
-		# pick out Skink ID and Sloop ID for all skinks photo-surveyed at the site on the day
-		my_query="SELECT \"INDIVIDUAL_ID\", \"SL_ID\" FROM \"CAPTURE\" WHERE \"EVENT\"=\'PhotoID\' AND \"SITE\"=\'"+site+"\' AND date_trunc(\'day\', \"CAPTURE_TIME\")=\'"+make_query_date(date)+"\'"
-		db_cur.execute(my_query)
-		for record in db_cur:	# loop over all photo-id skinks in the survey, noting them
-			surveys.AddSkink(date, record[0], record[1])
-			# ASSUMPTION: each date is queried once, so multiple adds of same skink on same date
-			#             will not be separated by other dates (but may be separated by other skinks on same date)
-		db_conn.rollback()	# do this as soon as practical to complete transaction and release lock
+# pull the skinks out of the survey records in the database (or the local cache), add them to the local survey object
+def query_skinks(source, surveys, site):
+	days = [datetime.date(d[0],d[1],d[2]) for d in surveys.SurveyDates()]
+	# pick out Skink ID and Sloop ID for all skinks photo-surveyed at the site on any survey day
+	for date, skink, value in source.Sightings(site, days, "SL_ID"):
+		surveys.AddSkink(date, skink, value)
+		# ASSUMPTION: rows come back in time order, so multiple adds of same skink on same date
+		#             will not be separated by other dates (but may be separated by other skinks on same date)
 
 
 # pick up the photos of the newbies from Sloop's store and put them in the destination directory
-def CollectPhotos(src,dest,newbies):
+# photos are copied (or hard linked) by a pool of threads, see sloop_photos.py
+# known is None, or {file name: (size, mtime)} of the photos the photo index says the store has for these newbies
+# returns the copier, which has what happened to each photo
+def CollectPhotos(src,dest,newbies,threads=None,no_link=False,known=None):
+	copier = sloop_photos.PhotoCopier(src, dest, threads, link=(False if no_link else None))
 	for n in newbies:	# go through the newbies
 		for s in n[1]:	# loop over each sloop id (sighting) for each newbie
-			left_photo = src+str(s)+"_L.jpg"	# synthesise full path/filename of left photo
-			if os.path.exists(left_photo):		# check it exists; we don't care if copy fails, but Phyton throws an error
-				shutil.copy(left_photo , dest)	# copy the photo
-			right_photo = src+str(s)+"_R.jpg"	# do the same for the right
-			if os.path.exists(right_photo):	
-				shutil.copy(right_photo , dest)
+			for photo in (str(s)+"_L.jpg", str(s)+"_R.jpg"):	# left photo, then the right
+				if known is None:
+					copier.Put(photo)	# missing photos are noted in the manifest
+				elif photo in known:
+					copier.Put(photo, known[photo])
+				else:
+					copier.Missing(photo)	# index says it's not there, don't go looking
+	copier.Finish()
+	return copier
 		
 
+# sloop ids of every sighting of the newbies
+def newbie_sightings(newbies):
+	return [s for n in newbies for s in n[1]]
+
+
 # write the newbies to the .csv file
 # one newbie per line
 # first column is skink_id (if any), remainder are sloop ids of each sighting
@@ -181,84 +194,483 @@ def WriteNewbies(f,newbies):
 		f.write("\r\n")
 
 
-#execution starts here
-arg_offset = 0
-if (len(sys.argv) < 4) or (len(sys.argv) > 5): usage_exit()
-if sys.argv[1] == "-v":
-	if len(sys.argv) == 5:
-		verbose = True
-		arg_offset = 1
+# survey days of sites of a species, for the source to pick out their newbies (see sloop_db.LiveSource.Newbies)
+def newbie_calendar(book, species, sites):
+	calendar = []
+	for site in sites:
+		surveys = extract_surveys(book,species,site)
+		if verbose:
+			surveys.DumpSurveys()
+			print
+		calendar += [(site, datetime.date(d[0],d[1],d[2]), latest) for d, latest in surveys.NewbieCalendar()]
+	return calendar
+
+# add a newbie sighting from the source to a site's list of newbies (as CollectNewbies gives them)
+# found is {skink id: sloop ids of its sightings} for the newbies already in the list
+def add_newbie(newbies, found, skink, sloop_id):
+	if skink in sloop_cache.provisional_ids:	# each sighting stands alone, as NewbieSeries.AddSkink has it
+		if skink == "NEVER_COMPARED":
+			print >> sys.stderr, "Warning: adding NEVER_COMPARED animal as newbie"
+		newbies.append((skink, [sloop_id]))
+	elif skink in found:
+		found[skink].append(sloop_id)
 	else:
-		usage_exit()
-species = sys.argv[1+arg_offset]
-site = sys.argv[2+arg_offset]
-survey_file = sys.argv[3+arg_offset]
-
-if verbose:
-	print species, site, survey_file
-	print
-
-if species == "otago":
-	sp_database = "otagolive"
-	sp_photo_src = "/media/GAOS_DB/OtagoSkinkSloopData/db/images/originals/"
-elif species == "grand":
-	sp_database = "grandlive"
-	sp_photo_src = "/media/GAOS_DB/GrandSkinkSloopData/db/images/originals/"
-else:
-	print >> sys.stderr, "Error: unknown species ", species 
-	usage_exit()
-
-# do all the spreadsheet stuff before we touch the database
-# for now, assume that process exit will clean up all the spreadsheet stuff
-book = xlrd.open_workbook(survey_file)	# how do we check if this worked???
-sheet = book.sheet_by_name(species)
-sightings = extract_surveys(book,sheet,site)
-
-if verbose:
-	sightings.DumpSurveys()
-	print
-	
-try:	# connect to the database for the species; no password seems to be required
-	conn=psycopg2.connect(database=sp_database,user="skuser")
-except Exception, e:
-	print >> sys.stderr, e.pgerror
-	sys.exit()
-conn.set_session(readonly=True)	# to be safe, prevent us from accidentally damaging the database
-cur=conn.cursor()
-
-# now pull the skink sightings out of the database
-query_skinks(conn, cur, sightings, site)
-
-# finished with database, so we can close the cursor and connection
-cur.close()
-conn.close()
-
-if verbose:
-	sightings.DumpSkinks()
-	print
-
-# Note that (unlike when generating MARK data) we don't need to deal with  Airport split survey on 5/6 April 2006
-
-# pick out the newbies
-newbie_list=sightings.CollectNewbies()
-
-outfile_name=site+"_"+species	# where to put the newbies
-
-# grab the newbie photos
-# try to create an empty directory to hold them, complain and quit if we fail
-photo_dir="./"+outfile_name
-try:
-	os.makedirs(photo_dir)
-except:
-	print >> sys.stderr, "Error: Failed to create new empty directory " + outfile_name + " to collect photos. Exiting."
-	sys.exit()
-CollectPhotos(sp_photo_src,photo_dir,newbie_list)
-
-# output .csv file listing newbies
-outfile=open(outfile_name+"_newbies.csv", 'w')	# write mode will overwrite any existing file
-WriteNewbies(outfile,newbie_list)
-outfile.close()
-
-# we're done...
+		found[skink] = [sloop_id]
+		newbies.append((skink, found[skink]))
+
+# newbies at sites of a species, picked out by the source in one query
+# returns {site: list of newbies as CollectNewbies gives them} for every site asked about
+def query_newbies(book, species, sites, source):
+	calendar = newbie_calendar(book, species, sites)
+	newbies = dict([(site, []) for site in sites])
+	found = dict([(site, {}) for site in sites])
+	with sloop_stats.span("query_newbies"):
+		for site, skink, sloop_id in source.Newbies(calendar):
+			add_newbie(newbies[site], found[site], skink, sloop_id)
+	return newbies
+
+# pull everything we need for one site out of the workbook and the database
+def load_site(book, species, site, source):
+	sightings = extract_surveys(book,species,site)
+
+	if verbose:
+		sightings.DumpSurveys()
+		print
+
+	# now pull the skink sightings out of the database
+	with sloop_stats.span("query_skinks"):
+		query_skinks(source, sightings, site)
+
+	if verbose:
+		sightings.DumpSkinks()
+		print
+	return sightings
+
+# names of the outputs for a site: photo directory, photo manifest and newbie list
+def output_names(site, species):
+	outfile_name=site+"_"+species
+	return [outfile_name, outfile_name+"_photos.csv", outfile_name+"_newbies.csv"]
+
+# copy the newbie photos and write the .csv file for one site
+# returns the counts and time taken for the summary, or None if we couldn't make the photo directory
+def harvest_site(job):
+	species, site, newbie_list, threads, no_link, known = job
+	start = time.time()
+	outfile_name=site+"_"+species	# where to put the newbies
+
+	# grab the newbie photos
+	# create a directory to hold them if there isn't one from an earlier harvest, complain and give up on this site if we fail
+	photo_dir="./"+outfile_name
+	if not os.path.isdir(photo_dir):
+		try:
+			os.makedirs(photo_dir)
+		except:
+			print >> sys.stderr, "Error: Failed to create new empty directory " + outfile_name + " to collect photos."
+			return None
+	with sloop_stats.span("copy_photos"):
+		copier = CollectPhotos(species_photo_src[species],photo_dir,newbie_list,threads,no_link,known)
+	stats = copier.Stats()
+	counts, moved, elapsed = stats
+	sloop_stats.count("photos_copied", counts.get(sloop_photos.LINKED, 0) + counts.get(sloop_photos.COPIED, 0))
+	sloop_stats.count("photos_present", counts.get(sloop_photos.PRESENT, 0))
+	sloop_stats.count("photos_missing", counts.get(sloop_photos.MISSING, 0))
+	sloop_stats.count("bytes_copied", moved)
+	sloop_stats.count("newbies", len(newbie_list))
+	if verbose:
+		print site, species, "photos:", sloop_photos.describe_stats(stats)
+
+	# manifest of what happened to each photo
+	manifest=cStringIO.StringIO()
+	copier.WriteManifest(manifest)
+	sloop_build.write_atomic(outfile_name+"_photos.csv", manifest.getvalue())
+
+	# output .csv file listing newbies
+	outfile=cStringIO.StringIO()
+	WriteNewbies(outfile,newbie_list)
+	sloop_build.write_atomic(outfile_name+"_newbies.csv", outfile.getvalue())	# replaces any existing file, once it's all written
+	return (len(newbie_list), stats, time.time() - start)
+
+# harvest_site in a pool worker: hands the worker's stats back with the result
+def harvest_site_worker(job):
+	sloop_stats.collect()	# drop anything inherited from the main process
+	result = harvest_site(job)
+	return result, sloop_stats.collect()
+
+class SiteHarvest(object):
+	'A site being harvested by HarvestPipeline: its newbies so far, and the copier already fetching their photos'
+
+	def __init__(self, species, site, threads, no_link):
+		self.species = species
+		self.site = site
+		self.outfile_name = site+"_"+species
+		self.newbies = []
+		self.found = {}		# skink id -> sloop ids of its sightings, for add_newbie
+		self.start = time.time()
+		self.fetched = None	# when the last of the site's sightings came in
+		self.copier = None	# None if we couldn't make the photo directory
+		photo_dir = "./"+self.outfile_name
+		if not os.path.isdir(photo_dir):
+			try:
+				os.makedirs(photo_dir)
+			except:
+				print >> sys.stderr, "Error: Failed to create new empty directory " + self.outfile_name + " to collect photos."
+				return
+		self.copier = sloop_photos.PhotoCopier(species_photo_src[species], photo_dir, threads, link=(False if no_link else None))
+
+	def Add(self, skink, sloop_id, known=None):	# a newbie sighting: note it, and queue its photos straight away
+		add_newbie(self.newbies, self.found, skink, sloop_id)
+		if self.copier is None:
+			return
+		for photo in (str(sloop_id)+"_L.jpg", str(sloop_id)+"_R.jpg"):	# as CollectPhotos does it
+			if known is None:
+				self.copier.Put(photo)
+			elif photo in known:
+				self.copier.Put(photo, known[photo])
+			else:
+				self.copier.Missing(photo)
+
+	def Finish(self):	# wait for the photos and write the .csv files; returns the result as harvest_site would
+		if self.copier is None:
+			return None
+		with sloop_stats.span("copy_photos"):
+			self.copier.Finish()
+		# photos were queued in the order their sightings came in, the manifest lists them newbie by newbie as CollectPhotos does
+		order = dict([(photo, n) for n, photo in enumerate([str(s)+side for s in newbie_sightings(self.newbies)
+			for side in ("_L.jpg", "_R.jpg")])])
+		self.copier.results.sort(key=lambda result: order[result[0]])
+		stats = self.copier.Stats()
+		counts, moved, elapsed = stats
+		sloop_stats.count("photos_copied", counts.get(sloop_photos.LINKED, 0) + counts.get(sloop_photos.COPIED, 0))
+		sloop_stats.count("photos_present", counts.get(sloop_photos.PRESENT, 0))
+		sloop_stats.count("photos_missing", counts.get(sloop_photos.MISSING, 0))
+		sloop_stats.count("bytes_copied", moved)
+		sloop_stats.count("newbies", len(self.newbies))
+		if verbose:
+			print self.site, self.species, "photos:", sloop_photos.describe_stats(stats)
+		manifest=cStringIO.StringIO()
+		self.copier.WriteManifest(manifest)
+		sloop_build.write_atomic(self.outfile_name+"_photos.csv", manifest.getvalue())
+		outfile=cStringIO.StringIO()
+		WriteNewbies(outfile,self.newbies)
+		sloop_build.write_atomic(self.outfile_name+"_newbies.csv", outfile.getvalue())
+		return (len(self.newbies), stats, time.time() - self.fetched)
+
+
+class HarvestPipeline(object):
+	'Harvest with fetching, newbie selection, photo copying and writing overlapped, for --pipeline'
+	# fetch threads each stream a species' newbie sightings from the source; a site's photo copier starts on each
+	# sighting's photos as soon as it arrives, while later sightings are still being fetched
+	# when a site's sightings are all in, the finishing thread waits for its photos and writes its files, while the
+	# fetch carries on with the next site; at most copy_sites sites are copying at once, so fetching waits for a slot
+
+	def __init__(self, threads=None, no_link=False, copy_sites=2):
+		self.threads = threads
+		self.no_link = no_link
+		self.slots = threading.BoundedSemaphore(copy_sites)
+		self.finishing = Queue.Queue()	# sites whose sightings are all in
+		self.results = {}	# (species, site) -> (fetch seconds, result as harvest_site gives it)
+		self.failure = None	# exc_info of anything that went wrong in a thread, raised again by Finish
+		self.finisher = threading.Thread(target=self._Finisher)
+		self.finisher.daemon = True
+		self.finisher.start()
+
+	def _Begin(self, species, site):
+		self.slots.acquire()	# wait for a site to finish copying if there are too many already
+		return SiteHarvest(species, site, self.threads, self.no_link)
+
+	def _End(self, harvest):
+		harvest.fetched = time.time()
+		self.finishing.put(harvest)
+
+	def _Finisher(self):
+		while True:
+			harvest = self.finishing.get()
+			if harvest is None:
+				return
+			try:
+				result = harvest.Finish()
+			except BaseException:
+				self.failure = sys.exc_info()
+				result = None
+			self.results[(harvest.species, harvest.site)] = (harvest.fetched - harvest.start, result)
+			self.slots.release()
+
+	def Species(self, book, species, sites, options):	# harvest the sites of a species (in a fetch thread)
+		# options are harvest_newbies.py's, for the source and photo index
+		harvest = None
+		try:
+			index = None
+			if options.photo_index:
+				index = sloop_photo_index.open_index(species, options.cache_dir, verbose=verbose)
+			source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+			calendar = newbie_calendar(book, species, sites)
+			seen = set()
+			with sloop_stats.span("query_newbies"):
+				for site, skink, sloop_id in source.Newbies(calendar):	# rows come back site by site
+					if harvest is None or site != harvest.site:
+						if harvest is not None:
+							self._End(harvest)
+						harvest = self._Begin(species, site)
+						seen.add(site)
+					known = None
+					if index is not None:
+						known = index.Originals([sloop_id])
+					harvest.Add(skink, sloop_id, known)
+			source.Close()
+			if harvest is not None:
+				self._End(harvest)
+			for site in sites:	# sites with no newbies still get their (empty) files
+				if site not in seen:
+					harvest = self._Begin(species, site)
+					self._End(harvest)
+		except BaseException:
+			self.failure = sys.exc_info()
+			if harvest is not None and harvest.fetched is None:	# give up on the site we were fetching, writing nothing
+				if harvest.copier is not None:
+					harvest.copier.Finish()
+				self.slots.release()
+
+	def Finish(self):	# wait for the last site to be written, returns the results
+		self.finishing.put(None)
+		self.finisher.join()
+		if self.failure is not None:
+			raise self.failure[0], self.failure[1], self.failure[2]
+		return self.results
+
+
+# harvest sites of the species with a HarvestPipeline, options.fetch_threads species at a time
+# sites is None for every site of each species; returns the summary lines for print_summary
+def pipeline_harvest(book, species_list, sites, options):
+	pipeline = HarvestPipeline(options.copy_threads, options.no_link, options.copy_sites)
+	waiting = Queue.Queue()
+	for species in species_list:
+		waiting.put(species)
+	def fetcher():
+		while True:
+			try:
+				species = waiting.get_nowait()
+			except Queue.Empty:
+				return
+			pipeline.Species(book, species, sites or book.Sites(species), options)
+	fetchers = [threading.Thread(target=fetcher) for i in range(max(1, min(options.fetch_threads, len(species_list))))]
+	for t in fetchers:
+		t.start()
+	for t in fetchers:
+		t.join()
+	results = pipeline.Finish()
+	return [(species, site, None) + results[(species, site)] for species in species_list for site in sites or book.Sites(species)]
+
+# write the .csv files of newbies for sites of the species, and make contact sheets of their photos, for --review
+# sites is None for every site of each species
+def review_harvest(book, species_list, sites, options):
+	print "%-8s %-16s %8s %8s %8s  %s" % ("species", "site", "newbies", "photos", "missing", "review")
+	for species in species_list:
+		species_sites = sites or book.Sites(species)
+		source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+		if options.legacy_newbies:
+			site_newbies = {}
+			for site in species_sites:
+				sightings = load_site(book, species, site, source)
+				with sloop_stats.span("collect_newbies"):
+					site_newbies[site] = sightings.CollectNewbies()
+		else:
+			site_newbies = query_newbies(book, species, species_sites, source)
+		source.Close()
+		for site in species_sites:
+			outfile=cStringIO.StringIO()
+			WriteNewbies(outfile,site_newbies[site])
+			sloop_build.write_atomic(site+"_"+species+"_newbies.csv", outfile.getvalue())
+		counts = sloop_review.make_sheets(species, [(site+"_"+species, site_newbies[site]) for site in species_sites], jobs=options.jobs)
+		for site in species_sites:
+			newbies, found, missing = counts[site+"_"+species]
+			print "%-8s %-16s %8d %8d %8d  %s" % (species, site, newbies, found, missing,
+				os.path.join(sloop_review.review_directory(site+"_"+species), "index.html"))
+
+# print a table of what was done for each site, and how long it took
+def print_summary(summary):
+	print "%-8s %-16s %8s %8s %8s %8s %8s %8s %8s" % ("species", "site", "animals", "newbies", "photos", "missing", "MB/s", "fetch s", "copy s")
+	for species, site, animals, fetch_time, result in summary:
+		if animals is None:	# only the newbies were fetched
+			animals = "-"
+		if result is None:
+			print "%-8s %-16s %8s   failed: could not create photo directory" % (species, site, animals)
+		else:
+			newbies, stats, copy_time = result
+			counts, moved, elapsed = stats
+			photos = counts.get(sloop_photos.LINKED, 0) + counts.get(sloop_photos.COPIED, 0) + counts.get(sloop_photos.PRESENT, 0)
+			rate = 0.0
+			if elapsed > 0:
+				rate = moved / elapsed / 1e6
+			print "%-8s %-16s %8s %8d %8d %8d %8.1f %8.2f %8.2f" % (species, site, animals, newbies, photos,
+				counts.get(sloop_photos.MISSING, 0), rate, fetch_time, copy_time)
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage=usage)
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--all-sites", action="store_true")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--refresh", action="store_true")
+	parser.add_argument("--offline", action="store_true")
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--copy-threads", type=int, default=None)
+	parser.add_argument("--no-link", action="store_true")
+	parser.add_argument("--photo-index", action="store_true")
+	parser.add_argument("--stats", choices=["json", "text"], default=None)
+	parser.add_argument("--stats-file", default=None)
+	parser.add_argument("--profile", default=None)
+	parser.add_argument("--legacy-newbies", action="store_true")
+	parser.add_argument("--changed-only", action="store_true")
+	parser.add_argument("--dry-run", action="store_true")
+	parser.add_argument("--pipeline", action="store_true")
+	parser.add_argument("--review", action="store_true")
+	parser.add_argument("--fetch-threads", type=int, default=1)
+	parser.add_argument("--copy-sites", type=int, default=2)
+	parser.add_argument("args", nargs="+")
+	options = parser.parse_args()
+	verbose = options.verbose
+	sloop_stats.instrument(lambda: run(options), options.stats, options.stats_file, options.profile)
+
+
+# everything after the command line is parsed
+def run(options):
+	if options.all_sites:
+		if len(options.args) != 2: usage_exit()
+		species_list = options.args[0].split(",")
+		sites = None	# every site in each species sheet
+		survey_file = options.args[1]
+	else:
+		if len(options.args) != 3: usage_exit()
+		species_list = [options.args[0]]
+		sites = [options.args[1]]
+		survey_file = options.args[2]
+
+	if options.refresh and options.offline: usage_exit()
+	if options.changed_only and not options.all_sites: usage_exit()
+	if options.dry_run and not options.changed_only: usage_exit()
+	if options.pipeline and (options.legacy_newbies or options.changed_only): usage_exit()
+	if options.copy_sites < 1: usage_exit()
+	if options.review and (options.pipeline or options.changed_only): usage_exit()
+
+	if verbose:
+		print " ".join(options.args)
+		print
+
+	for species in species_list:
+		if species not in sloop_db.species_database:
+			print >> sys.stderr, "Error: unknown species ", species 
+			usage_exit()
+
+	# do all the spreadsheet stuff before we touch the database
+	# (the calendars of all the species' sites are read, or taken from the cache, the first time we ask for one)
+	book = sloop_workbook.SurveyBook(survey_file, options.cache_dir)
+
+	# Note that (unlike when generating MARK data) we don't need to deal with  Airport split survey on 5/6 April 2006
+
+	if options.review:	# contact sheets rather than copies of the photos, one site or all of them
+		review_harvest(book, species_list, sites, options)
+		return
+
+	if options.pipeline:	# threads rather than a pool of workers, one site or all of them
+		results = pipeline_harvest(book, species_list, sites, options)
+		if sites is None:
+			print_summary(results)
+		elif results[0][4] is None:
+			print >> sys.stderr, "Exiting."
+			sys.exit()
+		return
+
+	if sites is not None:	# just the one site, no need for a pool of workers
+		species = species_list[0]
+		source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+		if options.legacy_newbies:
+			sightings = load_site(book, species, sites[0], source)
+			# pick out the newbies
+			with sloop_stats.span("collect_newbies"):
+				newbie_list = sightings.CollectNewbies()
+		else:
+			newbie_list = query_newbies(book, species, sites, source)[sites[0]]
+		# finished with database, so we can close the connection
+		source.Close()
+		# then collect their photos
+		known = None
+		if options.photo_index:
+			known = sloop_photo_index.open_index(species, options.cache_dir, verbose=verbose).Originals(newbie_sightings(newbie_list))
+		if harvest_site((species, sites[0], newbie_list, options.copy_threads, options.no_link, known)) is None:
+			print >> sys.stderr, "Exiting."
+			sys.exit()
+		return
+		# we're done...
+
+	# batch mode: one connection per species feeds sites to a pool of workers that copy photos and write the files
+	# with --changed-only the rows fetched for each site are hashed, and sites whose outputs are up to date are left alone
+	record = None
+	if options.changed_only:
+		record = sloop_build.BuildRecord(build_file)
+		code = sloop_build.code_hash([sys.modules[__name__], sloop_sightings, sloop_photos])
+	pool = multiprocessing.Pool(options.jobs)
+	summary = []
+	built = {}	# (species, site) -> (output names, inputs hash) of the sites being redone
+	for species in species_list:
+		source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+		if record is not None:
+			source = sloop_build.HashingSource(source)
+		index = None
+		if options.photo_index:
+			index = sloop_photo_index.open_index(species, options.cache_dir, verbose=verbose)
+		site_newbies = None
+		if not options.legacy_newbies:	# every site's newbies in one go
+			start = time.time()
+			site_newbies = query_newbies(book, species, book.Sites(species), source)
+			fetch_time = (time.time() - start) / max(1, len(site_newbies))	# shared out between the sites
+		for site in book.Sites(species):
+			start = time.time()
+			animals = None
+			if site_newbies is None:
+				sightings = load_site(book, species, site, source)
+				with sloop_stats.span("collect_newbies"):
+					newbie_list = sightings.CollectNewbies()	# pick out the newbies
+				animals = len(sightings.individuals)
+			else:
+				newbie_list = site_newbies[site]
+			known = None
+			if index is not None:
+				known = index.Originals(newbie_sightings(newbie_list))
+			if site_newbies is not None:
+				start -= fetch_time
+			if record is not None:
+				names = output_names(site, species)
+				inputs = sloop_build.inputs_hash(code, options.no_link, options.legacy_newbies, book.Calendar(species, site),
+					source.Rows(site), None if known is None else sorted(known.items()))
+				reason = record.Plan(names, inputs)
+				sloop_build.print_plan(species, site, reason)
+				if reason is None or options.dry_run:
+					continue
+				built[(species, site)] = (names, inputs)
+			summary.append((species, site, animals, time.time() - start,
+				pool.apply_async(harvest_site_worker, [(species, site, newbie_list, options.copy_threads, options.no_link, known)])))
+		source.Close()
+	pool.close()
+	pool.join()
+	results = []
+	for species, site, animals, fetch_time, result in summary:
+		result, stats = result.get()
+		sloop_stats.merge(stats)
+		results.append((species, site, animals, fetch_time, result))
+		if (species, site) in built:
+			if result is None or result[1][0].get(sloop_photos.FAILED, 0) > 0 or \
+					(not options.photo_index and result[1][0].get(sloop_photos.MISSING, 0) > 0):
+				record.Incomplete(built[(species, site)][0])	# try again next time
+			else:
+				record.Record(*built[(species, site)])
+	if options.dry_run:
+		return
+	if record is not None:
+		record.Save()
+	print_summary(results)
 
 
+#execution starts here
+if __name__ == "__main__":
+	main()
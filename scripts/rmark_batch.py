@@ -0,0 +1,314 @@
+#!/usr/bin/python
+
+# fit the candidate RMark models to the files exported by sloop_to_mark.py, every site_species and model at once,
+# and gather the AICc tables into one summary
+
+# usage:
+# rmark_batch.py [-v] [-j jobs] [--models model[,model...]] [--rscript path] [--cache-dir dir] [--refit]
+#                [--timeout minutes] [--keep-temp] [--out file] [--derived file] [site_species ...]
+# e.g. rmark_batch.py -j 8 --out aicc.csv Airport_grand Beach_otago
+# options:
+# -v reports each fit as it finishes
+# -j n sets the number of fits run at once (default: one per cpu)
+# --models list fits only the named models (default: all of them, see models below)
+# --rscript path runs fits with path rather than the Rscript on the PATH (e.g. a particular R install, or a stub)
+# --cache-dir dir keeps fitted results in dir/rmark (default: ~/.sloop_cache/rmark)
+# --refit fits every model again rather than using the cached results
+# --timeout minutes stops a fit (R and MARK) that has run for longer than that and counts it as failed (default: 60,
+#           0 for no limit), so one fit that never finishes doesn't hold up the rest
+# --keep-temp leaves each fit's scratch directory (they are always left when a fit fails, for its rscript.log)
+# --out file writes the summary to file (default: stdout)
+# --derived file writes each model's derived estimates (N-hat per session) to file as well
+# site_species names the site_species.inp and site_species_surveys.txt files to fit (a path, and the .inp, are allowed);
+# with none given, every .inp in the current directory is fitted (apart from _cohort.inp files)
+
+# the models are those of R/analyse_site_species.txt, and each is fitted by R/rmark_fit_model.txt:
+# Rscript rmark_fit_model.txt site_species model_name model_type model_parameters intervals
+# run in a scratch directory holding a copy of site_species.inp, so the mark files of fits running side by side
+# don't get mixed up; it leaves result.csv (model,type,npar,aicc,deviance,neg2lnl) and derived.csv
+# (estimate,se,lcl,ucl) there, and anything given as --rscript that does the same can stand in for R and MARK
+# results are cached by a hash of the .inp, the intervals line, the model and R/rmark_fit_model.txt,
+# so only sites with new exports (or models that have changed) are fitted again
+# the summary has a line per site_species and model, best first within each site_species:
+# site_species,model,type,npar,aicc,delta_aicc,weight,deviance,neg2lnl
+# (weight is the model's AICc weight among the models fitted for that site_species)
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import sys	# so we can get at stderr
+import os	# file paths
+import glob	# finding .inp files
+import math	# AICc weights
+import json	# cached result format
+import csv	# result files from the fits
+import shutil	# scratch directories
+import hashlib	# cache keys
+import tempfile	# scratch directories
+import argparse	# command line options
+import subprocess	# fits run as separate Rscript processes
+import signal	# stopping fits that run too long
+import time	# fit timeouts
+import multiprocessing	# pool running the fits
+import sloop_cache	# the fit cache lives in the cache directory
+
+fitter_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "R", "rmark_fit_model.txt")
+
+verbose = False	# global to turn on debug/information output
+default_timeout = 60	# minutes a fit may run for unless told otherwise
+
+# model.parameters terms, as in R/analyse_site_species.txt
+terms = {
+	"S.time": "list(formula=~time)",
+	"p.session": "list(formula=~session, share=TRUE)",
+	"p.time.session": "list(formula=~-1+session:time, share=TRUE)",
+	"p.session.mixture": "list(formula=~session+mixture, share=TRUE)",
+	"p.time.session.mixture": "list(formula=~-1+session:time+mixture, share=TRUE)",
+	"pi.session": "list(formula=~session)",
+	"GammaDoublePrime.fixed": "list(fixed=0)",
+	"GammaPrime.fixed": "list(fixed=1)",
+	"GammaDoublePrime.random": "list(formula=~time, share=TRUE)",
+	"GammaDoublePrime.dot": "list(formula=~1)",
+	"GammaPrime.dot": "list(formula=~1)",
+}
+
+# candidate models: (name, mark() model, [(parameter, term)...])
+# nm: no movement (Gamma'' fixed at 0), rm: random movement (Gamma''=Gamma' by year), Mm: Markovian movement
+models = []
+for movement, gammas in (("nm", [("GammaDoublePrime", "GammaDoublePrime.fixed"), ("GammaPrime", "GammaPrime.fixed")]),
+		("rm", [("GammaDoublePrime", "GammaDoublePrime.random")]),
+		("Mm", [("GammaDoublePrime", "GammaDoublePrime.dot"), ("GammaPrime", "GammaPrime.dot")])):
+	models += [("Mo." + movement, "RDHuggins", [("S", "S.time"), ("p", "p.session")] + gammas),
+		("Mt." + movement, "RDHuggins", [("S", "S.time"), ("p", "p.time.session")] + gammas),
+		("Mh." + movement, "RDHFHet", [("S", "S.time"), ("p", "p.session.mixture"), ("pi", "pi.session")] + gammas),
+		("Mht." + movement, "RDHFHet", [("S", "S.time"), ("p", "p.time.session.mixture"), ("pi", "pi.session")] + gammas)]
+
+
+def model_parameters(parameters):	# R expression for mark()'s model.parameters
+	return "list(" + ", ".join([name + "=" + terms[term] for name, term in parameters]) + ")"
+
+
+# directory holding the cached fits
+def fit_cache_directory(cache_dir=None):
+	return os.path.join(sloop_cache.cache_directory(cache_dir), "rmark")
+
+
+# cache key for a fit: hash of everything that goes into it
+def fit_key(inp_data, intervals, name, model_type, parameters, fitter):
+	digest = hashlib.sha1()
+	for part in (inp_data, intervals, name, model_type, parameters, fitter):
+		digest.update(part)
+		digest.update("\0")
+	return digest.hexdigest()
+
+
+# run a fit's command in directory, output to log; returns its exit status, or None if it was stopped after timeout minutes
+# the fit runs in a process group of its own, so stopping it stops the MARK run R started as well
+def run_fit(command, directory, log, timeout):
+	process = subprocess.Popen(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT, preexec_fn=os.setsid)
+	deadline = time.time() + timeout * 60
+	try:
+		while process.poll() is None:
+			if timeout > 0 and time.time() > deadline:
+				os.killpg(process.pid, signal.SIGKILL)
+				process.wait()
+				return None
+			time.sleep(0.2)
+	except BaseException:	# interrupted: the fit is in a group of its own, so it wouldn't see the Ctrl-C
+		os.killpg(process.pid, signal.SIGKILL)
+		raise
+	return process.returncode
+
+
+# fit one model (in a pool worker): returns (job, result, message), result is None (and message says why) if it failed
+def fit_model(job):
+	site_species, inp_path, intervals, name, model_type, parameters, rscript, keep_temp, timeout = job
+	scratch = tempfile.mkdtemp(prefix="rmark_" + site_species + "." + name + "_")
+	shutil.copyfile(inp_path, os.path.join(scratch, site_species + ".inp"))
+	log = open(os.path.join(scratch, "rscript.log"), "w")
+	try:
+		status = run_fit([rscript, os.path.abspath(fitter_path), site_species, name, model_type, parameters, intervals],
+			scratch, log, timeout)
+	except OSError, e:
+		log.close()
+		shutil.rmtree(scratch)
+		return job, None, "can't run " + rscript + ": " + str(e)
+	log.close()
+	if status is None:
+		return job, None, "still running after " + str(timeout) + " minutes, stopped it, see " + os.path.join(scratch, "rscript.log")
+	result_path = os.path.join(scratch, "result.csv")
+	if status != 0 or not os.path.exists(result_path):
+		return job, None, rscript + " exited with status " + str(status) + ", see " + os.path.join(scratch, "rscript.log")
+	try:
+		f = open(result_path)
+		row = list(csv.DictReader(f))[0]
+		f.close()
+		result = {"npar": int(row["npar"]), "aicc": float(row["aicc"]), "deviance": float(row["deviance"]),
+			"neg2lnl": float(row["neg2lnl"]), "derived": []}
+		derived_path = os.path.join(scratch, "derived.csv")
+		if os.path.exists(derived_path):
+			f = open(derived_path)
+			result["derived"] = [[float(derived_row[column]) for column in ("estimate", "se", "lcl", "ucl")]
+				for derived_row in csv.DictReader(f)]
+			f.close()
+	except (IndexError, KeyError, ValueError), e:
+		return job, None, "can't read the results in " + scratch + ": " + str(e)
+	if not keep_temp:
+		shutil.rmtree(scratch)
+	return job, result, None
+
+
+def read_cached(path):	# a cached fit, or None
+	if not os.path.exists(path):
+		return None
+	f = open(path)
+	result = json.load(f)
+	f.close()
+	return result
+
+
+def write_cached(path, result):	# save a fit, replacing any old one in one go
+	tmp_path = path + ".tmp"
+	f = open(tmp_path, "w")
+	json.dump(result, f)
+	f.close()
+	os.rename(tmp_path, path)
+
+
+# site_species to fit: [(site_species, inp path, intervals line)]
+def find_inputs(names):
+	if names == []:
+		names = sorted([name for name in glob.glob("*.inp") if not name.endswith("_cohort.inp")])
+		if names == []:
+			print >> sys.stderr, "Error: no .inp files in the current directory"
+			sys.exit()
+	inputs = []
+	for name in names:
+		if name.endswith(".inp"):
+			name = name[:-len(".inp")]
+		inp_path = name + ".inp"
+		surveys_path = name + "_surveys.txt"
+		for path in (inp_path, surveys_path):
+			if not os.path.exists(path):
+				print >> sys.stderr, "Error: can't find " + path
+				sys.exit()
+		f = open(surveys_path)
+		intervals = f.readline().strip()
+		f.close()
+		inputs.append((os.path.basename(name), inp_path, intervals))
+	return inputs
+
+
+# AICc table for each site_species: rows are (site_species, model, type, npar, aicc, delta, weight, deviance, neg2lnl)
+def summarise(fits):
+	rows = []
+	for site_species in sorted(set([site_species for site_species, name, model_type, result in fits])):
+		fitted = sorted([(result["aicc"], name, model_type, result) for s, name, model_type, result in fits if s == site_species])
+		best = fitted[0][0]
+		total = sum([math.exp(-(aicc - best) / 2) for aicc, name, model_type, result in fitted])
+		for aicc, name, model_type, result in fitted:
+			rows.append((site_species, name, model_type, result["npar"], aicc, aicc - best,
+				math.exp(-(aicc - best) / 2) / total, result["deviance"], result["neg2lnl"]))
+	return rows
+
+
+def write_summary(f, rows):
+	f.write("site_species,model,type,npar,aicc,delta_aicc,weight,deviance,neg2lnl\n")
+	for row in rows:
+		f.write("%s,%s,%s,%d,%.4f,%.4f,%.4f,%.4f,%.4f\n" % row)
+
+
+def write_derived(f, fits):
+	f.write("site_species,model,session,estimate,se,lcl,ucl\n")
+	for site_species, name, model_type, result in sorted(fits):
+		for session, (estimate, se, lcl, ucl) in enumerate(result["derived"]):
+			f.write("%s,%s,%d,%.4f,%.4f,%.4f,%.4f\n" % (site_species, name, session + 1, estimate, se, lcl, ucl))
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage="rmark_batch.py [-v] [-j jobs] [--models model[,model...]] [--rscript path] [--cache-dir dir] [--refit]\n       [--timeout minutes] [--keep-temp] [--out file] [--derived file] [site_species ...]")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--models", default=None)
+	parser.add_argument("--rscript", default="Rscript")
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--refit", action="store_true")
+	parser.add_argument("--timeout", type=float, default=default_timeout)
+	parser.add_argument("--keep-temp", action="store_true")
+	parser.add_argument("--out", default=None)
+	parser.add_argument("--derived", default=None)
+	parser.add_argument("site_species", nargs="*")
+	options = parser.parse_args()
+	verbose = options.verbose
+
+	chosen = models
+	if options.models is not None:
+		names = options.models.split(",")
+		for name in names:
+			if name not in [model[0] for model in models]:
+				print >> sys.stderr, "Error: unknown model " + name + " (models are " + ", ".join([model[0] for model in models]) + ")"
+				sys.exit()
+		chosen = [model for model in models if model[0] in names]
+	inputs = find_inputs(options.site_species)
+
+	f = open(fitter_path)
+	fitter = f.read()
+	f.close()
+	cache_directory = fit_cache_directory(options.cache_dir)
+	if not os.path.isdir(cache_directory):
+		os.makedirs(cache_directory)
+
+	fits = []	# (site_species, model, type, result)
+	jobs = []
+	keys = {}	# job -> cache file
+	for site_species, inp_path, intervals in inputs:
+		f = open(inp_path, "rb")
+		inp_data = f.read()
+		f.close()
+		for name, model_type, parameters in chosen:
+			parameters = model_parameters(parameters)
+			path = os.path.join(cache_directory, fit_key(inp_data, intervals, name, model_type, parameters, fitter) + ".json")
+			result = None if options.refit else read_cached(path)
+			if result is not None:
+				fits.append((site_species, name, model_type, result))
+				continue
+			job = (site_species, inp_path, intervals, name, model_type, parameters, options.rscript, options.keep_temp, options.timeout)
+			keys[job] = path
+			jobs.append(job)
+	if verbose:
+		print len(fits), "fits cached,", len(jobs), "to run"
+
+	failed = 0
+	if jobs != []:
+		pool = multiprocessing.Pool(options.jobs)
+		for job, result, message in pool.imap_unordered(fit_model, jobs):
+			site_species, name, model_type = job[0], job[3], job[4]
+			if result is None:
+				print >> sys.stderr, "Error: fitting " + name + " to " + site_species + " failed: " + message
+				failed += 1
+				continue
+			write_cached(keys[job], result)
+			fits.append((site_species, name, model_type, result))
+			if verbose:
+				print site_species, name, "AICc", result["aicc"]
+		pool.close()
+		pool.join()
+
+	if options.out is None:
+		write_summary(sys.stdout, summarise(fits))
+	else:
+		f = open(options.out, "w")
+		write_summary(f, summarise(fits))
+		f.close()
+	if options.derived is not None:
+		f = open(options.derived, "w")
+		write_derived(f, fits)
+		f.close()
+	if failed > 0:
+		print >> sys.stderr, failed, "of", len(jobs), "fits failed"
+		sys.exit(1)
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
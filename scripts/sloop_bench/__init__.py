@@ -0,0 +1,9 @@
+# benchmarks for sloop_to_mark.py and harvest_newbies.py on synthetic Sloop data
+# see __main__.py for usage: run as python -m sloop_bench from the scripts directory
+
+import os	# path utilities
+import sys	# so the scripts' modules can be imported from wherever we're run
+
+scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if scripts_dir not in sys.path:
+	sys.path.insert(0, scripts_dir)
@@ -0,0 +1,198 @@
+# time each stage of sloop_to_mark.py and harvest_newbies.py on synthetic Sloop data
+
+# usage (from the scripts directory):
+# python -m sloop_bench [--sites n] [--series n] [--surveys n] [--individuals n] [--resight p] [--size-noise p]
+#                       [--singletons p] [--repeats p] [--photo-bytes n] [--seed n] [--repeat n]
+#                       [--label text] [--out results.json] [--compare old_results.json] [--keep dir]
+# makes a survey workbook, a CAPTURE table in an SQLite stand-in for the Sloop database and a photo store in a
+# temporary directory (or in the new directory dir with --keep), then runs each stage on every site, --repeat times (default 3)
+# the fastest time for each stage is written to results.json (default bench_results.json) with the parameters and
+# counts, and printed; --compare prints each stage's time against an earlier results file, to spot regressions
+
+import sys	# so we can get at stderr
+import os	# temporary directories
+import time	# stage timings
+import datetime	# survey days for the queries
+import json	# results format
+import shutil	# clearing up
+import tempfile	# where the synthetic data goes
+import argparse	# command line options
+import platform	# recorded with the results
+import sloop_bench	# puts the scripts directory on the path
+from sloop_bench import synth, fake_db
+import sloop_db	# the live database connection is swapped for the stand-in
+import sloop_cache
+import sloop_workbook
+import sloop_to_mark
+import harvest_newbies
+
+species = "otago"	# species name the synthetic data goes under, any name the scripts know will do
+
+
+class StageTimes(object):
+	'Seconds spent in each stage, accumulated over sites'
+
+	def __init__(self):
+		self.seconds = {}
+		self.order = []		# stages in the order first timed, for printing
+
+	def Time(self, stage, function, *args):	# call function(*args), adding the time taken to stage; returns its result
+		start = time.time()
+		result = function(*args)
+		if stage not in self.seconds:
+			self.seconds[stage] = 0.0
+			self.order.append(stage)
+		self.seconds[stage] += time.time() - start
+		return result
+
+
+# add a list of sightings to a survey object, as query_skinks does as they come back from the database
+def add_sightings(surveys, rows):
+	for date, skink, value in rows:
+		surveys.AddSkink(date, skink, value)
+
+
+# add a list of each animal's sightings by day to a survey object, as query_skinks does unless told --legacy-sizes
+def add_days(surveys, rows):
+	for date, skink, size, count in rows:
+		surveys.AddDay(date, skink, size, count)
+
+
+# one run of every stage over every site; returns the stage times and counts
+def run_once(book_path, photo_dir, work_dir):
+	stages = StageTimes()
+	counts = {"sites": 0, "rows": 0, "day_rows": 0, "individuals": 0, "occasions": 0, "newbies": 0, "newbies_query": 0, "photos": 0, "photo_bytes": 0}
+	cache_dir = tempfile.mkdtemp(dir=work_dir)
+
+	# workbook: parsed from cold, then from the calendar cache
+	book = stages.Time("workbook_parse", lambda: sloop_workbook.SurveyBook(book_path, cache_dir))
+	sites = stages.Time("workbook_parse", book.Sites, species)	# leaves out the notes column, with a warning
+	assert synth.notes_header not in sites, "the notes column was taken for a site"
+	try:	# and asking for it as a site is an error
+		book.Calendar(species, synth.notes_header)
+		raise AssertionError("the notes column parsed as a survey calendar")
+	except ValueError:
+		pass
+	stages.Time("workbook_cached", lambda: sloop_workbook.SurveyBook(book_path, cache_dir).Sites(species))
+
+	source = stages.Time("db_connect", sloop_db.LiveSource, species)
+	cache = sloop_cache.CacheSource(species, cache_dir)
+	stages.Time("cache_refresh", cache.Refresh, source.conn)
+	for site in sites:
+		counts["sites"] += 1
+		# export
+		surveys = stages.Time("extract_surveys", sloop_to_mark.extract_surveys, book, species, site)
+		days = [datetime.date(*d) for d in surveys.SurveyDates()]
+		rows = stages.Time("query_skinks", lambda: list(source.Sightings(site, days, "EST_SIZE_CLASS")))
+		stages.Time("query_skinks_cache", lambda: list(cache.Sightings(site, days, "EST_SIZE_CLASS")))
+		stages.Time("AddSkink", add_sightings, surveys, rows)
+		day_surveys = sloop_to_mark.extract_surveys(book, species, site)
+		day_rows = stages.Time("query_daily_sizes", lambda: list(source.DailySizes(site, days)))
+		stages.Time("query_daily_sizes_cache", lambda: list(cache.DailySizes(site, days)))
+		stages.Time("AddDay", add_days, day_surveys, day_rows)
+		stages.Time("BuildHistory", surveys.BuildHistory)
+		stages.Time("ProcessSizes", surveys.ProcessSizes)
+		for name in sloop_to_mark.default_formats.split(",") + ["long"]:
+			stages.Time("writer_" + name, sloop_to_mark.render_outputs, surveys, site, species, [name])
+		stages.Time("writers_one_pass", sloop_to_mark.render_outputs, surveys, site, species, sloop_to_mark.default_formats.split(","))
+		counts["rows"] += len(rows)
+		counts["day_rows"] += len(day_rows)
+		counts["individuals"] += len(surveys.individuals)
+		counts["occasions"] += surveys.OccasionCount()
+
+		# harvest
+		newbie_surveys = stages.Time("extract_surveys", harvest_newbies.extract_surveys, book, species, site)
+		stages.Time("harvest_query_skinks", harvest_newbies.query_skinks, source, newbie_surveys, site)
+		newbies = stages.Time("CollectNewbies", newbie_surveys.CollectNewbies)
+		dest = os.path.join(work_dir, "harvest_" + site)
+		if os.path.exists(dest):
+			shutil.rmtree(dest)
+		os.makedirs(dest)
+		copier = stages.Time("CollectPhotos", harvest_newbies.CollectPhotos, photo_dir, dest, newbies, None, True)
+		stages.Time("CollectPhotos_present", harvest_newbies.CollectPhotos, photo_dir, dest, newbies, None, True)
+		photo_counts, moved, elapsed = copier.Stats()
+		counts["newbies"] += len(newbies)
+		counts["photos"] += photo_counts.get("copied", 0)
+		counts["photo_bytes"] += moved
+
+	# harvest as it's done unless told --legacy-newbies: the newbies of every site in one query
+	site_newbies = stages.Time("query_newbies", harvest_newbies.query_newbies, book, species, sites, source)
+	stages.Time("query_newbies_cache", harvest_newbies.query_newbies, book, species, sites, cache)
+	counts["newbies_query"] = sum([len(found) for found in site_newbies.values()])
+	cache.Close()
+	source.Close()
+	shutil.rmtree(cache_dir)
+	return stages, counts
+
+
+# print this run's stage times, against an earlier run's if we have one
+def print_results(results, old):
+	print "%-24s %10s" % ("stage", "seconds") + ("%10s %8s" % ("before", "ratio") if old is not None else "")
+	for stage in results["order"]:
+		line = "%-24s %10.4f" % (stage, results["stages"][stage])
+		if old is not None and stage in old["stages"]:
+			before = old["stages"][stage]
+			ratio = 0.0
+			if before > 0:
+				ratio = results["stages"][stage] / before
+			line += "%10.4f %8.2f" % (before, ratio)
+		print line
+	print " ".join(["%s=%d" % (k, v) for k, v in sorted(results["counts"].items())])
+
+
+def main():
+	parser = argparse.ArgumentParser(prog="python -m sloop_bench")
+	for name, value in sorted(synth.default_params.items()):
+		parser.add_argument("--" + name.replace("_", "-"), type=type(value), default=value, dest=name)
+	parser.add_argument("--repeat", type=int, default=3)
+	parser.add_argument("--label", default="")
+	parser.add_argument("--out", default="bench_results.json")
+	parser.add_argument("--compare", default=None)
+	parser.add_argument("--keep", default=None)
+	options = parser.parse_args()
+	params = dict([(name, getattr(options, name)) for name in synth.default_params])
+
+	old = None
+	if options.compare is not None:
+		f = open(options.compare)
+		old = json.load(f)
+		f.close()
+
+	if options.keep is not None:
+		work_dir = options.keep
+		if os.path.exists(work_dir):
+			print >> sys.stderr, "Error: " + work_dir + " already exists, --keep needs a new directory"
+			sys.exit()
+		os.makedirs(work_dir)
+	else:
+		work_dir = tempfile.mkdtemp(prefix="sloop_bench")
+	try:
+		start = time.time()
+		book_path, db_path, photo_dir = synth.generate(params, work_dir, species)
+		generate_time = time.time() - start
+		sloop_db.connect = lambda species: fake_db.FakeConnection(db_path)	# every connection goes to the stand-in
+
+		best = None
+		for i in range(options.repeat):
+			stages, counts = run_once(book_path, photo_dir, work_dir)
+			if best is None:
+				best = stages
+			else:
+				for stage in stages.order:
+					best.seconds[stage] = min(best.seconds[stage], stages.seconds[stage])
+	finally:
+		if options.keep is None:
+			shutil.rmtree(work_dir)
+
+	results = {"label": options.label, "when": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+		"params": params, "repeat": options.repeat, "generate_seconds": generate_time,
+		"stages": best.seconds, "order": best.order, "counts": counts}
+	f = open(options.out, "w")
+	json.dump(results, f, indent=1, sort_keys=True)
+	f.close()
+	print_results(results, old)
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
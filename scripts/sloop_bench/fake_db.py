@@ -0,0 +1,130 @@
+# stand-in for a psycopg2 connection to a Sloop database, backed by an SQLite file holding a CAPTURE table
+# only does what sloop_db and sloop_cache ask of psycopg2: the postgres-only bits of their queries
+# (%s parameters, CAST(... AS date), = ANY(list), <> ALL(list), unnest(list::type[], ...) AS t(columns),
+# string_agg(... ORDER BY column)) are translated to SQLite, and md5 and string_agg are added to it
+
+import sqlite3	# the database standing in for postgres
+import re	# query translation
+import hashlib	# md5 for sloop_cache's range check
+
+# schema of the synthetic CAPTURE table, as much of Sloop's as the scripts use
+capture_schema = 'CREATE TABLE IF NOT EXISTS "CAPTURE" ("SL_ID" INTEGER PRIMARY KEY, "INDIVIDUAL_ID" TEXT, ' \
+	'"EST_SIZE_CLASS" TEXT, "SITE" TEXT, "EVENT" TEXT, "CAPTURE_TIME" timestamp)'
+
+placeholder = re.compile(r'(= ANY\(%s\)|<> ALL\(%s\)|unnest\((?:%s::\w+\[\](?:, )?)+\) AS \w+\([^)]*\)|%s)')	# the ways queries take parameters
+unnest_arrays = re.compile(r'unnest\(((?:%s::\w+\[\](?:, )?)+)\) AS (\w+)\(([^)]*)\)')	# lists zipped into a table
+cast_date = re.compile(r'CAST\(("[A-Z_]+") AS date\)')
+aggregate_order = re.compile(r' ORDER BY "[A-Z_]+"\)')	# SQLite aggregates take rows as they come, in key order here
+
+
+# translate a psycopg2 query and its parameters to SQLite
+def translate(query, params):
+	select, sep, rest = query.partition(" FROM ")
+	# in the select list, name the column so sqlite3 gives us a datetime.date back, as psycopg2 would
+	select = cast_date.sub(r'date(\1) AS "day [date]"', select)
+	rest = cast_date.sub(r'date(\1)', rest)
+	select = aggregate_order.sub(')', select)
+	pieces = placeholder.split(select + sep + rest)
+	query = pieces[0]
+	values = []
+	params = list(params)
+	for i in range(1, len(pieces), 2):
+		marker = pieces[i]
+		if marker == "%s":
+			query += "?"
+			values.append(params.pop(0))
+		elif marker.startswith("unnest("):	# lists zipped into a table become a VALUES list, a row of parameters per row
+			match = unnest_arrays.match(marker)
+			arrays = [params.pop(0) for array in range(marker.count("%s"))]
+			columns = [column.strip() for column in match.group(3).split(",")]
+			rows = zip(*arrays)
+			query += "(SELECT " + ", ".join(["column%d AS %s" % (n + 1, column) for n, column in enumerate(columns)]) + \
+				" FROM (VALUES " + ", ".join(["(" + ", ".join(["?"] * len(columns)) + ")"] * len(rows)) + ")) AS " + match.group(2)
+			for row in rows:
+				values.extend(row)
+		else:	# a list parameter becomes an IN list
+			param = params.pop(0)
+			query += {"= ANY(%s)": " IN (", "<> ALL(%s)": " NOT IN ("}[marker] + ", ".join(["?"] * len(param)) + ")"
+			values.extend(param)
+		query += pieces[i + 1]
+	return query, values
+
+
+class FakeCursor(object):
+	'Cursor on the SQLite stand-in, named or not'
+
+	def __init__(self, db):
+		self.db = db
+		self.cur = None
+		self.itersize = 2000	# ignored, rows come from a local file anyway
+
+	def execute(self, query, params=()):
+		query, values = translate(query, params)
+		self.cur = self.db.execute(query, values)
+
+	def fetchone(self):
+		return self.cur.fetchone()
+
+	def fetchmany(self, size=None):
+		if size is None:
+			size = self.itersize
+		return self.cur.fetchmany(size)
+
+	def fetchall(self):
+		return self.cur.fetchall()
+
+	def __iter__(self):
+		return iter(self.cur)
+
+	def close(self):
+		self.cur = None
+
+
+class StringAgg(object):
+	'postgres string_agg(value, separator) for SQLite'
+
+	def __init__(self):
+		self.values = []
+		self.separator = ""
+
+	def step(self, value, separator):
+		if value is not None:
+			self.values.append(value)
+		self.separator = separator
+
+	def finalize(self):
+		if self.values == []:
+			return None
+		return self.separator.join(self.values)
+
+
+def md5(text):
+	if text is None:
+		return None
+	return hashlib.md5(text).hexdigest()
+
+
+class FakeConnection(object):
+	'psycopg2-like connection to the SQLite stand-in for a species database'
+
+	def __init__(self, path):
+		self.db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+		self.db.text_factory = str	# plain strings, as psycopg2 gives us
+		self.db.execute(capture_schema)
+		self.db.create_function("md5", 1, md5)
+		self.db.create_aggregate("string_agg", 2, StringAgg)
+
+	def set_session(self, readonly=False):
+		pass
+
+	def cursor(self, name=None):
+		return FakeCursor(self.db)
+
+	def commit(self):
+		self.db.commit()
+
+	def rollback(self):
+		self.db.rollback()
+
+	def close(self):
+		self.db.close()
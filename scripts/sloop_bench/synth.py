@@ -0,0 +1,117 @@
+# synthetic Sloop data for the benchmarks: a survey workbook, CAPTURE rows and a photo store
+
+# each site has its own survey series (one a year) of weekly surveys, all in one species sheet of the workbook,
+# followed by a column of free text notes like the ones people keep beside the calendars
+# animals turn up in a random series, are resighted on each later survey with a fixed probability,
+# and grow one size class a year; the size estimated in Sloop is wrong (or missing, or unsure) with a fixed probability
+# a fraction of sightings are unmatched singletons, and some animals are photographed twice on a survey
+
+import os	# directories for the photo store
+import random	# everything here is random, but repeatable given the seed
+import datetime	# survey dates and capture times
+import fake_db	# the CAPTURE table lives in the SQLite stand-in for the Sloop database
+
+try:
+	import xlwt	# .xls writer, only needed to make synthetic workbooks
+except ImportError:
+	xlwt = None
+
+# what the benchmarks run on unless told otherwise
+default_params = {
+	"sites": 4,		# site columns in the species sheet
+	"series": 6,		# survey series (years) at each site
+	"surveys": 4,		# surveys in each series
+	"individuals": 400,	# animals at each site
+	"resight": 0.5,		# chance an animal is photographed on a survey after its first sighting
+	"size_noise": 0.2,	# chance a size estimate is wrong, unsure or missing
+	"singletons": 0.05,	# fraction of sightings that are unmatched singletons
+	"repeats": 0.1,		# chance an animal is photographed twice on the same survey
+	"photo_bytes": 20000,	# size of each synthetic photo
+	"photo_sides": 0.9,	# chance each side's photo exists for a sighting
+	"seed": 1,
+}
+
+noisy_sizes = ["1", "2", "3", "4", "1-2", "2-3", "3-4", "", "?"]	# what a wrong size estimate might be
+notes_header = "Notes"	# header of the column of notes after the site columns, which isn't a survey calendar
+
+
+# survey dates for a site: series of weekly surveys, one series a year
+def survey_calendar(params, site_number):
+	calendar = []
+	for s in range(params["series"]):
+		start = datetime.date(2000 + s, 2, 1 + site_number % 20)
+		calendar.append([start + datetime.timedelta(days=7*k) for k in range(params["surveys"])])
+	return calendar
+
+
+# sightings at a site: [(capture time, individual id, estimated size)] in time order
+def site_sightings(params, rng, site, calendar):
+	sightings = []
+	for n in range(params["individuals"]):
+		skink_id = "%s_%d" % (site, n)
+		first = rng.randrange(len(calendar))
+		size = rng.randint(1, 3)
+		first_day = rng.randrange(len(calendar[first]))
+		for s in range(first, len(calendar)):
+			for k, day in enumerate(calendar[s]):
+				if s == first and k < first_day:
+					continue	# hasn't turned up yet
+				if (s, k) != (first, first_day) and rng.random() >= params["resight"]:
+					continue	# not photographed this time
+				for repeat in range(1 + (rng.random() < params["repeats"])):
+					estimate = str(size)
+					if rng.random() < params["size_noise"]:
+						estimate = rng.choice(noisy_sizes)
+					skink = skink_id
+					if rng.random() < params["singletons"]:
+						skink = "SINGLETON_SO_FAR"
+					time = datetime.datetime(day.year, day.month, day.day, rng.randint(8, 17), rng.randint(0, 59), rng.randint(0, 59))
+					sightings.append((time, skink, estimate))
+			size = min(4, size + 1)
+	sightings.sort()
+	return sightings
+
+
+# make the synthetic data in directory for species; returns the workbook path, database path and photo store path
+def generate(params, directory, species):
+	if xlwt is None:
+		raise ImportError("the xlwt package is needed to make synthetic survey workbooks")
+	rng = random.Random(params["seed"])
+	book_path = os.path.join(directory, "surveys.xls")
+	db_path = os.path.join(directory, species + "_capture.db")
+	photo_dir = os.path.join(directory, "images", "originals")
+	os.makedirs(photo_dir)
+
+	book = xlwt.Workbook()
+	sheet = book.add_sheet(species)
+	date_style = xlwt.easyxf(num_format_str="YYYY-MM-DD")
+	conn = fake_db.FakeConnection(db_path)
+	sl_id = 0
+	photo = "\xff\xd8" + "\0" * (params["photo_bytes"] - 2)	# starts like a JPEG, that'll do
+	for col in range(params["sites"]):
+		site = "Site%d" % col
+		calendar = survey_calendar(params, col)
+		sheet.write(0, col, site)
+		sheet.write(1, col, col % 2)	# every other site is closed to size 1 births
+		row = 2
+		for dates in calendar:
+			for day in dates:
+				sheet.write(row, col, day, date_style)
+				row += 1
+			row += 1	# blank cell between series
+		rows = []
+		for time, skink, estimate in site_sightings(params, rng, site, calendar):
+			sl_id += 1
+			rows.append((sl_id, skink, estimate, site, "PhotoID", time.strftime("%Y-%m-%d %H:%M:%S")))
+			for side in ("L", "R"):
+				if rng.random() < params["photo_sides"]:
+					f = open(os.path.join(photo_dir, "%d_%s.jpg" % (sl_id, side)), "wb")
+					f.write(photo)
+					f.close()
+		conn.db.executemany('INSERT INTO "CAPTURE" VALUES (?, ?, ?, ?, ?, ?)', rows)
+	sheet.write(0, params["sites"], notes_header)
+	sheet.write(2, params["sites"], "resurveyed after flood")
+	conn.commit()
+	conn.close()
+	book.save(book_path)
+	return book_path, db_path, photo_dir + "/"
@@ -0,0 +1,163 @@
+# build records for sloop_to_mark.py and harvest_newbies.py --changed-only: which sites' outputs are up to date
+
+# each site's outputs are recorded in a build file in the output directory (one per script) with a hash of everything
+# that went into them: the scripts' code, the options that change what is written, the site's survey calendar and
+# every row fetched for the site; and a hash of each output as written (a photo directory by its file names,
+# sizes and times)
+# a later run fetches the rows again (which is quick) and skips fitting and writing for a site if the inputs hash the
+# same and its outputs are still as recorded, so only sites with new sightings, matches or surveys are redone
+# rows are hashed as text, so the live database and the local cache hash the same sightings the same way
+
+import os	# file paths
+import json	# build file format
+import hashlib	# input and output hashes
+import decimal	# postgres numeric values in rows
+
+build_version = 1	# bumped if what is hashed changes, older build files are ignored
+
+
+# write a file so it is either all there or not changed at all: an interrupted run never leaves half a file behind
+def write_atomic(name, contents):
+	tmp_name = name + ".tmp"
+	f = open(tmp_name, "wb")
+	f.write(contents)
+	f.close()
+	os.rename(tmp_name, name)
+
+
+# hash of the source of the modules that produce a script's outputs, so changing the code redoes everything
+def code_hash(modules):
+	digest = hashlib.sha1()
+	for module in modules:
+		path = module.__file__
+		if path.endswith(".pyc") or path.endswith(".pyo"):
+			path = path[:-1]
+		f = open(path, "rb")
+		digest.update(f.read())
+		f.close()
+	return digest.hexdigest()
+
+
+def row_text(row):	# a fetched row as text, the same whichever source it came from
+	values = []
+	for value in row:
+		if isinstance(value, (float, decimal.Decimal)):
+			value = repr(float(value))
+		elif isinstance(value, unicode):
+			value = value.encode("utf-8")
+		values.append(str(value))
+	return "\t".join(values) + "\n"
+
+
+def output_hash(name):	# hash of an output file, or of a photo directory's listing; None if it isn't there
+	if os.path.isdir(name):
+		digest = hashlib.sha1()
+		for photo in sorted(os.listdir(name)):
+			st = os.stat(os.path.join(name, photo))
+			digest.update("%s\t%d\t%d\n" % (photo, st.st_size, int(st.st_mtime)))
+		return digest.hexdigest()
+	if not os.path.isfile(name):
+		return None
+	digest = hashlib.sha1()
+	f = open(name, "rb")
+	while True:
+		block = f.read(1 << 16)
+		if block == "":
+			break
+		digest.update(block)
+	f.close()
+	return digest.hexdigest()
+
+
+class HashingSource(object):
+	'Wraps a sightings source, hashing the rows it hands out for each site'
+
+	def __init__(self, source):
+		self.source = source
+		self.digests = {}	# site -> sha1 of the rows fetched for it
+
+	def _Hash(self, site, row):
+		if site not in self.digests:
+			self.digests[site] = hashlib.sha1()
+		self.digests[site].update(row_text(row))
+
+	def Sightings(self, site, days, column):
+		self._Hash(site, ["Sightings", column])
+		for row in self.source.Sightings(site, days, column):
+			self._Hash(site, row)
+			yield row
+
+	def DailySizes(self, site, days):
+		self._Hash(site, ["DailySizes"])
+		for row in self.source.DailySizes(site, days):
+			self._Hash(site, row)
+			yield row
+
+	def Newbies(self, calendar):	# rows are hashed for the site they belong to
+		for site in sorted(set([day[0] for day in calendar])):
+			self._Hash(site, ["Newbies"])
+		for row in self.source.Newbies(calendar):
+			self._Hash(row[0], row)
+			yield row
+
+	def Rows(self, site):	# hash of the rows fetched for a site so far
+		if site not in self.digests:
+			self.digests[site] = hashlib.sha1()
+		return self.digests[site].hexdigest()
+
+	def Close(self):
+		self.source.Close()
+
+
+class BuildRecord(object):
+	'What each output of a script was last built from, kept in the output directory'
+
+	def __init__(self, path):
+		self.path = path
+		self.outputs = {}	# output name -> [input hash, output hash], both None if it has to be built next time
+		if os.path.exists(path):
+			f = open(path)
+			saved = json.load(f)
+			f.close()
+			if saved.get("version") == build_version:
+				self.outputs = saved["outputs"]
+
+	def Plan(self, names, inputs):	# None if the outputs are up to date for these inputs, otherwise why they need building
+		for name in names:
+			if name not in self.outputs:
+				return "new"
+			if self.outputs[name][0] is None:
+				return "incomplete last time"
+			if self.outputs[name][0] != inputs:
+				return "inputs changed"
+		for name in names:
+			current = output_hash(name)
+			if current is None:
+				return "output missing"
+			if current != self.outputs[name][1]:
+				return "output changed"
+		return None
+
+	def Record(self, names, inputs):	# note outputs (already written) as built from inputs
+		for name in names:
+			self.outputs[name] = [inputs, output_hash(name)]
+
+	def Incomplete(self, names):	# note outputs that have to be built next time whatever their inputs
+		for name in names:
+			self.outputs[name] = [None, None]
+
+	def Save(self):
+		write_atomic(self.path, json.dumps({"version": build_version, "outputs": self.outputs}, indent=0, sort_keys=True))
+
+
+# hash of the parts that go into a site's outputs (each part is turned into text with repr)
+def inputs_hash(*parts):
+	digest = hashlib.sha1()
+	for part in parts:
+		digest.update(repr(part))
+		digest.update("\0")
+	return digest.hexdigest()
+
+
+def print_plan(species, site, reason):	# a line of the plan: what happens to a site, and why
+	print "%-8s %-16s %s" % (species, site, "up to date" if reason is None else "build (" + reason + ")")
@@ -0,0 +1,182 @@
+# local copy of the Sloop photo-ID sightings, so exports don't have to hit the live database every time
+
+# one SQLite file per species holds INDIVIDUAL_ID, SL_ID, EST_SIZE_CLASS, SITE and CAPTURE_TIME
+# for every PhotoID row of the CAPTURE table
+# refreshing is incremental: only rows with an SL_ID above the highest one already cached are fetched, plus any range
+# of rows (range_size SL_IDs each) changed in Sloop since it was cached, e.g. by matching, a corrected size or a deleted
+# sighting; each range's row count and an md5 of its rows are taken on the server at each refresh and kept in the cache,
+# and a range whose count or md5 differs from last time is read again (the server reads the whole table for this,
+# but only the changed ranges come back)
+
+import sqlite3	# local database for the cache
+import os	# path and directory utilities
+import sys	# so we can get at stderr
+import datetime	# to get date conversion functions
+import sloop_db	# live database access, used to refresh the cache
+import sloop_stats	# timing and counting for --stats
+
+default_cache_dir = "~/.sloop_cache"	# where cache files go unless told otherwise
+
+provisional_ids = sloop_db.provisional_ids	# ids that can change when matching is done
+range_size = 1000	# SL_IDs in each range of rows checked for changes on refresh
+
+# row count and md5 of each range of photo-ID rows in the live database, to spot ranges changed since they were cached
+range_row = " || '|' || ".join(['CAST("SL_ID" AS text)'] + ['COALESCE("%s", \'\\N\')' % column for column in
+	("INDIVIDUAL_ID", "EST_SIZE_CLASS", "SITE")] + ['CAST("CAPTURE_TIME" AS text)'])
+range_query = 'SELECT "SL_ID" / %s, COUNT(*), md5(string_agg(' + range_row + ', \';\' ORDER BY "SL_ID")) ' \
+	'FROM "CAPTURE" WHERE "EVENT"=\'PhotoID\' GROUP BY 1'
+
+
+# the cache directory, given the --cache-dir option (also used for the photo index and survey calendar cache)
+def cache_directory(cache_dir=None):
+	if cache_dir is None:
+		cache_dir = default_cache_dir
+	return os.path.expanduser(cache_dir)
+
+
+# path of the cache file for a species
+def cache_path(species, cache_dir=None):
+	return os.path.join(cache_directory(cache_dir), species + "_capture.sqlite")
+
+
+class CacheSource(object):
+	'Photo-ID sightings for a species read from (and refreshed into) the local cache'
+
+	def __init__(self, species, cache_dir=None, create=True):
+		self.species = species
+		self.path = cache_path(species, cache_dir)
+		if not os.path.exists(self.path):
+			if not create:
+				print >> sys.stderr, "Error: no sightings cache for " + species + " at " + self.path + ", refresh it first"
+				sys.exit()
+			if not os.path.isdir(os.path.dirname(self.path)):
+				os.makedirs(os.path.dirname(self.path))
+		self.conn = sqlite3.connect(self.path)
+		self.conn.text_factory = str	# plain strings, as psycopg2 gives us
+		# same column names as the CAPTURE table so callers can ask for a column by its Sloop name
+		# CAPTURE_TIME is kept as ISO text, so it sorts in time order; CAPTURE_DAY is its date part
+		self.conn.execute('CREATE TABLE IF NOT EXISTS capture ("SL_ID" INTEGER PRIMARY KEY, "INDIVIDUAL_ID" TEXT, '
+			'"EST_SIZE_CLASS" TEXT, "SITE" TEXT, "CAPTURE_TIME" TEXT, "CAPTURE_DAY" TEXT)')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS capture_site_day ON capture ("SITE", "CAPTURE_DAY")')
+		# each range's row count and md5 on the server when it was last refreshed
+		self.conn.execute('CREATE TABLE IF NOT EXISTS capture_ranges (number INTEGER PRIMARY KEY, rows INTEGER, digest TEXT)')
+		self.conn.commit()
+
+	def HighWaterMark(self):	# highest SL_ID in the cache, 0 if it's empty
+		return self.conn.execute('SELECT COALESCE(MAX("SL_ID"), 0) FROM capture').fetchone()[0]
+
+	def Refresh(self, db_conn, itersize=None):	# bring the cache up to date from the live database
+		# returns the number of new rows and the number of rows read again from ranges changed in Sloop
+		with sloop_stats.span("cache_refresh"):
+			added, changed = self._refresh(db_conn, itersize)
+		sloop_stats.count("cache_rows_added", added)
+		return added, changed
+
+	def _refresh(self, db_conn, itersize):
+		if itersize is None:
+			itersize = sloop_db.fetch_itersize
+		high = self.HighWaterMark()
+		# ranges as they are now, first, so an edit while we're fetching shows up as a change next time
+		db_cur = db_conn.cursor()
+		db_cur.execute(range_query, (range_size,))
+		ranges = dict([(r[0], (r[1], r[2])) for r in db_cur])
+		db_cur.close()
+		cached = dict([(r[0], (r[1], r[2])) for r in self.conn.execute('SELECT number, rows, digest FROM capture_ranges')])
+		# ranges with cached rows that have changed (or were cached before ranges were kept) are read again, up to high
+		changed = 0
+		for number in sorted(set(ranges) | set(cached)):
+			start = number * range_size
+			if start > high or ranges.get(number) == cached.get(number):
+				continue
+			end = min(start + range_size, high + 1)
+			self.conn.execute('DELETE FROM capture WHERE "SL_ID" >= ? AND "SL_ID" < ?', (start, end))
+			changed += self._fetch(db_conn, itersize, '"SL_ID" >= %s AND "SL_ID" < %s', (start, end))
+		added = self._fetch(db_conn, itersize, '"SL_ID" > %s', (high,))
+		self.conn.execute('DELETE FROM capture_ranges')
+		self.conn.executemany('INSERT INTO capture_ranges VALUES (?, ?, ?)', [(number,) + ranges[number] for number in ranges])
+		db_conn.rollback()	# complete the read-only transaction on the live database
+		self.conn.commit()
+		return added, changed
+
+	def _fetch(self, db_conn, itersize, where, params):	# copy the photo-ID rows where the condition holds, returns how many
+		db_cur = db_conn.cursor(name="cache_refresh")	# named cursor: rows stay on the server until we ask for them
+		db_cur.itersize = itersize
+		db_cur.execute('SELECT "SL_ID", "INDIVIDUAL_ID", "EST_SIZE_CLASS", "SITE", "CAPTURE_TIME", CAST("CAPTURE_TIME" AS date) '
+			'FROM "CAPTURE" WHERE "EVENT"=\'PhotoID\' AND ' + where + ' ORDER BY "SL_ID"', params)
+		fetched = 0
+		while True:
+			records = db_cur.fetchmany(itersize)
+			if records == []:
+				break
+			self.conn.executemany('INSERT OR REPLACE INTO capture VALUES (?, ?, ?, ?, ?, ?)',
+				[(r[0], r[1], r[2], r[3], r[4].isoformat(" "), r[5].isoformat()) for r in records])
+			fetched += len(records)
+		db_cur.close()
+		return fetched
+
+	def Sightings(self, site, days, column):	# generator of (date tuple, INDIVIDUAL_ID, column value) for the site
+		# same rows, in the same order, as sloop_db.LiveSource.Sightings
+		if days == []:
+			return
+		wanted = set([d.isoformat() for d in days])
+		records = self.conn.execute('SELECT "INDIVIDUAL_ID", "' + column + '", "CAPTURE_DAY" FROM capture '
+			'WHERE "SITE"=? AND "CAPTURE_DAY" >= ? AND "CAPTURE_DAY" <= ? ORDER BY "CAPTURE_TIME", "SL_ID"',
+			(site, min(days).isoformat(), max(days).isoformat()))
+		for record in sloop_stats.timed_iter("cache_fetch", records, "rows_fetched"):
+			if record[2] in wanted:	# only sightings on the survey days themselves
+				day = datetime.datetime.strptime(record[2], "%Y-%m-%d")
+				yield (day.year, day.month, day.day), record[0], record[1]
+
+	def DailySizes(self, site, days):	# generator of (date tuple, INDIVIDUAL_ID, mean size, sightings), as sloop_db.LiveSource.DailySizes
+		if days == []:
+			return
+		wanted = set([d.isoformat() for d in days])
+		records = self.conn.execute(sloop_db.daily_sizes_query('SELECT "SL_ID", "INDIVIDUAL_ID", "EST_SIZE_CLASS", "CAPTURE_TIME", "CAPTURE_DAY" '
+			'FROM capture WHERE "SITE"=? AND "CAPTURE_DAY" >= ? AND "CAPTURE_DAY" <= ?', '"CAPTURE_DAY"'),
+			(site, min(days).isoformat(), max(days).isoformat()))
+		for record in sloop_stats.timed_iter("cache_fetch", records, "rows_fetched"):
+			if record[0] in wanted:	# only sightings on the survey days themselves
+				day = datetime.datetime.strptime(record[0], "%Y-%m-%d")
+				yield (day.year, day.month, day.day), record[1], record[2], record[3]
+
+	def Newbies(self, calendar):	# generator of (SITE, INDIVIDUAL_ID, SL_ID) for the sightings of newbies, as sloop_db.LiveSource.Newbies
+		if calendar == []:
+			return
+		# the calendar goes in a temporary table for the query to join on
+		self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS newbie_calendar (cal_site TEXT, cal_day TEXT, latest INTEGER)')
+		self.conn.execute('DELETE FROM newbie_calendar')
+		self.conn.executemany('INSERT INTO newbie_calendar VALUES (?, ?, ?)', [(site, day.isoformat(), int(latest)) for site, day, latest in calendar])
+		records = self.conn.execute('WITH sightings AS (SELECT "SL_ID", "INDIVIDUAL_ID", "SITE", "CAPTURE_TIME", latest FROM capture '
+			'JOIN newbie_calendar ON cal_site = "SITE" AND cal_day = "CAPTURE_DAY"), '
+			'firsts AS (SELECT "INDIVIDUAL_ID", "SITE", MIN("CAPTURE_TIME") AS first FROM sightings GROUP BY "INDIVIDUAL_ID", "SITE"), '
+			'starts AS (SELECT cal_site, MIN(cal_day) AS latest_start FROM newbie_calendar WHERE latest GROUP BY cal_site) '
+			'SELECT s."SITE", s."INDIVIDUAL_ID", s."SL_ID" FROM sightings s '
+			'JOIN firsts f ON f."INDIVIDUAL_ID" = s."INDIVIDUAL_ID" AND f."SITE" = s."SITE" JOIN starts ON cal_site = s."SITE" '
+			'WHERE s.latest AND (s."INDIVIDUAL_ID" IN (?, ?) OR f.first >= latest_start) '
+			'ORDER BY s."SITE", s."CAPTURE_TIME", s."SL_ID"', provisional_ids)
+		for record in sloop_stats.timed_iter("cache_fetch", records, "rows_fetched"):
+			yield record[0], record[1], record[2]
+		self.conn.rollback()	# the calendar isn't kept
+
+	def Individuals(self):	# generator of (SL_ID, INDIVIDUAL_ID) for every photo-ID sighting, as sloop_db.LiveSource.Individuals
+		records = self.conn.execute('SELECT "SL_ID", "INDIVIDUAL_ID" FROM capture ORDER BY "SL_ID"')
+		for record in sloop_stats.timed_iter("cache_fetch", records, "rows_fetched"):
+			yield record[0], record[1]
+
+	def Close(self):
+		self.conn.close()
+
+
+# pick where sightings come from for a species, given the --refresh/--offline/--cache-dir options
+# with neither switch we go to the live database as always
+def open_source(species, refresh, offline, cache_dir=None, verbose=False):
+	if not (refresh or offline):
+		return sloop_db.LiveSource(species)
+	cache = CacheSource(species, cache_dir, create=refresh)
+	if refresh:
+		db_conn = sloop_db.connect(species)
+		added, changed = cache.Refresh(db_conn)
+		db_conn.close()
+		if verbose:
+			print "cache", cache.path, "refreshed:", added, "new sightings,", changed, "read again where Sloop had changed them"
+	return cache
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+
+# thin client for sloop_daemon.py: runs an export or newbie harvest in the daemon instead of starting from cold
+
+# usage:
+# sloop_client.py [--socket path] [--cache-dir dir] [--stats json|text] [--stats-file file] export sloop_to_mark.py-arguments
+# sloop_client.py [--socket path] [--cache-dir dir] [--stats json|text] [--stats-file file] harvest harvest_newbies.py-arguments
+# sloop_client.py [--socket path] [--cache-dir dir] ping | stop
+# e.g. sloop_client.py export --all-sites otago surveys.xls
+# options:
+# --socket path, --cache-dir dir find the daemon's socket, as for sloop_daemon.py
+# --stats json|text, --stats-file file report the daemon's stats for the request, as the scripts' own options do
+# the script arguments are as for the scripts themselves, less the options that pick a source or cache
+# (--refresh, --offline, --cache-dir: the daemon always reads the live database) and the --stats/--profile options;
+# -j is accepted but the daemon does sites one at a time
+# output files are written in the current directory, as the scripts would, and the script's output and exit status
+# are passed on; ping checks the daemon is there, stop stops it
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import sys	# so we can get at stderr
+import os	# working directory
+import json	# request and reply format
+import socket	# Unix socket the daemon listens on
+import argparse	# command line options
+import sloop_cache	# default cache directory
+import sloop_stats	# --stats report
+
+socket_name = "sloop_daemon.sock"	# as in sloop_daemon.py (not imported from there, it loads everything)
+
+
+def main():
+	parser = argparse.ArgumentParser(usage="sloop_client.py [--socket path] [--cache-dir dir] [--stats json|text] [--stats-file file]\n       export|harvest|ping|stop [script arguments]")
+	parser.add_argument("--socket", default=None)
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--stats", choices=["json", "text"], default=None)
+	parser.add_argument("--stats-file", default=None)
+	parser.add_argument("command", choices=["export", "harvest", "ping", "stop"])
+	parser.add_argument("args", nargs=argparse.REMAINDER)
+	options = parser.parse_args()
+
+	path = options.socket
+	if path is None:
+		path = os.path.join(sloop_cache.cache_directory(options.cache_dir), socket_name)
+	path = os.path.expanduser(path)
+	conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		conn.connect(path)
+	except socket.error, e:
+		print >> sys.stderr, "Error: can't reach sloop_daemon.py on " + path + ":", e
+		sys.exit(1)
+
+	conn.sendall(json.dumps({"command": options.command, "args": options.args, "cwd": os.getcwd()}))
+	conn.shutdown(socket.SHUT_WR)	# that's the whole request
+	data = []
+	while True:
+		chunk = conn.recv(65536)
+		if chunk == "":
+			break
+		data.append(chunk)
+	conn.close()
+	if data == []:
+		print >> sys.stderr, "Error: no reply from sloop_daemon.py"
+		sys.exit(1)
+	reply = json.loads("".join(data))
+
+	sys.stdout.write(reply.get("stdout", "").encode("utf-8"))
+	sys.stderr.write(reply.get("stderr", "").encode("utf-8"))
+	if options.stats is not None and "stats" in reply:
+		sloop_stats.merge(reply["stats"])
+		if options.stats_file is None:
+			sloop_stats.report(sys.stderr, options.stats)
+		else:
+			f = open(options.stats_file, "w")
+			sloop_stats.report(f, options.stats)
+			f.close()
+	sys.exit(reply["status"])
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
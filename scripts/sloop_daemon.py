@@ -0,0 +1,406 @@
+#!/usr/bin/python
+
+# long-running export server: keeps database connections, survey calendars and sightings warm between exports
+# so repeated sloop_to_mark.py and harvest_newbies.py runs (e.g. while checking a new survey) don't pay for them every time
+
+# usage:
+# sloop_daemon.py [--socket path] [--cache-dir dir] [--connections n] [--keep-rows n] [--hash-interval seconds] [-v]
+# options:
+# --socket path is the Unix socket to listen on (default: sloop_daemon.sock in the cache directory)
+# --cache-dir dir is the cache directory used for survey calendars and the photo index (default: ~/.sloop_cache)
+# --connections n is the most database connections held open for each species (default: 2)
+# --keep-rows n is the most sightings rows kept in memory for each species (default: 2000000); the lists of rows
+#   used least recently are dropped to make room, and read again if they're asked for
+# --hash-interval seconds is the most time between checks of every CAPTURE row for edits (default: 300)
+# -v prints each request and how long it took
+
+# requests come from sloop_client.py, which sends the command line it was given; the daemon runs it as the
+# script would, in the client's working directory, and sends back what the script would have printed and its exit status
+# requests are served one at a time, in the order they arrive
+# for each species the daemon keeps a pool of read-only connections, and the lists of sightings it has fetched
+# (up to --keep-rows rows); before each request the CAPTURE table's highest SL_ID and row count are checked, and the
+# sightings all dropped if they've changed, so new or deleted sightings show up in the next export; edits to existing
+# rows (matches done in Sloop, say) are found by a hash of every row, which is much more work for the server, so it's
+# only done if --hash-interval seconds have passed since the last one: edits show up within that time
+# survey calendars are kept for each workbook and re-read when its size or modification time changes
+# the daemon runs until interrupted or sent sloop_client.py stop
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import sys	# so we can get at stderr
+import os	# working directories, socket file
+import time	# request timings
+import json	# request and reply format
+import socket	# Unix socket the clients connect to
+import argparse	# command line options
+import collections	# kept rows, least recently used first
+import cStringIO	# script output is collected to send back to the client
+import traceback	# errors in requests are reported to the client rather than stopping the daemon
+import sloop_db	# pooled read-only connections
+import sloop_cache	# default cache directory
+import sloop_workbook	# survey calendars
+import sloop_photo_index	# photo index for harvests
+import sloop_stats	# stats for each request are sent back to the client
+import sloop_to_mark
+import harvest_newbies
+
+socket_name = "sloop_daemon.sock"	# in the cache directory, unless told otherwise
+max_request = 1 << 20	# longest request we'll read, in bytes
+default_keep_rows = 2000000	# sightings rows kept in memory for each species unless told otherwise
+default_hash_interval = 300	# seconds between hashes of the CAPTURE table unless told otherwise
+
+verbose = False	# global to turn on debug/information output
+
+
+# the socket path, given the --socket and --cache-dir options (sloop_client.py works it out the same way)
+def socket_path(path=None, cache_dir=None):
+	if path is None:
+		path = os.path.join(sloop_cache.cache_directory(cache_dir), socket_name)
+	return os.path.expanduser(path)
+
+
+class SpeciesSource(object):
+	'Sightings for a species from a pool of read-only connections, kept in memory until the CAPTURE table changes'
+
+	def __init__(self, species, connections, keep_rows=default_keep_rows, hash_interval=default_hash_interval):
+		self.species = species
+		self.pool = sloop_db.connect_pool(species, connections)
+		self.counts = None	# CAPTURE table's highest SL_ID and row count when the kept rows were read
+		self.digest = None	# hash of the CAPTURE rows the kept rows were read from, None if not known
+		self.hashed = 0	# when the CAPTURE rows were last hashed
+		self.hash_interval = hash_interval	# seconds between hashes
+		self.kept = collections.OrderedDict()	# (LiveSource method name, its arguments) -> list of the rows it gave, oldest use first
+		self.kept_rows = 0	# rows in all the kept lists
+		self.keep_rows = keep_rows	# most rows to keep
+
+	# drop the kept rows if the CAPTURE table has changed, returns True if it had
+	# rows added or deleted are found every time, edits once the last hash is hash_interval seconds old
+	def Check(self):
+		now = time.time()
+		conn = self.pool.getconn()
+		try:
+			counts = sloop_db.capture_counts(conn)
+			digest = self.digest
+			if counts == self.counts and now - self.hashed >= self.hash_interval:
+				digest = sloop_db.capture_hash(conn)
+				self.hashed = now
+		finally:
+			self.pool.putconn(conn)
+		if counts != self.counts:	# rows added or deleted; the rows read from now on haven't been hashed
+			self.counts = counts
+			self.digest = None
+			self.hashed = now
+		elif digest == self.digest:	# not hashed this time, or hashed the same
+			return False
+		else:
+			unknown = self.digest is None	# first hash since the rows were read: they may have been read before an edit
+			self.digest = digest
+			if unknown and self.kept_rows == 0:
+				return False
+		self.kept.clear()
+		self.kept_rows = 0
+		return True
+
+	def _Rows(self, method, *args):	# rows from a LiveSource method on a pooled connection, from memory when we've asked before
+		key = (method,) + tuple([tuple(arg) if isinstance(arg, list) else arg for arg in args])
+		rows = self.kept.pop(key, None)
+		if rows is None:
+			conn = self.pool.getconn()
+			try:
+				rows = list(getattr(sloop_db.LiveSource(self.species, conn=conn), method)(*args))
+			finally:
+				self.pool.putconn(conn)
+			self.kept_rows += len(rows)
+		else:
+			sloop_stats.count("rows_kept", len(rows))
+		self.kept[key] = rows	# now the most recently used
+		while self.kept_rows > self.keep_rows and len(self.kept) > 1:	# make room, but always keep the one in use
+			dropped = self.kept.popitem(last=False)[1]
+			self.kept_rows -= len(dropped)
+			sloop_stats.count("rows_dropped", len(dropped))
+		return iter(rows)
+
+	# the sources' queries, as LiveSource has them
+	def Sightings(self, site, days, column):
+		return self._Rows("Sightings", site, days, column)
+
+	def DailySizes(self, site, days):
+		return self._Rows("DailySizes", site, days)
+
+	def Newbies(self, calendar):
+		return self._Rows("Newbies", calendar)
+
+	def Close(self):	# the scripts close their source when done with it; ours stays open for the next request
+		pass
+
+	def Shutdown(self):
+		self.pool.closeall()
+
+
+class Daemon(object):
+	'What the daemon keeps between requests'
+
+	def __init__(self, cache_dir, connections, keep_rows=default_keep_rows, hash_interval=default_hash_interval):
+		self.cache_dir = cache_dir
+		self.connections = connections
+		self.keep_rows = keep_rows
+		self.hash_interval = hash_interval
+		self.sources = {}	# species -> SpeciesSource
+		self.books = {}	# absolute workbook path -> SurveyBook
+		self.indexes = {}	# species -> PhotoIndex
+		self.notes = []	# what was (re)loaded for the current request, for -v
+		self.stop = False
+
+	def Source(self, species):	# the species' sightings, checked against the database
+		if species not in self.sources:
+			self.sources[species] = SpeciesSource(species, self.connections, self.keep_rows, self.hash_interval)
+		source = self.sources[species]
+		with sloop_stats.span("check_capture"):
+			if source.Check():
+				self.notes.append(species + " CAPTURE table changed, sightings will be read again")
+		return source
+
+	def Book(self, path):	# survey calendars of a workbook, re-read if the file has changed
+		path = os.path.abspath(path)
+		st = os.stat(path)
+		book = self.books.get(path)
+		if book is None or book.key != (path, st.st_size, st.st_mtime):
+			book = sloop_workbook.SurveyBook(path, self.cache_dir)
+			self.books[path] = book
+			self.notes.append(path + " calendars loaded")
+		return book
+
+	def Index(self, species):	# the species' photo index, brought up to date
+		if species not in self.indexes:
+			self.indexes[species] = sloop_photo_index.open_index(species, self.cache_dir)
+		else:
+			index = self.indexes[species]
+			with sloop_stats.span("photo_index"):
+				index.Update(False)
+				if index.modified:
+					index.Save()
+		return self.indexes[species]
+
+	def Export(self, options):	# sloop_to_mark.py's run(), on what we keep
+		species_list, sites, survey_file = script_args(options, sloop_to_mark.usage_exit)
+		incremental = options.incremental or options.verify_incremental
+		formats = options.formats.split(",")
+		for name in formats:
+			if name not in sloop_to_mark.output_formats:
+				print >> sys.stderr, "Error: unknown output format ", name
+				sloop_to_mark.usage_exit()
+		book = self.Book(survey_file)
+		summary = []
+		failed = False
+		for species in species_list:
+			source = self.Source(species)
+			for site in sites or book.Sites(species):
+				start = time.time()
+				sightings, full = sloop_to_mark.load_site(book, species, site, source, incremental, options.verify_incremental)
+				result = sloop_to_mark.export_site((species, site, sightings, full, incremental, formats))
+				summary.append((species, site, time.time() - start - result[2], result))
+				failed = failed or result[3] == False
+		if sites is None:
+			sloop_to_mark.print_summary(summary)
+		if failed:
+			sys.exit(1)
+
+	def Harvest(self, options):	# harvest_newbies.py's run(), on what we keep
+		species_list, sites, survey_file = script_args(options, harvest_newbies.usage_exit)
+		book = self.Book(survey_file)
+		summary = []
+		for species in species_list:
+			source = self.Source(species)
+			index = None
+			if options.photo_index:
+				index = self.Index(species)
+			site_newbies = None
+			if not options.legacy_newbies:	# every site's newbies in one go
+				site_newbies = harvest_newbies.query_newbies(book, species, sites or book.Sites(species), source)
+			for site in sites or book.Sites(species):
+				start = time.time()
+				animals = None
+				if site_newbies is None:
+					sightings = harvest_newbies.load_site(book, species, site, source)
+					with sloop_stats.span("collect_newbies"):
+						newbie_list = sightings.CollectNewbies()
+					animals = len(sightings.individuals)
+				else:
+					newbie_list = site_newbies[site]
+				known = None
+				if index is not None:
+					known = index.Originals(harvest_newbies.newbie_sightings(newbie_list))
+				result = harvest_newbies.harvest_site((species, site, newbie_list, options.copy_threads, options.no_link, known))
+				if result is None and sites is not None:
+					print >> sys.stderr, "Exiting."
+					sys.exit()
+				summary.append((species, site, animals, time.time() - start - (result or (0, 0, 0))[2], result))
+		if sites is None:
+			harvest_newbies.print_summary(summary)
+
+	def Handle(self, request):	# run one request, returns the reply
+		command = request.get("command")
+		if command == "ping":
+			return {"status": 0, "stdout": "sloop_daemon.py running, pid %d\n" % os.getpid()}
+		if command == "stop":
+			self.stop = True
+			return {"status": 0, "stdout": "sloop_daemon.py stopping\n"}
+		if command not in ("export", "harvest"):
+			return {"status": 1, "stderr": "Error: unknown request " + str(command) + "\n"}
+
+		# run the script as it would have run in the client's directory, catching what it prints and how it exits
+		stdout, stderr = sys.stdout, sys.stderr
+		sys.stdout, sys.stderr = cStringIO.StringIO(), cStringIO.StringIO()
+		sloop_stats.collect()	# just this request's stats go back
+		status = 0
+		cwd = os.getcwd()
+		try:
+			try:
+				os.chdir(request["cwd"])
+				if command == "export":
+					sloop_stats.instrument(lambda: self.Export(parse_script_args(sloop_to_mark, request["args"])))
+				else:
+					sloop_stats.instrument(lambda: self.Harvest(parse_script_args(harvest_newbies, request["args"])))
+			except SystemExit, e:	# the scripts exit on errors; we mustn't
+				if isinstance(e.code, int):
+					status = e.code
+				elif e.code is not None:
+					print >> sys.stderr, e.code
+					status = 1
+			except Exception, e:
+				traceback.print_exc()
+				status = 1
+			reply = {"status": status, "stdout": sys.stdout.getvalue(), "stderr": sys.stderr.getvalue(), "stats": sloop_stats.collect()}
+		finally:
+			sys.stdout, sys.stderr = stdout, stderr
+			sloop_to_mark.verbose = harvest_newbies.verbose = sloop_to_mark.legacy_sizes = False
+			os.chdir(cwd)
+		return reply
+
+	def Shutdown(self):
+		for source in self.sources.values():
+			source.Shutdown()
+
+
+# options for the daemon's copy of a script's run(), from the script's own command line
+# the options that would change how the daemon works (sources, caches, workers, stats) are refused
+def parse_script_args(script, args):
+	parser = argparse.ArgumentParser(prog=script.__name__ + ".py (via sloop_daemon.py)", usage=script.usage)
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--all-sites", action="store_true")
+	parser.add_argument("-j", "--jobs", type=int, default=None)	# accepted, but sites are done one at a time
+	if script is sloop_to_mark:
+		parser.add_argument("--incremental", action="store_true")
+		parser.add_argument("--verify-incremental", action="store_true")
+		parser.add_argument("--formats", default=sloop_to_mark.default_formats)
+		parser.add_argument("--legacy-sizes", action="store_true")
+	else:
+		parser.add_argument("--copy-threads", type=int, default=None)
+		parser.add_argument("--no-link", action="store_true")
+		parser.add_argument("--photo-index", action="store_true")
+		parser.add_argument("--legacy-newbies", action="store_true")
+	parser.add_argument("args", nargs="+")
+	options = parser.parse_args(args)
+	script.verbose = options.verbose
+	if script is sloop_to_mark:
+		sloop_to_mark.legacy_sizes = options.legacy_sizes
+	return options
+
+
+# (species list, site list or None for every site, survey file) from the script arguments
+def script_args(options, usage_exit):
+	if options.all_sites:
+		if len(options.args) != 2: usage_exit()
+		species_list, sites, survey_file = options.args[0].split(","), None, options.args[1]
+	else:
+		if len(options.args) != 3: usage_exit()
+		species_list, sites, survey_file = [options.args[0]], [options.args[1]], options.args[2]
+	for species in species_list:
+		if species not in sloop_db.species_database:
+			print >> sys.stderr, "Error: unknown species ", species
+			usage_exit()
+	return species_list, sites, survey_file
+
+
+# read a whole message (the other end shuts down its side when it's sent it all)
+def receive(conn):
+	data = []
+	size = 0
+	while True:
+		chunk = conn.recv(65536)
+		if chunk == "":
+			break
+		data.append(chunk)
+		size += len(chunk)
+		if size > max_request:
+			raise ValueError("request too long")
+	return json.loads("".join(data))
+
+
+def serve(path, daemon):
+	if os.path.exists(path):	# left behind by a daemon that didn't stop cleanly, or one that's still running
+		probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			probe.connect(path)
+			print >> sys.stderr, "Error: a daemon is already listening on " + path
+			sys.exit(1)
+		except socket.error:
+			os.remove(path)
+		finally:
+			probe.close()
+	elif not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	old_umask = os.umask(077)	# only we can connect
+	listener.bind(path)
+	os.umask(old_umask)
+	listener.listen(5)
+	if verbose:
+		print "listening on", path
+	try:
+		while not daemon.stop:
+			conn, address = listener.accept()
+			try:
+				start = time.time()
+				daemon.notes = []
+				try:
+					request = receive(conn)
+					reply = daemon.Handle(request)
+				except ValueError, e:
+					request = {}
+					reply = {"status": 1, "stderr": "Error: bad request: " + str(e) + "\n"}
+				conn.sendall(json.dumps(reply))
+				if verbose:
+					print "%s %s: status %d, %.2fs" % (request.get("command"), " ".join(request.get("args", [])), reply["status"], time.time() - start)
+					for note in daemon.notes:
+						print "  " + note
+					sys.stdout.flush()
+			except socket.error, e:	# client went away, never mind
+				print >> sys.stderr, "Warning: lost client:", e
+			finally:
+				conn.close()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		listener.close()
+		os.remove(path)
+		daemon.Shutdown()
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage="sloop_daemon.py [--socket path] [--cache-dir dir] [--connections n] [--keep-rows n] [--hash-interval seconds] [-v]")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--socket", default=None)
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--connections", type=int, default=2)
+	parser.add_argument("--keep-rows", type=int, default=default_keep_rows)
+	parser.add_argument("--hash-interval", type=float, default=default_hash_interval)
+	options = parser.parse_args()
+	verbose = options.verbose
+	serve(socket_path(options.socket, options.cache_dir), Daemon(options.cache_dir, options.connections, options.keep_rows, options.hash_interval))
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,177 @@
+# database connection helpers shared by sloop_to_mark.py and harvest_newbies.py
+
+import psycopg2	# postgres interface package
+import psycopg2.pool	# connection pools for the export daemon
+import sys	# so we can get at stderr
+import datetime	# to get date conversion functions
+import sloop_stats	# timing and counting for --stats
+
+# each species has its own Sloop database
+species_database = {"otago": "otagolive", "grand": "grandlive"}
+
+fetch_itersize = 2000	# rows per round trip when streaming sightings back from the database
+
+provisional_ids = ("SINGLETON_SO_FAR", "NEVER_COMPARED")	# ids that can change when matching is done
+
+# numeric size class of each EST_SIZE_CLASS value, unsure sizes are halves and anything else counts as 0 (no size)
+size_classes = [("1", 1.0), ("2", 2.0), ("3", 3.0), ("4", 4.0), ("1-2", 1.5), ("2-3", 2.5), ("3-4", 3.5)]
+size_case = 'CASE "EST_SIZE_CLASS" ' + " ".join(["WHEN '%s' THEN %.1f" % size for size in size_classes]) + ' ELSE 0 END'
+
+# sightings of each animal on each day as one row: the mean of the non-zero sizes (0 if there are none) and how many sightings,
+# from a select of the CAPTURE rows wanted (passed in by the source, postgres or the local cache);
+# provisional ids are never combined, each sighting is a row of its own; rows are in the order each animal was first seen
+def daily_sizes_query(rows, day):
+	return 'SELECT ' + day + ', "INDIVIDUAL_ID", CAST(COALESCE(AVG(NULLIF(' + size_case + ', 0)), 0) AS double precision), COUNT(*) ' \
+		'FROM (' + rows + ') AS sightings ' \
+		'GROUP BY "INDIVIDUAL_ID", ' + day + ', CASE WHEN "INDIVIDUAL_ID" IN (\'' + "', '".join(provisional_ids) + '\') THEN "SL_ID" END ' \
+		'ORDER BY MIN("CAPTURE_TIME"), MIN("SL_ID")'
+
+
+# connect to the database for the species, complain and exit if we can't
+# connections are read-only unless asked otherwise (only sloop_photo_fix.py --execute-sql writes)
+def connect(species, readonly=True):
+	try:	# no password seems to be required
+		with sloop_stats.span("db_connect"):
+			conn=psycopg2.connect(database=species_database[species],user="skuser")
+	except Exception, e:
+		print >> sys.stderr, e.pgerror
+		sys.exit()
+	if readonly:
+		conn.set_session(readonly=True)	# to be safe, prevent us from accidentally damaging the database
+	return conn
+
+
+class ReadOnlyPool(psycopg2.pool.ThreadedConnectionPool):
+	'Pool of connections to a species database, made read-only as they are opened'
+
+	def _connect(self, key=None):
+		conn = psycopg2.pool.ThreadedConnectionPool._connect(self, key)
+		conn.set_session(readonly=True)	# to be safe, prevent us from accidentally damaging the database
+		return conn
+
+
+# a pool of up to maxconn connections to the database for the species (for sloop_daemon.py), complain and exit if we can't
+def connect_pool(species, maxconn=2):
+	try:
+		with sloop_stats.span("db_connect"):
+			return ReadOnlyPool(1, maxconn, database=species_database[species], user="skuser")
+	except Exception, e:
+		print >> sys.stderr, e.pgerror
+		sys.exit()
+
+
+# columns of CAPTURE the scripts read, so a change to any of them in any row changes capture_hash
+signature_columns = ("SL_ID", "INDIVIDUAL_ID", "EST_SIZE_CLASS", "SITE", "EVENT", "CAPTURE_TIME")
+
+# highest SL_ID and row count of CAPTURE: cheap (SL_ID is the key), and changes whenever rows are added or deleted
+def capture_counts(conn):
+	cur = conn.cursor()
+	cur.execute('SELECT MAX("SL_ID"), COUNT(*) FROM "CAPTURE"')
+	counts = list(cur.fetchone())
+	cur.close()
+	conn.rollback()	# complete the transaction
+	return counts
+
+
+# md5 of every row's signature columns (NULLs marked as such), which changes whenever any row is edited as well;
+# it reads and sorts the whole table on the server, so it's only worth doing now and then
+def capture_hash(conn):
+	row = " || E'\\t' || ".join(["COALESCE(CAST(\"%s\" AS text), E'\\\\N')" % column for column in signature_columns])
+	cur = conn.cursor()
+	cur.execute('SELECT md5(string_agg(' + row + ', E\'\\n\' ORDER BY "SL_ID")) FROM "CAPTURE"')
+	digest = cur.fetchone()[0]
+	cur.close()
+	conn.rollback()	# complete the transaction
+	return digest
+
+
+class LiveSource(object):
+	'Photo-ID sightings read straight from the live Sloop database for a species'
+
+	def __init__(self, species, itersize=None, conn=None):
+		if conn is None:	# our own connection, unless given one (e.g. from a pool)
+			conn = connect(species)
+		self.conn = conn
+		if itersize is None:
+			itersize = fetch_itersize
+		self.itersize = itersize	# rows fetched per round trip
+
+	def Sightings(self, site, days, column):	# generator of (date tuple, INDIVIDUAL_ID, column value) for the site
+		# one query covers every survey day for the site, rows are streamed back through a named (server-side) cursor
+		# days is a list of datetime.date; rows come back in time order
+		if days == []:	# nothing to look for (and min/max below would fail)
+			return
+		# note that postgres requires quoting to prevent identifiers being folded to lower case
+		# values are passed as query parameters, never pasted into the SQL string
+		# the half-open range on the raw CAPTURE_TIME column lets postgres use an index on it,
+		# the = ANY() test then restricts the range to the survey days themselves
+		my_query = 'SELECT "INDIVIDUAL_ID", "' + column + '", CAST("CAPTURE_TIME" AS date) FROM "CAPTURE" ' \
+			'WHERE "EVENT"=\'PhotoID\' AND "SITE"=%s AND "CAPTURE_TIME" >= %s AND "CAPTURE_TIME" < %s ' \
+			'AND CAST("CAPTURE_TIME" AS date) = ANY(%s) ORDER BY "CAPTURE_TIME", "SL_ID"'
+		db_cur = self.conn.cursor(name="sightings")	# named cursor: rows stay on the server until we ask for them
+		db_cur.itersize = self.itersize
+		with sloop_stats.span("db_query"):
+			db_cur.execute(my_query, (site, min(days), max(days) + datetime.timedelta(days=1), days))
+		for record in sloop_stats.timed_iter("db_fetch", db_cur, "rows_fetched"):	# time waiting for rows, not what the caller does with them
+			day = record[2]
+			yield (day.year, day.month, day.day), record[0], record[1]
+		db_cur.close()
+		self.conn.rollback()	# do this as soon as practical to complete transaction and release lock
+
+	def DailySizes(self, site, days):	# generator of (date tuple, INDIVIDUAL_ID, mean size, sightings) for the site, see daily_sizes_query
+		if days == []:
+			return
+		my_query = daily_sizes_query('SELECT "SL_ID", "INDIVIDUAL_ID", "EST_SIZE_CLASS", "CAPTURE_TIME" FROM "CAPTURE" ' \
+			'WHERE "EVENT"=\'PhotoID\' AND "SITE"=%s AND "CAPTURE_TIME" >= %s AND "CAPTURE_TIME" < %s ' \
+			'AND CAST("CAPTURE_TIME" AS date) = ANY(%s)', 'CAST("CAPTURE_TIME" AS date)')
+		db_cur = self.conn.cursor(name="daily_sizes")
+		db_cur.itersize = self.itersize
+		with sloop_stats.span("db_query"):
+			db_cur.execute(my_query, (site, min(days), max(days) + datetime.timedelta(days=1), days))
+		for record in sloop_stats.timed_iter("db_fetch", db_cur, "rows_fetched"):
+			day = record[0]
+			yield (day.year, day.month, day.day), record[1], record[2], record[3]
+		db_cur.close()
+		self.conn.rollback()
+
+	def Newbies(self, calendar):	# generator of (SITE, INDIVIDUAL_ID, SL_ID) for the sightings of newbies, by site in time order
+		# calendar is a list of (site, datetime.date, in the site's latest series?) for every survey day of the sites asked about
+		# a newbie is an animal whose first sighting at the site on a survey day (MIN("CAPTURE_TIME") for the animal and
+		# site) is in the site's latest series (so series are taken to be in date order, as they are in the workbook);
+		# provisional ids are never matched, so each of their sightings in the latest series counts as a newbie
+		# only the newbies' sightings come back, all sites in one query
+		if calendar == []:
+			return
+		sites, days, latest = zip(*calendar)
+		my_query = 'WITH calendar AS (SELECT * FROM unnest(%s::text[], %s::date[], %s::boolean[]) AS c(cal_site, cal_day, latest)), ' \
+			'sightings AS (SELECT "SL_ID", "INDIVIDUAL_ID", "SITE", "CAPTURE_TIME", latest FROM "CAPTURE" ' \
+			'JOIN calendar ON cal_site = "SITE" AND cal_day = CAST("CAPTURE_TIME" AS date) ' \
+			'WHERE "EVENT"=\'PhotoID\' AND "CAPTURE_TIME" >= %s AND "CAPTURE_TIME" < %s), ' \
+			'firsts AS (SELECT "INDIVIDUAL_ID", "SITE", MIN("CAPTURE_TIME") AS first FROM sightings GROUP BY "INDIVIDUAL_ID", "SITE"), ' \
+			'starts AS (SELECT cal_site, MIN(cal_day) AS latest_start FROM calendar WHERE latest GROUP BY cal_site) ' \
+			'SELECT s."SITE", s."INDIVIDUAL_ID", s."SL_ID" FROM sightings s ' \
+			'JOIN firsts f ON f."INDIVIDUAL_ID" = s."INDIVIDUAL_ID" AND f."SITE" = s."SITE" JOIN starts ON cal_site = s."SITE" ' \
+			'WHERE s.latest AND (s."INDIVIDUAL_ID" = ANY(%s) OR f.first >= latest_start) ' \
+			'ORDER BY s."SITE", s."CAPTURE_TIME", s."SL_ID"'
+		db_cur = self.conn.cursor(name="newbies")
+		db_cur.itersize = self.itersize
+		with sloop_stats.span("db_query"):
+			db_cur.execute(my_query, (list(sites), list(days), list(latest), min(days), max(days) + datetime.timedelta(days=1),
+				list(provisional_ids)))
+		for record in sloop_stats.timed_iter("db_fetch", db_cur, "rows_fetched"):
+			yield record[0], record[1], record[2]
+		db_cur.close()
+		self.conn.rollback()
+
+	def Individuals(self):	# generator of (SL_ID, INDIVIDUAL_ID) for every photo-ID sighting, in SL_ID order
+		db_cur = self.conn.cursor(name="individuals")
+		db_cur.itersize = self.itersize
+		with sloop_stats.span("db_query"):
+			db_cur.execute('SELECT "SL_ID", "INDIVIDUAL_ID" FROM "CAPTURE" WHERE "EVENT"=\'PhotoID\' ORDER BY "SL_ID"')
+		for record in sloop_stats.timed_iter("db_fetch", db_cur, "rows_fetched"):
+			yield record[0], record[1]
+		db_cur.close()
+		self.conn.rollback()
+
+	def Close(self):
+		self.conn.close()
@@ -0,0 +1,277 @@
+#!/usr/bin/python
+
+# audit the L/R photos in Sloop's image store for swapped sides, mirror images and duplicate uploads
+# so the ones to check with sloop_swap.sh/sloop_switch.sh come from a short ranked list instead of being found by chance
+
+# usage:
+# sloop_photo_audit.py [-v] [-j jobs] [--refresh | --offline] [--cache-dir dir] [--image-dir dir] [--rehash]
+#                      [--min-margin bits] [--duplicate-bits bits] [--limit n] [--out file] species
+# options:
+# -v reports progress
+# -j n sets the number of processes hashing photos (default: one per cpu)
+# --refresh, --offline, --cache-dir pick where sightings come from, as for sloop_to_mark.py
+# --image-dir dir audits the image store in dir rather than the species' Sloop store (e.g. a copy of it)
+# --rehash hashes every photo again rather than using the hash cache
+# --min-margin bits is how much better (in hash bits, out of 64) another side or a flipped image must match
+#              than the photo as labelled before it is listed (default: 8)
+# --duplicate-bits bits is how close two photos' hashes must be to be listed as a duplicate upload (default: 4)
+# --limit n lists only the n most likely candidates
+# --out file writes the candidates to file (default: stdout)
+
+# every original photo (xxxxx_L.jpg, xxxxx_R.jpg) gets a 64 bit difference hash of itself and of its mirror image;
+# hashes are cached in the cache directory by file name, inode, size and modification time, so only new or changed
+# photos (including ones renamed by a swap) are hashed again
+# each photo is then compared with the photos of every other sighting of the same INDIVIDUAL_ID (provisional ids
+# aren't compared), and listed if it matches better as something other than what it is labelled:
+# switch    - it matches the other side of the animal (as sloop_switch.sh fixes)
+# swap      - both photos of the sighting match the other side (as sloop_swap.sh fixes)
+# mirror    - its mirror image matches the side it is labelled as (or, as mirror-switch, the other side)
+# duplicate - it is (nearly) the same picture as a photo of another sighting of the animal
+# candidates are written as .csv, most likely first: confidence (0-1) is the margin in bits over 64 for
+# switch and mirror (over 128 for swap, the margin is for both photos together), and 1 less the distance over 64 for duplicates
+# the .csv, cut down to the confirmed swaps and switches, can be given to sloop_photo_fix.py to fix them all at once
+
+# Note: errors, warnings and verbose output all go to stderr, so stdout only ever has the candidates
+
+import sys	# so we can get at stderr
+import os	# photo paths
+import json	# hash cache format
+import argparse	# command line options
+import multiprocessing	# photos are hashed in a pool of worker processes
+import sloop_db	# species names
+import sloop_cache	# sightings, and the hash cache lives in the cache directory
+import sloop_photo_index	# which photos there are
+import sloop_stats	# timing
+try:
+	from PIL import Image	# image decoding, only needed to hash photos
+except ImportError:
+	Image = None
+
+hash_cache_version = 1	# bumped if the hash or the file layout changes, older files are ignored
+hash_width = 8	# difference hash of an 8x8 grid (from 9x8 pixels): 64 bits
+
+verbose = False	# global to turn on debug/information output
+
+
+# path of the hash cache for a species
+def hash_cache_path(species, cache_dir=None):
+	return os.path.join(sloop_cache.cache_directory(cache_dir), species + "_photo_hashes.json")
+
+
+# difference hash of a grayscale image's pixels, hash_width+1 across by hash_width down, each bit is whether a pixel
+# is brighter than the one to its right; the mirror image's hash comes from the same pixels read right to left
+def difference_hashes(pixels):
+	plain = mirror = 0
+	for row in range(hash_width):
+		line = pixels[row*(hash_width+1):(row+1)*(hash_width+1)]
+		for col in range(hash_width):
+			plain = (plain << 1) | (line[col] > line[col+1])
+			mirror = (mirror << 1) | (line[hash_width-col] > line[hash_width-col-1])
+	return plain, mirror
+
+
+# hash a photo file (in a pool worker): returns (name, hash, mirror image hash), hashes are None if it can't be read
+def hash_photo(job):
+	name, path = job
+	try:
+		image = Image.open(path)
+		image.draft("L", (hash_width * 8, hash_width * 8))	# JPEGs can be decoded at a fraction of full size
+		image = image.convert("L").resize((hash_width + 1, hash_width), Image.ANTIALIAS)
+		plain, mirror = difference_hashes(list(image.getdata()))
+		return name, plain, mirror
+	except (IOError, ValueError):
+		return name, None, None
+
+
+def distance(a, b):	# differing bits between two hashes
+	return bin(a ^ b).count("1")
+
+
+class HashCache(object):
+	'Photo hashes for a species, kept between runs'
+
+	def __init__(self, species, cache_dir=None):
+		self.path = hash_cache_path(species, cache_dir)
+		self.hashes = {}	# file name -> [inode, size, mtime, hash, mirror image hash]
+		if os.path.exists(self.path):
+			f = open(self.path)
+			saved = json.load(f)
+			f.close()
+			if saved.get("version") == hash_cache_version:
+				self.hashes = saved["hashes"]
+
+	def Update(self, index, jobs=None, rehash=False):	# hash every original in the photo index that isn't cached
+		# returns the number of photos hashed and the number that couldn't be read
+		originals = index.files.get("originals", {})
+		stale = [name for name, entry in originals.iteritems()
+			if rehash or name not in self.hashes or self.hashes[name][0:3] != entry]
+		for name in [name for name in self.hashes if name not in originals]:
+			del self.hashes[name]
+		if stale == []:
+			return 0, 0
+		if Image is None:
+			print >> sys.stderr, "Error: the PIL (Pillow) package is needed to hash photos"
+			sys.exit()
+		directory = os.path.join(index.image_dir, "originals")
+		failed = 0
+		pool = multiprocessing.Pool(jobs)
+		with sloop_stats.span("hash_photos"):
+			for n, (name, plain, mirror) in enumerate(pool.imap_unordered(hash_photo,
+					[(name, os.path.join(directory, name)) for name in stale], 32)):
+				if plain is None:
+					print >> sys.stderr, "Warning: can't read photo " + name
+					failed += 1
+					self.hashes.pop(name, None)
+					continue
+				self.hashes[name] = originals[name] + ["%016x" % plain, "%016x" % mirror]
+				if verbose and (n + 1) % 1000 == 0:
+					print >> sys.stderr, n + 1, "of", len(stale), "photos hashed"
+		pool.close()
+		pool.join()
+		sloop_stats.count("photos_hashed", len(stale) - failed)
+		return len(stale) - failed, failed
+
+	def Save(self):	# write the cache file, replacing the old one in one go
+		if not os.path.isdir(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+		tmp_path = self.path + ".tmp"
+		f = open(tmp_path, "w")
+		json.dump({"version": hash_cache_version, "hashes": self.hashes}, f)
+		f.close()
+		os.rename(tmp_path, self.path)
+
+	def Photos(self):	# sloop id -> {side: (hash, mirror image hash)}
+		photos = {}
+		for name, entry in self.hashes.iteritems():
+			match = sloop_photo_index.photo_name.match(name)
+			photos.setdefault(int(match.group(1)), {})[match.group(2)] = (int(entry[3], 16), int(entry[4], 16))
+		return photos
+
+
+other_side = {"L": "R", "R": "L"}
+
+
+# nearest of a list of hashes to a hash: (distance, sloop id) or None if there are none to compare with
+def nearest(target, hashes):
+	best = None
+	for sl_id, candidate in hashes:
+		d = distance(target, candidate)
+		if best is None or d < best[0]:
+			best = (d, sl_id)
+	return best
+
+
+# candidates for one animal's sightings, photos is {sl_id: {side: (hash, mirror image hash)}} for them
+# appends (individual, confidence, kind, sl_id, side, match sl_id, match side, distance, labelled distance) to candidates
+def audit_individual(individual, photos, min_margin, duplicate_bits, candidates):
+	for sl_id, sides in photos.iteritems():
+		others = dict([(side, [(o, hashes[side][0]) for o, hashes in photos.iteritems() if o != sl_id and side in hashes])
+			for side in ("L", "R")])
+		found = {}	# side -> (kind, margin, match sl_id, match side, distance, labelled distance)
+		for side, (plain, mirror) in sides.iteritems():
+			# duplicates: each pair once, whatever sides they are labelled
+			for other in ("L", "R"):
+				for o, candidate in others[other]:
+					d = distance(plain, candidate)
+					if o > sl_id and d <= duplicate_bits:
+						candidates.append((individual, 1.0 - d / 64.0, "duplicate", sl_id, side, o, other, d, None))
+			labelled = nearest(plain, others[side])
+			if labelled is None:
+				continue	# nothing to say it's wrong
+			for kind, target, compare in (("switch", plain, other_side[side]), ("mirror", mirror, side),
+					("mirror-switch", mirror, other_side[side])):
+				match = nearest(target, others[compare])
+				if match is not None and labelled[0] - match[0] >= min_margin and (side not in found or match[0] < found[side][4]):
+					found[side] = (kind, labelled[0] - match[0], match[1], compare, match[0], labelled[0])
+		if len(sides) == 2:	# is the sighting better as a swap (both photos matching the other side)?
+			labelled = [nearest(sides[side][0], others[side]) for side in ("L", "R")]
+			swapped = [nearest(sides[side][0], others[other_side[side]]) for side in ("L", "R")]
+			if None not in labelled and None not in swapped:
+				labelled_total = labelled[0][0] + labelled[1][0]
+				swapped_total = swapped[0][0] + swapped[1][0]
+				if labelled_total - swapped_total >= 2 * min_margin:	# listed instead of anything found for either side alone
+					candidates.append((individual, (labelled_total - swapped_total) / 128.0, "swap", sl_id, "LR",
+						swapped[0][1], "RL", swapped_total, labelled_total))
+					continue
+		for side, (kind, margin, match, compare, d, labelled) in found.iteritems():
+			candidates.append((individual, margin / 64.0, kind, sl_id, side, match, compare, d, labelled))
+
+
+# candidates for every animal with more than one photographed sighting, most likely first
+def audit(individuals, photos, min_margin, duplicate_bits):
+	by_individual = {}
+	for sl_id, individual in individuals:
+		if individual in sloop_cache.provisional_ids or sl_id not in photos:
+			continue
+		by_individual.setdefault(individual, {})[sl_id] = photos[sl_id]
+	candidates = []
+	with sloop_stats.span("compare_photos"):
+		for individual, sightings in by_individual.iteritems():
+			if len(sightings) > 1:
+				audit_individual(individual, sightings, min_margin, duplicate_bits, candidates)
+	candidates.sort(key=lambda c: (-c[1], c[3], c[4]))
+	return candidates
+
+
+def write_candidates(f, candidates):
+	f.write("confidence,kind,sl_id,side,individual,match_sl_id,match_side,distance,labelled_distance\n")
+	for individual, confidence, kind, sl_id, side, match, match_side, d, labelled in candidates:
+		f.write("%.3f,%s,%d,%s,%s,%d,%s,%d,%s\n" % (confidence, kind, sl_id, side, individual, match, match_side, d,
+			"" if labelled is None else labelled))
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage="sloop_photo_audit.py [-v] [-j jobs] [--refresh | --offline] [--cache-dir dir] [--image-dir dir] [--rehash]\n       [--min-margin bits] [--duplicate-bits bits] [--limit n] [--out file] species")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--refresh", action="store_true")
+	parser.add_argument("--offline", action="store_true")
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--image-dir", default=None)
+	parser.add_argument("--rehash", action="store_true")
+	parser.add_argument("--min-margin", type=int, default=8)
+	parser.add_argument("--duplicate-bits", type=int, default=4)
+	parser.add_argument("--limit", type=int, default=None)
+	parser.add_argument("--out", default=None)
+	parser.add_argument("species")
+	options = parser.parse_args()
+	verbose = options.verbose
+	species = options.species
+	if species not in sloop_db.species_database:
+		print >> sys.stderr, "Error: unknown species ", species
+		sys.exit()
+	if options.refresh and options.offline:
+		parser.print_usage(sys.stderr)
+		sys.exit()
+
+	candidates_out = sys.stdout
+	sys.stdout = sys.stderr	# -v output from the photo index and sightings cache too, so only the candidates are on stdout
+
+	index = sloop_photo_index.open_index(species, options.cache_dir, verbose=verbose, image_dir=options.image_dir)
+	cache = HashCache(species, options.cache_dir)
+	hashed, failed = cache.Update(index, options.jobs, options.rehash)
+	cache.Save()
+	if verbose:
+		print >> sys.stderr, hashed, "photos hashed,", failed, "unreadable,", len(cache.hashes), "in", cache.path
+
+	source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+	individuals = list(source.Individuals())
+	source.Close()
+
+	candidates = audit(individuals, cache.Photos(), options.min_margin, options.duplicate_bits)
+	if options.limit is not None:
+		candidates = candidates[:options.limit]
+	if options.out is None:
+		write_candidates(candidates_out, candidates)
+	else:
+		f = open(options.out, "w")
+		write_candidates(f, candidates)
+		f.close()
+	if verbose:
+		print >> sys.stderr, len(candidates), "candidates"
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,419 @@
+#!/usr/bin/python
+
+# fix a batch of swapped or mislabelled L/R photos in Sloop's image store in one go
+# does what sloop_swap.sh and sloop_switch.sh do for one sloop id at a time, for a whole list, with a journal to undo it
+
+# usage:
+# sloop_photo_fix.py [-v] [--dry-run] [--image-dir dir] [--cache-dir dir] [--journal file]
+#                    [--sql-template file] [--sql file] [--execute-sql] species operations_file
+# sloop_photo_fix.py [-v] --rollback journal_file
+# options:
+# -v lists each rename as it is done
+# --dry-run checks the operations and prints the renames and SQL, without doing anything
+# --image-dir dir fixes the image store in dir rather than the species' Sloop store
+# --cache-dir dir is where the photo index is kept (default: ~/.sloop_cache), it is updated after the renames
+# --journal file is where the journal is written (default: sloop_photo_fix_<date>-<time>.journal in the current directory)
+# --sql-template file holds the SQL for each kind of operation (default: sloop_photo_fix.sql beside this script)
+# --sql file writes the SQL for the batch to file, to be run by hand (default: printed to stdout)
+# --execute-sql runs the SQL in the species' database instead, in one transaction that is only committed if every
+#               rename succeeds (and the renames are undone if the commit fails)
+# --sql and --execute-sql are refused if the batch has a kind of operation the template gives no SQL for (the one
+# shipped has none for switch, as Sloop's schema for it isn't known here); without them the SQL printed lists those
+# operations as comments, for fixing the database by hand
+# --rollback journal_file undoes the renames recorded in a journal (the SQL, if it was run, must be undone by hand)
+
+# the operations file has one operation per line, blank lines and # comments are ignored:
+# swap xxxxx      - swap xxxxx_L.jpg and xxxxx_R.jpg in originals/, and their thumbnails in thumbs/ (as sloop_swap.sh)
+# switch xxxxx    - rename the one photo there is for xxxxx to the other side, and its thumbnail (as sloop_switch.sh)
+# switch xxxxx L  - the same, checking that the photo there is now is the L one
+# or it may be a .csv written by sloop_photo_audit.py (edited down to the confirmed candidates): swap and switch lines
+# are taken as they are, mirror-switch lines as switches, other kinds are skipped with a warning
+
+# every operation is checked against the image store before anything is renamed: the photos to be renamed must be
+# there, the names they go to must not, and no sloop id may appear twice; any problem stops the whole batch
+# the journal is written before the first rename and records each rename as it is done (on disk before the next),
+# so if one fails, or the batch is interrupted, the ones already done are undone, and a finished batch (or one whose
+# process died part way) can be undone later with --rollback
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import sys	# so we can get at stderr
+import os	# renames
+import time	# default journal name
+import json	# journal format
+import csv	# sloop_photo_audit.py output
+import argparse	# command line options
+import sloop_db	# database updates
+import sloop_photo_index	# image store locations, and the index updated after renames
+
+default_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sloop_photo_fix.sql")
+temporary_suffix = ".fix-tmp"	# photos being swapped are parked under this suffix (not a photo name, so never indexed)
+
+verbose = False	# global to turn on debug/information output
+
+
+def photo_file(kind, sl_id, side):	# path of a photo in the image store, relative to the store
+	if kind == "thumbs":
+		return os.path.join(kind, "%d_%s-thumb.jpg" % (sl_id, side))
+	return os.path.join(kind, "%d_%s.jpg" % (sl_id, side))
+
+
+# the operations in a file: [(line number, operation, sl_id, side or None)]
+def read_operations(path):
+	operations = []
+	f = open(path)
+	first = f.readline()
+	f.seek(0)
+	if first.startswith("confidence,kind,"):	# sloop_photo_audit.py output
+		for n, row in enumerate(csv.DictReader(f)):
+			kind = {"mirror-switch": "switch"}.get(row["kind"], row["kind"])
+			if kind not in ("swap", "switch"):
+				print >> sys.stderr, "Warning: line %d: %s %s can't be fixed by renaming, skipped" % (n + 2, row["kind"], row["sl_id"])
+				continue
+			side = None
+			if kind == "switch":
+				side = row["side"]
+			operations.append((n + 2, kind, int(row["sl_id"]), side))
+		f.close()
+		return operations
+	for n, line in enumerate(f):
+		words = line.split("#")[0].split()
+		if words == []:
+			continue
+		if words[0] not in ("swap", "switch") or len(words) > 2 + (words[0] == "switch") or len(words) < 2 \
+				or not words[1].isdigit() or (len(words) == 3 and words[2] not in ("L", "R")):
+			print >> sys.stderr, "Error: line %d: can't understand: %s" % (n + 1, line.strip())
+			sys.exit(1)
+		side = None
+		if len(words) == 3:
+			side = words[2]
+		operations.append((n + 1, words[0], int(words[1]), side))
+	f.close()
+	return operations
+
+
+# check the operations against the image store and work out the renames
+# returns ([(from, to)] relative to the store, [(operation, sl_id, source side, destination side)] for the SQL),
+# prints every problem found and exits if there are any
+def plan(image_dir, operations):
+	renames = []
+	changes = []
+	problems = []
+	seen = {}
+	exists = lambda name: os.path.exists(os.path.join(image_dir, name))
+	for line, operation, sl_id, side in operations:
+		where = "line %d: %s %d: " % (line, operation, sl_id)
+		if sl_id in seen:
+			problems.append(where + "already on line %d" % seen[sl_id])
+			continue
+		seen[sl_id] = line
+		if operation == "swap":
+			steps = []
+			for kind in sloop_photo_index.image_kinds:
+				left, right = photo_file(kind, sl_id, "L"), photo_file(kind, sl_id, "R")
+				if not exists(left) and not exists(right) and kind == "thumbs":
+					continue	# no thumbnails to swap
+				missing = [name for name in (left, right) if not exists(name)]
+				if missing != []:
+					problems.append(where + "no " + " or ".join(missing))
+					continue
+				if exists(left + temporary_suffix):
+					problems.append(where + left + temporary_suffix + " is in the way")
+					continue
+				steps += [(left, left + temporary_suffix), (right, left), (left + temporary_suffix, right)]
+			renames += steps
+			changes.append((operation, sl_id, "L", "R"))
+		else:
+			present = [s for s in ("L", "R") if exists(photo_file("originals", sl_id, s))]
+			if len(present) != 1:
+				problems.append(where + {0: "no photo", 2: "both sides exist"}[len(present)])
+				continue
+			source = present[0]
+			if side is not None and side != source:
+				problems.append(where + "the photo there is the " + source + " one, not " + side)
+				continue
+			dest = {"L": "R", "R": "L"}[source]
+			for kind in sloop_photo_index.image_kinds:
+				if exists(photo_file(kind, sl_id, dest)):
+					problems.append(where + photo_file(kind, sl_id, dest) + " is in the way")
+				elif exists(photo_file(kind, sl_id, source)):
+					renames.append((photo_file(kind, sl_id, source), photo_file(kind, sl_id, dest)))
+			changes.append((operation, sl_id, source, dest))
+	if problems != []:
+		for problem in problems:
+			print >> sys.stderr, "Error: " + problem
+		print >> sys.stderr, "Nothing done."
+		sys.exit(1)
+	return renames, changes
+
+
+# SQL statements for each kind of operation from a template file: blocks headed by a line "-- swap" or "-- switch",
+# statements in a block end with ";" and may use %(sl_id)s, %(source)s and %(dest)s; a line "-- none" in a block says
+# that kind needs no SQL; other comment lines are ignored
+# returns kind of operation -> list of statements, None for a kind the template doesn't say anything about
+def read_template(path):
+	template = {"swap": None, "switch": None}
+	block = None
+	statement = ""
+	f = open(path)
+	for line in f:
+		stripped = line.strip()
+		if stripped.startswith("--"):
+			heading = stripped[2:].strip()
+			if heading in template:
+				block = heading
+			elif heading == "none" and block is not None and template[block] is None:
+				template[block] = []
+			continue
+		if stripped == "" or block is None:
+			continue
+		statement += line
+		if stripped.endswith(";"):
+			if template[block] is None:
+				template[block] = []
+			template[block].append(statement.strip())
+			statement = ""
+	f.close()
+	return template
+
+
+def sql_values(change):	# the values a template statement is filled in with
+	operation, sl_id, source, dest = change
+	return {"sl_id": sl_id, "source": source, "dest": dest}
+
+
+# the SQL for the batch as text, to be run by hand
+def write_sql(f, template, changes):
+	f.write("BEGIN;\n")
+	for change in changes:
+		operation, sl_id, source, dest = change
+		f.write("-- %s %d: %s -> %s\n" % (operation, sl_id, source, dest))
+		values = sql_values(change)
+		quoted = dict([(name, str(value) if isinstance(value, int) else "'" + value + "'") for name, value in values.items()])
+		if template[operation] is None:
+			f.write("-- (no SQL for %s in the template, fix the database by hand)\n" % operation)
+			continue
+		for statement in template[operation]:
+			f.write(statement % quoted + "\n")
+	f.write("COMMIT;\n")
+
+
+# the kinds of operation in the batch that the template gives no SQL for
+def missing_sql(template, changes):
+	return sorted(set([change[0] for change in changes if template[change[0]] is None]))
+
+
+class Journal(object):
+	'Renames in a batch, written down before they are done and as each one is done, so they can be undone'
+
+	def __init__(self, path):
+		self.path = path
+		self.f = None
+		self.image_dir = None
+		self.renames = []
+		self.done = 0	# renames done, in order
+		self.rolled_back = False
+
+	def Begin(self, image_dir, renames, changes):	# record the batch before anything is renamed
+		self.image_dir = image_dir
+		self.renames = renames
+		self.f = open(self.path, "w")
+		self.f.write(json.dumps({"image_dir": image_dir, "renames": renames, "changes": changes}) + "\n")
+		self._sync()
+
+	# do the renames, returns True if they all worked; if one fails, the ones done are undone
+	# so are they if we're stopped part way (Ctrl-C, say), before the interruption is passed on
+	def Apply(self):
+		try:
+			for old, new in self.renames:
+				source, dest = os.path.join(self.image_dir, old), os.path.join(self.image_dir, new)
+				if os.path.exists(dest):	# something has turned up since we checked
+					raise OSError("%s is in the way" % dest)
+				os.rename(source, dest)
+				self.done += 1
+				self.f.write("done %d\n" % self.done)
+				self._sync()	# so --rollback knows about this one if we die before the next
+				if verbose:
+					print old, "->", new
+			return True
+		except BaseException, e:
+			if isinstance(e, OSError):
+				print >> sys.stderr, "Error: rename failed:", e
+				self.Rollback()
+				return False
+			print >> sys.stderr, "Error: stopped part way through the renames, undoing them"
+			self.Rollback()
+			raise
+
+	def Load(self):	# read a journal back for --rollback
+		f = open(self.path)
+		header = json.loads(f.readline())
+		self.image_dir = header["image_dir"]
+		self.renames = [tuple(rename) for rename in header["renames"]]
+		for line in f:
+			if line.startswith("done "):
+				self.done = int(line.split()[1])
+			elif line.strip() == "rolled back":
+				self.rolled_back = True
+			elif line.startswith("undone "):
+				self.done = int(line.split()[1])
+		f.close()
+		self.f = open(self.path, "a")
+		return header
+
+	def Rollback(self):	# undo the renames done, last first; returns True if they were all undone
+		if self.rolled_back:
+			print >> sys.stderr, "Error: " + self.path + " has already been rolled back"
+			return False
+		while self.done > 0:
+			old, new = self.renames[self.done - 1]
+			try:
+				os.rename(os.path.join(self.image_dir, new), os.path.join(self.image_dir, old))
+			except OSError, e:
+				print >> sys.stderr, "Error: couldn't undo %s -> %s: %s" % (old, new, e)
+				print >> sys.stderr, "Fix that by hand, then run sloop_photo_fix.py --rollback " + self.path + " again"
+				self._sync()
+				return False
+			self.done -= 1
+			self.f.write("undone %d\n" % self.done)
+			self._sync()
+			if verbose:
+				print new, "->", old
+		self.f.write("rolled back\n")
+		self.rolled_back = True
+		self._sync()
+		return True
+
+	def _sync(self):	# make sure the journal is on disk before we go on
+		self.f.flush()
+		os.fsync(self.f.fileno())
+
+	def Close(self):
+		self.f.close()
+
+
+# bring the species' photo index up to date after renaming, if there is one for this store
+def update_index(species, cache_dir, image_dir):
+	index = sloop_photo_index.PhotoIndex(species, cache_dir, image_dir)
+	if index.files == {}:	# no index of this store yet, so nothing to keep up to date
+		return
+	added, removed, changed = index.Update()
+	if index.modified:
+		index.Save()
+	if verbose:
+		print "photo index", index.path, "updated:", added, "added,", removed, "removed,", changed, "changed"
+
+
+def rollback(path):
+	if not os.path.exists(path):
+		print >> sys.stderr, "Error: no journal " + path
+		sys.exit(1)
+	journal = Journal(path)
+	journal.Load()
+	ok = journal.Rollback()
+	journal.Close()
+	if not ok:
+		sys.exit(1)
+	print "rolled back", path
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage="sloop_photo_fix.py [-v] [--dry-run] [--image-dir dir] [--cache-dir dir] [--journal file]\n       [--sql-template file] [--sql file] [--execute-sql] species operations_file\n       sloop_photo_fix.py [-v] --rollback journal_file")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--dry-run", action="store_true")
+	parser.add_argument("--image-dir", default=None)
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--journal", default=None)
+	parser.add_argument("--sql-template", default=default_template)
+	parser.add_argument("--sql", default=None)
+	parser.add_argument("--execute-sql", action="store_true")
+	parser.add_argument("--rollback", default=None)
+	parser.add_argument("args", nargs="*")
+	options = parser.parse_args()
+	verbose = options.verbose
+
+	if options.rollback is not None:
+		if options.args != []:
+			parser.print_usage(sys.stderr)
+			sys.exit(1)
+		rollback(options.rollback)
+		return
+
+	if len(options.args) != 2 or (options.sql is not None and options.execute_sql):
+		parser.print_usage(sys.stderr)
+		sys.exit(1)
+	species, operations_file = options.args
+	if species not in sloop_db.species_database:
+		print >> sys.stderr, "Error: unknown species ", species
+		sys.exit(1)
+	image_dir = options.image_dir
+	if image_dir is None:
+		image_dir = sloop_photo_index.species_image_dir[species]
+
+	renames, changes = plan(image_dir, read_operations(operations_file))
+	template = read_template(options.sql_template)
+	missing = missing_sql(template, changes)
+	if missing != [] and (options.execute_sql or options.sql is not None):
+		print >> sys.stderr, "Error: " + options.sql_template + " has no SQL for " + " or ".join(missing) + \
+			"; give it (or a line -- none if the database needs nothing) in a --sql-template, or leave out " + \
+			("--execute-sql" if options.execute_sql else "--sql") + " and fix the database by hand"
+		sys.exit(1)
+	if verbose or options.dry_run:
+		print len(changes), "operations,", len(renames), "renames"
+	if options.dry_run:
+		for old, new in renames:
+			print old, "->", new
+		write_sql(sys.stdout, template, changes)
+		return
+
+	conn = None
+	if options.execute_sql:	# run the SQL first, but don't commit it until the renames are done
+		conn = sloop_db.connect(species, readonly=False)
+		cur = conn.cursor()
+		try:
+			for change in changes:
+				for statement in template[change[0]]:
+					cur.execute(statement, sql_values(change))
+		except Exception, e:
+			print >> sys.stderr, "Error: SQL failed, nothing done:", e
+			conn.rollback()
+			sys.exit(1)
+
+	journal_path = options.journal
+	if journal_path is None:
+		journal_path = time.strftime("sloop_photo_fix_%Y%m%d-%H%M%S.journal")
+	journal = Journal(journal_path)
+	journal.Begin(os.path.abspath(image_dir), renames, changes)	# so --rollback works from anywhere
+	if not journal.Apply():
+		if conn is not None:
+			conn.rollback()
+		journal.Close()
+		print >> sys.stderr, "Nothing done."
+		sys.exit(1)
+	if conn is not None:
+		try:
+			conn.commit()
+		except Exception, e:
+			print >> sys.stderr, "Error: SQL commit failed, undoing renames:", e
+			journal.Rollback()
+			journal.Close()
+			sys.exit(1)
+		conn.close()
+	journal.Close()
+	update_index(species, options.cache_dir, image_dir)
+	print len(changes), "operations done,", len(renames), "photos renamed, journal in", journal_path
+
+	if conn is None:	# the database is left to be fixed by hand
+		if options.sql is None:
+			write_sql(sys.stdout, template, changes)
+		else:
+			f = open(options.sql, "w")
+			write_sql(f, template, changes)
+			f.close()
+			print "SQL for the database in", options.sql
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,17 @@
+-- SQL for each kind of operation done by sloop_photo_fix.py, run (or written out) once per operation
+-- %(sl_id)s is the sloop id, %(source)s and %(dest)s are the sides ('L' or 'R') a photo goes from and to
+-- (for a swap, source is 'L' and dest is 'R')
+-- statements under each heading end with ";", a line "-- none" under a heading says that kind needs no SQL,
+-- other lines starting -- are ignored
+--
+-- a swap only exchanges the two photo files, so the database needs nothing
+-- a switch moves a sighting's only photo to the other side, and the database must say which side it is:
+-- put the statement(s) that record that in your Sloop database under "-- switch", e.g. if the side were kept
+-- in a CAPTURE column: UPDATE "CAPTURE" SET "PHOTO_SIDE" = %(dest)s WHERE "SL_ID" = %(sl_id)s;
+-- (sloop_switch.sh just says "Now fix the database"; until this file says how, --sql and --execute-sql are refused
+-- for batches with switches, and the SQL printed lists the switches done as comments, for fixing by hand)
+
+-- swap
+-- none
+
+-- switch
@@ -0,0 +1,188 @@
+#!/usr/bin/python
+
+# index of the photos in Sloop's image store (db/images/originals and db/images/thumbs)
+# so tools can ask which photos exist for a list of sloop ids without probing the (slow, mounted) store file by file
+
+# the index is a small JSON file per species, kept alongside the sightings cache; an image store other than the
+# species' own (--image-dir in sloop_photo_audit.py and sloop_photo_fix.py, e.g. a copy of it) gets an index file of
+# its own, named by a hash of its path, so it never replaces the species' main index
+# it records every xxxxx_L.jpg/xxxxx_R.jpg (and xxxxx_L-thumb.jpg/xxxxx_R-thumb.jpg) with its inode, size and modification time
+# updating is incremental: a directory whose modification time hasn't changed isn't read again, and when one has changed
+# only files with a new name or inode are stat'ed (renames, as done by sloop_swap.sh/sloop_switch.sh, change the inode a name refers to)
+# a photo overwritten in place keeps its name and inode, so use --rebuild if photos have been edited in the store
+# inodes come free with the directory listing from scandir (python 3.5 on, or the scandir backport package on python 2);
+# without it every photo in a changed directory is stat'ed again (still correct, but slow on the mounted store),
+# since telling a renamed file from the one that had its name before takes the inode
+
+# usage:
+# sloop_photo_index.py [-v] [--rebuild] [--cache-dir dir] species [sl_id ...]
+# updates the index for the species, then lists the photos the index has for any sloop ids given
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import os	# directory scanning
+import sys	# so we can get at the command line
+import re	# photo file names
+import json	# index file format
+import hashlib	# index file names for other image stores
+import argparse	# command line options
+import sloop_cache	# the index lives in the sightings cache directory
+import sloop_stats	# timing for --stats
+try:
+	from os import scandir	# python 3.5 on
+except ImportError:
+	try:
+		from scandir import scandir	# backport package, if installed
+	except ImportError:
+		scandir = None	# fall back to listdir plus a stat of every file in a changed directory
+
+# where Sloop keeps its images for each species
+species_image_dir = {
+	"otago": "/media/GAOS_DB/OtagoSkinkSloopData/db/images/",
+	"grand": "/media/GAOS_DB/GrandSkinkSloopData/db/images/",
+}
+
+image_kinds = ("originals", "thumbs")	# subdirectories of the image store that are indexed
+
+photo_name = re.compile(r"^(\d+)_([LR])(-thumb)?\.jpg$")	# sloop id, side, and thumbnail suffix
+
+index_version = 1	# bumped if the file layout changes, older files are rebuilt
+
+
+# path of the index file for a species' image store, or for another image store in image_dir
+def index_path(species, cache_dir=None, image_dir=None):
+	name = species + "_photos.json"
+	if image_dir is not None and not same_dir(image_dir, species_image_dir[species]):
+		name = species + "_photos_" + hashlib.sha1(os.path.abspath(image_dir)).hexdigest()[0:12] + ".json"
+	return os.path.join(sloop_cache.cache_directory(cache_dir), name)
+
+
+def same_dir(a, b):	# are two directory names the same directory (give or take a trailing / or relative path)?
+	return os.path.abspath(a) == os.path.abspath(b)
+
+
+# photo file names in a directory with their inodes, [(name, inode)]; inode is None if we'd have to stat to find it
+def list_photos(directory):
+	if scandir is not None:
+		return [(entry.name, entry.inode()) for entry in scandir(directory) if photo_name.match(entry.name)]
+	return [(name, None) for name in os.listdir(directory) if photo_name.match(name)]
+
+
+class PhotoIndex(object):
+	'Photos in the Sloop image store for a species, by sloop id'
+
+	def __init__(self, species, cache_dir=None, image_dir=None):
+		self.species = species
+		self.path = index_path(species, cache_dir, image_dir)
+		if image_dir is None:
+			image_dir = species_image_dir[species]
+		self.image_dir = image_dir
+		self.dirs = {}		# kind -> modification time of the directory when it was last read
+		self.files = {}		# kind -> file name -> [inode, size, mtime]
+		self.by_id = None	# sloop id -> {side: (size, mtime)}, built when first asked for
+		self.modified = False	# does the index file need saving?
+		if os.path.exists(self.path):
+			f = open(self.path)
+			saved = json.load(f)
+			f.close()
+			if saved.get("version") == index_version and same_dir(saved.get("image_dir", ""), image_dir):
+				self.dirs = saved["dirs"]
+				self.files = saved["files"]
+
+	def Update(self, rebuild=False):	# bring the index up to date with the image store
+		# returns the number of files added, removed and changed
+		added = removed = changed = 0
+		for kind in image_kinds:
+			directory = os.path.join(self.image_dir, kind)
+			try:
+				dir_mtime = os.stat(directory).st_mtime
+			except OSError:
+				print >> sys.stderr, "Warning: no photo directory " + directory
+				continue
+			old = self.files.get(kind, {})
+			if not rebuild and self.dirs.get(kind) == dir_mtime:
+				continue	# nothing added, removed or renamed since we last looked
+			new = {}
+			for name, inode in list_photos(directory):
+				entry = old.get(name)
+				if not rebuild and entry is not None and inode is not None and entry[0] == inode:
+					new[name] = entry	# same file as before
+					continue
+				try:
+					st = os.stat(os.path.join(directory, name))
+				except OSError:
+					continue	# gone while we were looking
+				new[name] = [st.st_ino, st.st_size, int(st.st_mtime)]
+				if entry is None:
+					added += 1
+				elif entry != new[name]:
+					changed += 1
+			removed += len([name for name in old if name not in new])
+			self.files[kind] = new
+			self.dirs[kind] = dir_mtime
+			self.modified = True
+		self.by_id = None
+		return added, removed, changed
+
+	def Save(self):	# write the index file, replacing the old one in one go
+		if not os.path.isdir(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+		tmp_path = self.path + ".tmp"
+		f = open(tmp_path, "w")
+		json.dump({"version": index_version, "image_dir": self.image_dir, "dirs": self.dirs, "files": self.files}, f)
+		f.close()
+		os.rename(tmp_path, self.path)
+
+	def _build_by_id(self):
+		self.by_id = {}
+		for kind in image_kinds:
+			for name, entry in self.files.get(kind, {}).iteritems():
+				match = photo_name.match(name)
+				side = match.group(2) + (match.group(3) or "")	# L, R, L-thumb or R-thumb
+				self.by_id.setdefault(int(match.group(1)), {})[side] = (entry[1], entry[2])
+
+	def Photos(self, sl_id):	# {side: (size, mtime)} of the photos there are for a sloop id
+		if self.by_id is None:
+			self._build_by_id()
+		return self.by_id.get(int(sl_id), {})
+
+	def Originals(self, sl_ids):	# {file name: (size, mtime)} of the original photos there are for a list of sloop ids
+		found = {}
+		for sl_id in sl_ids:
+			for side, stat in self.Photos(sl_id).iteritems():
+				if side in ("L", "R"):
+					found[str(sl_id) + "_" + side + ".jpg"] = stat
+		return found
+
+
+# open a species' photo index and bring it up to date
+def open_index(species, cache_dir=None, rebuild=False, verbose=False, image_dir=None):
+	with sloop_stats.span("photo_index"):
+		index = PhotoIndex(species, cache_dir, image_dir)
+		added, removed, changed = index.Update(rebuild)
+		if index.modified:
+			index.Save()
+	if verbose:
+		print "photo index", index.path, "updated:", added, "added,", removed, "removed,", changed, "changed"
+	return index
+
+
+def main():
+	parser = argparse.ArgumentParser(usage="sloop_photo_index.py [-v] [--rebuild] [--cache-dir dir] species [sl_id ...]")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--rebuild", action="store_true")
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("species")
+	parser.add_argument("sl_ids", nargs="*", type=int)
+	options = parser.parse_args()
+	if options.species not in species_image_dir:
+		print >> sys.stderr, "Error: unknown species ", options.species
+		sys.exit()
+	index = open_index(options.species, options.cache_dir, options.rebuild, options.verbose)
+	for sl_id in options.sl_ids:
+		print sl_id, " ".join(sorted(index.Photos(sl_id)))
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,130 @@
+# photo copying for harvest_newbies.py
+
+# Sloop's photo store is on slow mounted storage, so photos are copied by a pool of threads
+# fed through a bounded queue: the caller queues photos as it finds them, the threads do the waiting on the disk
+# when the store and the destination are on the same filesystem photos are hard linked instead of copied
+# a photo already in the destination with the same size and modification time is left alone,
+# so an interrupted or repeated harvest only fetches what it's missing
+
+import os	# file and directory utilities
+import sys	# so we can get at stderr
+import shutil	# file copy utilities
+import time	# for throughput figures
+import threading	# copying threads
+import Queue	# bounded queue feeding the threads
+
+copy_threads = 8	# threads copying photos unless told otherwise
+queue_depth = 64	# photos queued ahead of the copying threads
+
+# what happened to each photo, as it appears in the manifest
+LINKED = "linked"	# hard linked into the destination
+COPIED = "copied"	# copied into the destination
+PRESENT = "present"	# already in the destination with matching size and time
+MISSING = "missing"	# not in the photo store
+FAILED = "failed"	# in the store, but couldn't be put in the destination
+
+
+# are two directories on the same filesystem (so we can hard link between them)?
+def same_filesystem(src, dest):
+	try:
+		return os.stat(src).st_dev == os.stat(dest).st_dev
+	except OSError:
+		return False
+
+
+class PhotoCopier(object):
+	'Copies photos from the photo store to a destination directory using a pool of threads'
+
+	def __init__(self, src, dest, threads=None, link=None):
+		self.src = src		# directory photos come from
+		self.dest = dest	# directory photos go to
+		if threads is None:
+			threads = copy_threads
+		if link is None:	# hard link if we can, unless told not to
+			link = same_filesystem(src, dest)
+		self.link = link
+		self.results = []	# [photo, status, bytes, known source stat] for each photo, in the order they were queued
+		self.queue = Queue.Queue(queue_depth)
+		self.start = time.time()
+		self.elapsed = None	# set by Finish
+		self.threads = [threading.Thread(target=self._worker) for i in range(max(1, threads))]
+		for t in self.threads:
+			t.daemon = True	# don't hold up exit if the caller dies
+			t.start()
+
+	def Put(self, photo, src_stat=None):	# queue a photo (file name in the store) for copying, blocks while the queue is full
+		# src_stat is (size, mtime) of the photo in the store if already known (e.g. from the photo index)
+		result = [photo, None, 0, src_stat]
+		self.results.append(result)
+		self.queue.put(result)
+
+	def Missing(self, photo):	# note a photo we already know isn't in the store
+		self.results.append([photo, MISSING, 0, None])
+
+	def Finish(self):	# wait for the queued photos to be done, returns the results
+		for t in self.threads:
+			self.queue.put(None)	# one stop marker for each thread
+		for t in self.threads:
+			t.join()
+		self.elapsed = time.time() - self.start
+		return self.results
+
+	def _worker(self):
+		while True:
+			result = self.queue.get()
+			if result is None:
+				return
+			result[1], result[2] = self._copy(result[0], result[3])
+
+	def _copy(self, photo, src_stat):	# put one photo in the destination, returns status and bytes
+		src_path = os.path.join(self.src, photo)
+		dest_path = os.path.join(self.dest, photo)
+		if src_stat is None:
+			try:
+				st = os.stat(src_path)
+			except OSError:
+				return MISSING, 0
+			src_stat = (st.st_size, int(st.st_mtime))
+		try:
+			dest_stat = os.stat(dest_path)
+			if dest_stat.st_size == src_stat[0] and int(dest_stat.st_mtime) == src_stat[1]:
+				return PRESENT, 0
+			os.remove(dest_path)	# out of date, replace it
+		except OSError:
+			pass	# not there yet
+		if self.link:
+			try:
+				os.link(src_path, dest_path)
+				return LINKED, src_stat[0]
+			except OSError:
+				pass	# can't link after all (e.g. permissions), fall back to copying
+		try:
+			shutil.copy2(src_path, dest_path)	# copy2 keeps the modification time, for the check above next time
+		except (IOError, OSError), e:
+			print >> sys.stderr, "Warning: failed to copy " + src_path + ": " + str(e)
+			return FAILED, 0
+		return COPIED, src_stat[0]
+
+	def Stats(self):	# counts of each status, bytes moved and seconds taken
+		counts = {}
+		moved = 0
+		for photo, status, size, src_stat in self.results:
+			counts[status] = counts.get(status, 0) + 1
+			moved += size
+		return counts, moved, self.elapsed
+
+	def WriteManifest(self, f):	# one line per photo: file name, what happened to it, bytes moved
+		f.write("photo,status,bytes\r\n")
+		for photo, status, size, src_stat in self.results:
+			f.write("%s,%s,%d\r\n" % (photo, status, size))
+
+
+# a line describing a copier's results, for the summary or verbose output
+def describe_stats(stats):
+	counts, moved, elapsed = stats
+	rate = 0.0
+	if elapsed > 0:
+		rate = moved / elapsed / 1e6
+	return "%d linked, %d copied, %d present, %d missing, %d failed; %.1f MB in %.2f s (%.1f MB/s)" % (
+		counts.get(LINKED, 0), counts.get(COPIED, 0), counts.get(PRESENT, 0), counts.get(MISSING, 0),
+		counts.get(FAILED, 0), moved / 1e6, elapsed, rate)
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+# contact sheets for reviewing newbies: rather than copying every full size photo of every newbie sighting
+# (see harvest_newbies.py), each newbie gets one small sheet of all its photos, and only the photos picked from
+# the sheets are copied in full
+
+# usage:
+# sloop_review.py [-v] [-j jobs] [--image-dir dir] [--size px] [--sloop-thumbs] species site_species [site_species ...]
+# sloop_review.py --fetch [-v] [--image-dir dir] [--copy-threads n] [--no-link] species site_species [site_species ...]
+# e.g. sloop_review.py otago Airport_otago Mac_otago, then sloop_review.py --fetch otago Airport_otago Mac_otago
+# options:
+# -v reports progress
+# -j n sets the number of processes making sheets (default: one per cpu)
+# --image-dir dir reads photos from the image store in dir rather than the species' Sloop store (e.g. a copy of it)
+# --size px is the size of the box each photo is shrunk to fit on the sheets (default: 240)
+# --sloop-thumbs uses Sloop's own thumbnails (xxxxx_L-thumb.jpg) where there are any, which are much less to read
+#                over the mount than the originals, but only as sharp as Sloop made them
+# --fetch copies the photos listed in each site_species_selected.txt into the site_species directory, as
+#         harvest_newbies.py does, with the site_species_photos.csv manifest; --copy-threads and --no-link are as for it
+
+# the sheets are made from site_species_newbies.csv, as written by harvest_newbies.py (harvest_newbies.py --review
+# writes that and then the sheets, without copying any photos), and go in the site_species_review directory:
+# one .jpg per newbie, a row per sighting with its left and right photos each labelled with sloop id and side,
+# and index.html showing them all; tick the photos to keep (or click them on the sheets) and save the list it makes
+# as site_species_selected.txt in the directory the harvest was run in, then run --fetch
+# site_species_selected.txt is a photo file name (e.g. 12345_L.jpg) per line; blank lines and lines starting # are ignored
+# photos are decoded at reduced size (JPEG draft mode) by a pool of worker processes, a sheet at a time
+
+# Note: errors and warnings go to stderr, verbose output goes to stdout
+
+import sys	# so we can get at stderr
+import os	# file paths
+import cgi	# escaping for index.html
+import cStringIO	# index.html and the manifest are assembled in memory
+import argparse	# command line options
+import multiprocessing	# sheets are made in a pool of worker processes
+import sloop_db	# species names
+import sloop_photo_index	# where the photos are
+import sloop_photos	# copying the selected photos
+import sloop_build	# atomic writes
+import sloop_stats	# timing
+try:
+	from PIL import Image, ImageDraw	# image decoding, only needed to make sheets
+except ImportError:
+	Image = None
+
+default_size = 240	# box each photo is shrunk into, in pixels
+label_height = 16	# room under each photo for its label
+title_height = 24	# room at the top of a sheet for the newbie's id
+margin = 8		# space around and between photos
+sides = ("L", "R")
+
+verbose = False	# global to turn on debug/information output
+
+
+def review_directory(site_species):	# where a site's sheets go
+	return site_species + "_review"
+
+
+def cell_box(row, column, size):	# (left, top, right, bottom) of a photo on a sheet
+	left = margin + column * (size + margin)
+	top = title_height + margin + row * (size + label_height + margin)
+	return left, top, left + size, top + size
+
+
+# make one newbie's sheet (in a pool worker)
+# job is (sheet path, title, [sloop ids], image dir, size, use Sloop's thumbnails?)
+# returns (sheet path, [(photo, found?)]) for the photos of each sighting, left then right
+def make_sheet(job):
+	path, title, sl_ids, image_dir, size, sloop_thumbs = job
+	sheet = Image.new("RGB", (2 * size + 3 * margin, title_height + margin + len(sl_ids) * (size + label_height + margin)), "white")
+	draw = ImageDraw.Draw(sheet)
+	draw.text((margin, margin / 2), title, fill="black")
+	found = []
+	for row, sl_id in enumerate(sl_ids):
+		for column, side in enumerate(sides):
+			photo = "%s_%s.jpg" % (sl_id, side)
+			candidates = [os.path.join(image_dir, "originals", photo)]
+			if sloop_thumbs:
+				candidates.insert(0, os.path.join(image_dir, "thumbs", "%s_%s-thumb.jpg" % (sl_id, side)))
+			box = cell_box(row, column, size)
+			image = None
+			for candidate in candidates:
+				try:
+					image = Image.open(candidate)
+					image.draft("RGB", (size, size))	# JPEGs can be decoded at a fraction of full size
+					image = image.convert("RGB")
+					image.thumbnail((size, size), Image.ANTIALIAS)
+					break
+				except (IOError, ValueError):
+					image = None
+			if image is None:
+				draw.rectangle(box, fill="lightgrey")
+				draw.text((box[0] + margin, box[1] + margin), "missing", fill="black")
+			else:
+				sheet.paste(image, (box[0] + (size - image.size[0]) / 2, box[1] + (size - image.size[1]) / 2))
+			draw.text((box[0], box[3] + 2), "%s %s" % (sl_id, side), fill="black")
+			found.append((photo, image is not None))
+	tmp_path = path + ".tmp"
+	sheet.save(tmp_path, "JPEG", quality=85)
+	os.rename(tmp_path, path)
+	return path, found
+
+
+def sheet_name(n, skink):	# file name of a newbie's sheet (numbered, as singletons all share an id)
+	return "%03d_%s.jpg" % (n + 1, "".join([c if c.isalnum() or c in "-_" else "_" for c in skink]))
+
+
+# index.html for a site's sheets: newbies is a list of (skink id, [sloop ids]), found is {photo: found?}
+def write_index(f, site_species, newbies, found, size):
+	f.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>%s newbies</title>\n" % cgi.escape(site_species))
+	f.write("<style>body { font-family: sans-serif } .newbie { margin-bottom: 2em } label { margin-right: 1em }</style>\n")
+	f.write("</head><body>\n<h1>%s: %d newbies</h1>\n" % (cgi.escape(site_species), len(newbies)))
+	f.write("<p>Tick the photos to keep (or click them on the sheets), save the list at the bottom as %s_selected.txt "
+		"where the harvest was run, then run sloop_review.py --fetch for %s.</p>\n" % (cgi.escape(site_species), cgi.escape(site_species)))
+	for n, (skink, sl_ids) in enumerate(newbies):
+		f.write("<div class=\"newbie\"><h2>%d. %s (%d sighting%s)</h2>\n" % (n + 1, cgi.escape(skink), len(sl_ids),
+			"" if len(sl_ids) == 1 else "s"))
+		f.write("<img src=\"%s\" usemap=\"#sheet%d\" alt=\"%s\"><map name=\"sheet%d\">\n" % (sheet_name(n, skink), n, cgi.escape(skink), n))
+		boxes = []
+		for row, sl_id in enumerate(sl_ids):
+			for column, side in enumerate(sides):
+				photo = "%s_%s.jpg" % (sl_id, side)
+				if found.get(photo):
+					f.write("<area shape=\"rect\" coords=\"%d,%d,%d,%d\" href=\"#\" onclick=\"return toggle('%s')\">\n" % (cell_box(row, column, size) + (photo,)))
+					boxes.append("<label><input type=\"checkbox\" name=\"%s\" onchange=\"update()\"> %s %s</label>" % (photo, sl_id, side))
+				else:
+					boxes.append("<label><input type=\"checkbox\" disabled> %s %s (missing)</label>" % (sl_id, side))
+		f.write("</map>\n<p>%s</p></div>\n" % " ".join(boxes))
+	f.write("<h2>Selected photos</h2>\n<textarea id=\"selected\" rows=\"10\" cols=\"30\" readonly></textarea>\n")
+	f.write("<p><a id=\"save\" download=\"%s_selected.txt\" href=\"data:text/plain,\">Save the list</a></p>\n" % cgi.escape(site_species))
+	f.write("<script>\n"
+		"function update() {\n"
+		"	var names = [];\n"
+		"	var boxes = document.querySelectorAll(\"input[type=checkbox]\");\n"
+		"	for (var i = 0; i < boxes.length; i++) if (boxes[i].checked) names.push(boxes[i].name);\n"
+		"	var text = names.length ? names.join(\"\\n\") + \"\\n\" : \"\";\n"
+		"	document.getElementById(\"selected\").value = text;\n"
+		"	document.getElementById(\"save\").href = \"data:text/plain;charset=utf-8,\" + encodeURIComponent(text);\n"
+		"}\n"
+		"function toggle(name) {\n"
+		"	var box = document.querySelector(\"input[name='\" + name + \"']\");\n"
+		"	box.checked = !box.checked;\n"
+		"	update();\n"
+		"	return false;\n"
+		"}\n"
+		"</script>\n</body></html>\n")
+
+
+# make the sheets and index.html for sites of a species
+# sites is a list of (site_species, newbies as harvest_newbies.py has them: [(skink id, [sloop ids])])
+# returns {site_species: (newbies, photos found, photos missing)}
+def make_sheets(species, sites, image_dir=None, jobs=None, size=default_size, sloop_thumbs=False):
+	if Image is None:
+		print >> sys.stderr, "Error: the PIL (Pillow) package is needed to make contact sheets"
+		sys.exit()
+	if image_dir is None:
+		image_dir = sloop_photo_index.species_image_dir[species]
+	work = []
+	for site_species, newbies in sites:
+		directory = review_directory(site_species)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		for n, (skink, sl_ids) in enumerate(newbies):
+			work.append((os.path.join(directory, sheet_name(n, skink)), "%s  %s" % (site_species, skink), list(sl_ids),
+				image_dir, size, sloop_thumbs))
+	found = {}	# photo -> found?
+	pool = multiprocessing.Pool(jobs)
+	with sloop_stats.span("make_sheets"):
+		for n, (path, photos) in enumerate(pool.imap_unordered(make_sheet, work)):
+			found.update(photos)
+			if verbose and (n + 1) % 100 == 0:
+				print n + 1, "of", len(work), "sheets made"
+	pool.close()
+	pool.join()
+	sloop_stats.count("sheets", len(work))
+	counts = {}
+	for site_species, newbies in sites:
+		index = cStringIO.StringIO()
+		write_index(index, site_species, newbies, found, size)
+		sloop_build.write_atomic(os.path.join(review_directory(site_species), "index.html"), index.getvalue())
+		photos = ["%s_%s.jpg" % (sl_id, side) for skink, sl_ids in newbies for sl_id in sl_ids for side in sides]
+		have = len([photo for photo in photos if found.get(photo)])
+		counts[site_species] = (len(newbies), have, len(photos) - have)
+	return counts
+
+
+def read_newbies(path):	# newbies from a site_species_newbies.csv: [(skink id, [sloop ids])]
+	newbies = []
+	f = open(path)
+	for line in f:
+		fields = [field.strip() for field in line.split(",")]
+		if fields != [""]:
+			newbies.append((fields[0], fields[1:]))
+	f.close()
+	return newbies
+
+
+def read_selection(path):	# photo file names listed in a site_species_selected.txt
+	selection = []
+	f = open(path)
+	for n, line in enumerate(f):
+		line = line.strip()
+		if line == "" or line.startswith("#"):
+			continue
+		match = sloop_photo_index.photo_name.match(line)
+		if match is None or match.group(3) is not None:
+			print >> sys.stderr, "Error: " + path + " line " + str(n + 1) + ": " + line + " isn't a photo name (e.g. 12345_L.jpg)"
+			sys.exit()
+		selection.append(line)
+	f.close()
+	return selection
+
+
+# copy a site's selected photos into its photo directory, with the manifest, as harvest_newbies.py would
+def fetch_selected(species, site_species, image_dir=None, threads=None, no_link=False):
+	if image_dir is None:
+		image_dir = sloop_photo_index.species_image_dir[species]
+	selection = read_selection(site_species + "_selected.txt")
+	if not os.path.isdir(site_species):
+		os.makedirs(site_species)
+	copier = sloop_photos.PhotoCopier(os.path.join(image_dir, "originals"), site_species, threads, link=(False if no_link else None))
+	with sloop_stats.span("copy_photos"):
+		for photo in selection:
+			copier.Put(photo)
+		copier.Finish()
+	manifest = cStringIO.StringIO()
+	copier.WriteManifest(manifest)
+	sloop_build.write_atomic(site_species + "_photos.csv", manifest.getvalue())
+	return copier.Stats()
+
+
+def main():
+	global verbose
+	parser = argparse.ArgumentParser(usage="sloop_review.py [-v] [-j jobs] [--image-dir dir] [--size px] [--sloop-thumbs] species site_species [site_species ...]\n       sloop_review.py --fetch [-v] [--image-dir dir] [--copy-threads n] [--no-link] species site_species [site_species ...]")
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--image-dir", default=None)
+	parser.add_argument("--size", type=int, default=default_size)
+	parser.add_argument("--sloop-thumbs", action="store_true")
+	parser.add_argument("--fetch", action="store_true")
+	parser.add_argument("--copy-threads", type=int, default=None)
+	parser.add_argument("--no-link", action="store_true")
+	parser.add_argument("species")
+	parser.add_argument("site_species", nargs="+")
+	options = parser.parse_args()
+	verbose = options.verbose
+	species = options.species
+	if species not in sloop_db.species_database:
+		print >> sys.stderr, "Error: unknown species ", species
+		sys.exit()
+
+	if options.fetch:
+		for site_species in options.site_species:
+			stats = fetch_selected(species, site_species, options.image_dir, options.copy_threads, options.no_link)
+			print site_species, "photos:", sloop_photos.describe_stats(stats)
+		return
+
+	sites = []
+	for site_species in options.site_species:
+		path = site_species + "_newbies.csv"
+		if not os.path.exists(path):
+			print >> sys.stderr, "Error: can't find " + path + " (run harvest_newbies.py first)"
+			sys.exit()
+		sites.append((site_species, read_newbies(path)))
+	counts = make_sheets(species, sites, options.image_dir, options.jobs, options.size, options.sloop_thumbs)
+	for site_species, newbies in sites:
+		print "%s: %d newbies, %d photos, %d missing, sheets in %s" % ((site_species,) + counts[site_species] +
+			(os.path.join(review_directory(site_species), "index.html"),))
+
+
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,90 @@
+# survey calendar and sightings store shared by sloop_to_mark.py and harvest_newbies.py
+
+# a site's surveys are numbered as occasions 0..n-1 in date order, as they appear in the survey workbook
+# animals are found through a dictionary keyed by skink id, and each animal keeps a map from
+# occasion to its entry for that occasion, so neither lookup has to scan a list
+
+import datetime	# to get date conversion functions
+from array import array	# compact storage for per-animal occasion numbers
+
+
+class Individual(object):
+	'One animal (or one anonymous sighting) and its entries in occasion order'
+	__slots__ = ('skink_id', 'occasions', 'values', 'seen')
+
+	def __init__(self, skink_id):
+		self.skink_id = skink_id
+		self.occasions = array('i')	# occasion number of each entry, in the order added
+		self.values = []		# what the caller keeps per entry (size estimate, sloop id...)
+		self.seen = {}			# occasion number -> position of first entry for that occasion
+
+	def Add(self, occasion, value):	# append an entry for the given occasion
+		if occasion not in self.seen:
+			self.seen[occasion] = len(self.values)
+		self.occasions.append(occasion)
+		self.values.append(value)
+
+
+class SurveySeries(object):
+	'Class to manage skink sightings for a survey series'
+
+	def __init__(self, site):
+		self.site = site		# not sure if we'll ever use this
+		self.surveys = []		# list of lists of dates
+		self.current_series = []	# list of dates in current series during assembly
+		self.series_start = []		# occasion number of the first survey in each series
+		self.dates = []			# date of each occasion
+		self.occasion = {}		# survey date -> occasion number
+		self.individuals = []		# animals in the order they were first seen
+		self.by_id = {}			# skink id -> Individual, for animals that have an id
+
+	def AddSurvey(self, date):	# add survey on given date to current series
+		self.current_series.append(date)
+
+	def EndSeries(self):	# mark that all surveys in current series have been added
+		self.series_start.append(len(self.dates))
+		for date in self.current_series:
+			self.occasion.setdefault(date, len(self.dates))	# a repeated date keeps its first occasion
+			self.dates.append(date)
+		self.surveys.append(self.current_series)
+		self.current_series = []
+
+	def SurveyDates(self):	# generator to return each date in turn
+		for series in self.surveys:
+			for date in series:
+				yield date
+
+	def SurveyGaps(self):	# generator to return interval in years between each survey series
+		# gap is taken between first surveys in successive series
+		# (we assume survesy in series are closed to births etc. so any consistent reference point should be OK)
+		# values returned to 2 decimal places so ~3.5 day resolution
+		for i in range(len(self.surveys)-1):
+			start1 = self.surveys[i][0]
+			start2 = self.surveys[i+1][0]
+			yield round((datetime.datetime(start2[0],start2[1],start2[2]) - datetime.datetime(start1[0],start1[1],start1[2])).days / 365.0, 2)
+
+	def OccasionCount(self):	# total number of surveys across all series
+		return len(self.dates)
+
+	def SeriesOccasions(self, i):	# occasion numbers of the surveys in series i
+		return range(self.series_start[i], self.series_start[i] + len(self.surveys[i]))
+
+	def NewIndividual(self, skink_id):	# start a fresh entry, never merged with anything else (anonymous sightings)
+		animal = Individual(skink_id)
+		self.individuals.append(animal)
+		return animal
+
+	def FindIndividual(self, skink_id):	# entry for an animal with an id, created on first sighting
+		animal = self.by_id.get(skink_id)
+		if animal is None:
+			animal = self.NewIndividual(skink_id)
+			self.by_id[skink_id] = animal
+		return animal
+
+	def DumpSurveys(self):	# debug function to dump assembled survey series
+		for i in self.surveys:
+			print i
+
+	def DumpSkinks(self):	# debug function to dump list of skinks in surveys
+		for animal in self.individuals:
+			print animal.skink_id, [self.dates[o] for o in animal.occasions], animal.values
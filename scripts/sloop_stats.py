@@ -0,0 +1,106 @@
+# timing and counting instrumentation shared by the scripts, reported by their --stats and --profile options
+
+# time goes into named spans (workbook parse, database connect, queries, size fitting, each writer, photo copy...)
+# and things done go into named counters (rows fetched, individuals, occasions, files copied, bytes...)
+# both are simple totals for this process; pool workers hand theirs back with their results to be merged
+
+import sys	# stats go to stderr unless told otherwise
+import time	# span timings
+import json	# --stats json
+import cProfile	# --profile
+from contextlib import contextmanager
+
+spans = {}	# span name -> [times entered, total seconds]
+counters = {}	# counter name -> total
+
+
+def add_time(name, seconds, calls=1):	# add time to a span
+	total = spans.setdefault(name, [0, 0.0])
+	total[0] += calls
+	total[1] += seconds
+
+
+@contextmanager
+def span(name):	# time a with block into a span
+	start = time.time()
+	try:
+		yield
+	finally:
+		add_time(name, time.time() - start)
+
+
+def timed_iter(name, iterable, counter=None):	# iterate, timing only the fetching of each item (not what the caller does with it)
+	# counts as one call however many items there are; counter, if given, counts the items
+	items = iter(iterable)
+	seconds = 0.0
+	n = 0
+	try:
+		while True:
+			start = time.time()
+			try:
+				item = next(items)
+			except StopIteration:
+				seconds += time.time() - start
+				return
+			seconds += time.time() - start
+			n += 1
+			yield item
+	finally:	# totals go in once, at the end (or when the caller stops early)
+		add_time(name, seconds)
+		if counter is not None:
+			count(counter, n)
+
+
+def count(name, n=1):	# add to a counter
+	counters[name] = counters.get(name, 0) + n
+
+
+def collect():	# take this process's spans and counters, leaving them empty (for a pool worker to return)
+	collected = {"spans": dict(spans), "counters": dict(counters)}
+	spans.clear()
+	counters.clear()
+	return collected
+
+
+def merge(collected):	# add spans and counters from collect() in another process
+	for name, (calls, seconds) in collected["spans"].items():
+		add_time(name, seconds, calls)
+	for name, n in collected["counters"].items():
+		count(name, n)
+
+
+def report(f, format):	# write out the spans and counters as json or a text table
+	if format == "json":
+		json.dump({"spans": dict([(name, {"calls": calls, "seconds": round(seconds, 6)}) for name, (calls, seconds) in spans.items()]),
+			"counters": counters}, f, indent=1, sort_keys=True)
+		f.write("\n")
+		return
+	f.write("%-24s %8s %10s\n" % ("span", "calls", "seconds"))
+	for name, (calls, seconds) in sorted(spans.items(), key=lambda item: -item[1][1]):
+		f.write("%-24s %8d %10.4f\n" % (name, calls, seconds))
+	for name, n in sorted(counters.items()):
+		f.write("%-24s %8d\n" % (name, n))
+
+
+# run a script's work as asked by its --stats/--stats-file/--profile options
+# stats_format is None (no stats), "json" or "text"; stats go to stderr unless stats_file is given
+# profile_file, if given, gets a cProfile dump of the run (of this process only: not of pool workers)
+def instrument(function, stats_format=None, stats_file=None, profile_file=None):
+	profiler = None
+	if profile_file is not None:
+		profiler = cProfile.Profile()
+		profiler.enable()
+	try:
+		with span("total"):
+			function()
+	finally:	# even if the script exits early
+		if profiler is not None:
+			profiler.disable()
+			profiler.dump_stats(profile_file)
+		if stats_format is not None:
+			if stats_file is None:
+				report(sys.stderr, stats_format)
+			else:
+				f = open(stats_file, "w")
+				report(f, stats_format)
+				f.close()
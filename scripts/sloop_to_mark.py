@@ -6,53 +6,71 @@
 
 # usage:
 # sloop_to_mark.py [options] species site surveyfile.xls
+# sloop_to_mark.py [options] --all-sites species[,species...] surveyfile.xls
 # options:
 # -v causes details of processing to be dumped to standard error
+# --all-sites exports every site column in the sheet for each species, reading the workbook once and
+#             sharing one database connection per species; size fitting and file writing for each site
+#             run in a pool of worker processes, and a table of per-site counts and timings is printed at the end
+# -j n sets the number of worker processes for --all-sites (default: one per cpu)
+# --refresh brings the local sightings cache up to date from the live database, then works from the cache
+# --offline works from the local sightings cache without touching the live database
+# --cache-dir dir puts the sightings cache, and the cache of survey calendars read from workbooks, in dir (default: ~/.sloop_cache)
+# --incremental keeps the fitted sizes of each export in site_species_state.npz; when the survey workbook has
+#               gained survey series since, only the new series are queried and only animals seen in them
+#               (or never yet seen with a size) are re-fitted, other animals' histories are reused as they are
+# --verify-incremental does an incremental export and checks it against a full rebuild, which is written
+#               instead (with an error, and exit status 1) if they differ
+# --stats json|text reports the time spent in each stage (workbook parse, database connect and queries, size fitting,
+#         each writer...) and counts of rows fetched, individuals, occasions and files written, on stderr
+# --stats-file file puts the --stats report in file instead
+# --profile file writes a cProfile dump of the run to file (of the main process: not of --all-sites workers)
+# --formats list picks the output files, from surveys (site_species_surveys.txt), inp (site_species.inp),
+#           cohort (site_species_cohort.inp), long (site_species_long.csv, one line per animal per occasion
+#           seen, for reading into R) and columns (site_species_columns.bin, the histories, fitted sizes, ids and
+#           survey intervals in one binary file, read into R by read_sloop_columns in R/read_sloop_columns.txt
+#           without parsing any text; the layout is described at ColumnsSink); the default is surveys,inp,cohort
+# --legacy-sizes fetches every sighting and combines repeat sightings of an animal on a day here, as exports used to
+#                (averaging sizes pairwise, which over-weights later sightings when there are more than two);
+#                otherwise the database returns one row per animal per day, with the mean of its non-zero sizes
+# --changed-only (with --all-sites) only fits and writes sites whose inputs have changed since they were last exported:
+#                the hash of each site's survey calendar, the rows fetched for it, the options that change the outputs
+#                and this script's code is kept with the hash of its outputs in sloop_to_mark_build.json (see sloop_build.py),
+#                and a site is redone if any of them differ or its outputs are missing; a line per site says which
+# --dry-run (with --changed-only) prints which sites would be redone, and why, without writing anything
+# output files are written aside and renamed into place, so an interrupted export leaves each file old or new, never half written
 
 # Note: errors and warnings go to stderr, verbose output goes to stdout
 
-import psycopg2	# postgres interface package
-import xlrd	# .xls decoder package
 import sys	# so we can get at the command line
 import datetime	# to get date conversion functions
+import os	# to check for saved state files
+import time	# for the batch summary timings
+import cStringIO	# outputs are assembled in memory before writing
+import argparse	# command line options
+import multiprocessing	# worker pool for batch exports
+import numpy	# array package, capture histories are held as a matrix
+import sloop_sightings	# survey calendar and sightings store shared with harvest_newbies.py
+import sloop_db	# database connections shared with harvest_newbies.py
+import sloop_workbook	# survey workbook reading, with a cache of survey calendars
+import sloop_cache	# local sightings cache shared with harvest_newbies.py
+import sloop_stats	# timing and counting for --stats
+import sloop_build	# --changed-only build records
 
 verbose = False	# global to turn on debug/information output
+legacy_sizes = False	# global to combine each day's sightings here (--legacy-sizes) rather than in the database
 
+split_survey_dates = [(2006, 4, 6)]	# surveys folded into the survey before them (Airport, 5/6 April 2006)
+build_file = "sloop_to_mark_build.json"	# --changed-only build record, in the output directory
 
-class SurveySeries:
-	'Class to manage skink sightings for a survey series'
+
+class MarkSeries(sloop_sightings.SurveySeries):
+	'Survey series holding estimated sizes, for MARK output'
 
 	def __init__(self, site, keep_ones):
-		self.site = site		# not sure if we'll ever use this
+		sloop_sightings.SurveySeries.__init__(self, site)
 		self.keep_size_one = keep_ones	# is site closed to size 1 births during survey period?
-		self.surveys = []		# list of lists of dates
-		self.current_series = []	# list of dates in current series during assembly
-		self.skinks = []		# list of skinks seen in the survey series
-		self.dates = []			# and list of lists of dates
-		self.sizes = []			# and list of lists of sizes
- 
-	def AddSurvey(self, date):	# add survey on given date to current series
-		self.current_series.append(date)
-
-
-	def EndSeries(self):	# mark that all surveys in current series have been added
-		self.surveys.append(self.current_series)
-		self.current_series = []
-
-	def SurveyDates(self):	# generator to return each date in turn
-		for series in self.surveys:
-			for date in series:
-				yield date
-
-	def SurveyGaps(self):	# generator to return interval in years between each survey series
-		# gap is taken between first surveys in successive series
-		# (we assume survesy in series are closed to births etc. so any consistent reference point should be OK)
-		# values returned to 2 decimal places so ~3.5 day resolution
-		for i in range(len(self.surveys)-1):
-			start1 = self.surveys[i][0]
-			start2 = self.surveys[i+1][0]
-			yield round((datetime.datetime(start2[0],start2[1],start2[2]) - datetime.datetime(start1[0],start1[1],start1[2])).days / 365.0, 2)
-
+		self.refit = None		# animals ProcessSizes has to fit, None for all of them
 
 	def AddSkink(self, date, skink, size):	# put a skink sighting into the survey records
 		# multiple occurrences of a skink on the same date are removed in the add process
@@ -75,408 +93,747 @@ class SurveySeries:
 			size=3.5
 		else:	# convert unexpected sizes to 0
 			size = 0
+		occasion = self.occasion[date]	# which survey this sighting belongs to
 		if skink == "SINGLETON_SO_FAR":		# anonymous singletons have been seen exactly once by definition, don't want to combine them
 			# add new entry with this date and size
-			self.skinks.append(skink)	# append skink to list
-			self.dates.append([date])	# append list containing date to list
-			self.sizes.append([size])	# ditto for size
- 		elif skink == "NEVER_COMPARED":	# Unexpected in production use: indicates that Sloop matching has not been checked for this animal
- 			# might be running the script for test or other purposes when Sloop matching incomplete
- 			# warn the user, omit this animal so that MARK data only contains matched animals
- 			print >> sys.stderr, "Warning: NEVER_COMPARED animal omitted from output files for MARK analysis"
+			self.NewIndividual(skink).Add(occasion, size)
+		elif skink == "NEVER_COMPARED":	# Unexpected in production use: indicates that Sloop matching has not been checked for this animal
+			# might be running the script for test or other purposes when Sloop matching incomplete
+			# warn the user, omit this animal so that MARK data only contains matched animals
+			print >> sys.stderr, "Warning: NEVER_COMPARED animal omitted from output files for MARK analysis"
 		else:	# a skink with an id
-			if skink in self.skinks:	# is this skink already in the list?
-				i=self.skinks.index(skink)	# yes: pick up its index
-				if self.dates[i][-1] == date:	# is this a repeat entry for the day? dates queried in sequence, so would be at end of list
-					if size != 0:	# only interested in size, and then only if meaningful
-						if self.sizes[i][-1] == 0:	# drop already entered size if zero
-							self.sizes[i][-1] = size
-						else:
-							self.sizes[i][-1] = (size + self.sizes[i][-1])/2	# average the size
-							# !!!BUG!!! if more than two sightings, later entries are over-weighted
-				else:	# straightforward new date for existing skink
-					self.dates[i].append(date)	# append new date to list of dates for this skink
-					self.sizes[i].append(size)	# ditto for size
-			else:	# not in list, new entry on the end
-				self.skinks.append(skink)	# append skink to list
-				self.dates.append([date])	# append list containing date to list
-				self.sizes.append([size])	# ditto for size
-
-	def _try_fit(self, hist, gaps, size):
-		# takes a list of estimated sizes, one per survey series
-		#	a list of gaps between survey series, in years
-		#	a presumed size at the start of the survey seriese, to test the fit of
-		# returns residual between idealised growth from that size and estimated sizes
-
-		# calculate residual for first survey series
-		residual = 0.0
-		if hist[0] != "":
-			residual = abs(hist[0] - size)
-		# if we have gaps, there are more years to recurse through
-		if gaps != []:
-			# increase size by number of years to next survey, capping at size 4
-			n_size = size + gaps[0]
-			if n_size > 4.0:
-				n_size = 4.0
-			# now get residual for remaining survey series
-			residual += self._try_fit(hist[1:], gaps[1:], n_size)
-		return residual
-			
+			animal = self.FindIndividual(skink)	# existing entry, or a new one on the end
+			i = animal.seen.get(occasion)
+			if i is not None:	# is this a repeat entry for the day?
+				if size != 0:	# only interested in size, and then only if meaningful
+					if animal.values[i] == 0:	# drop already entered size if zero
+						animal.values[i] = size
+					else:
+						animal.values[i] = (size + animal.values[i])/2	# average the size
+						# !!!BUG!!! if more than two sightings, later entries are over-weighted
+			else:	# straightforward new date for this skink
+				animal.Add(occasion, size)
+
+	def AddDay(self, date, skink, size, count):	# put an animal's sightings on a day, already combined by the database, into the survey records
+		# size is the mean of the day's non-zero size estimates (0 if there were none), count is how many sightings there were
+		occasion = self.occasion[date]	# which survey this belongs to
+		if skink == "SINGLETON_SO_FAR":		# each singleton sighting comes as a day of its own
+			self.NewIndividual(skink).Add(occasion, size)
+		elif skink == "NEVER_COMPARED":		# likewise, omitted as AddSkink does
+			print >> sys.stderr, "Warning: NEVER_COMPARED animal omitted from output files for MARK analysis"
+		else:
+			animal = self.FindIndividual(skink)
+			if animal.seen.get(occasion) is None:	# one row per animal per day, so this is a new date for this skink
+				animal.Add(occasion, size)
+
+	def BuildHistory(self):	# build the individuals x occasions matrix of sizes once all sightings are in
+		# NaN marks an occasion on which the animal wasn't seen, 0 a sighting without a usable size estimate
+		rows = []
+		columns = []
+		sizes = []
+		for row, animal in enumerate(self.individuals):
+			rows.extend([row] * len(animal.occasions))
+			columns.extend(animal.occasions)
+			sizes.extend(animal.values)
+		self.history = numpy.empty((len(self.individuals), self.OccasionCount()))
+		self.history.fill(numpy.nan)
+		self.history[numpy.array(rows, dtype=int), numpy.array(columns, dtype=int)] = sizes
+
+	def _series_means(self, first_series=0):	# individuals x series matrix of the mean estimated size in each survey series
+		# arithmetic mean of the sized sightings in the series, NaN if the animal wasn't seen with a size that year
+		# series before first_series are left as NaN
+		means = numpy.empty((len(self.individuals), len(self.surveys)))
+		means.fill(numpy.nan)
+		for survey in range(first_series, len(self.surveys)):	# look through each survey in turn
+			tmp_s = numpy.zeros(len(self.individuals))
+			tmp_c = numpy.zeros(len(self.individuals), dtype=int)
+			for occasion in self.SeriesOccasions(survey):	# add in each date in the survey, in date order
+				sz = self.history[:, occasion]
+				sized = numpy.nan_to_num(sz) > 0	# skip 0 because 0 indicates unsized, not zero size (and not seen)
+				tmp_s[sized] += sz[sized]
+				tmp_c += sized
+			have = tmp_c > 0
+			means[have, survey] = tmp_s[have] / tmp_c[have]
+		return means
+
+	def FitSizes(self, rows=None):	# score every possible starting size class for every animal at once
+		# fit of idealised growth curve (one size class per year, capped at size 4) against the mean estimated size
+		# in each series, from the first series in which the animal was seen with a size
+		# sets self.first_sight (series), self.first_fit (size class when first seen) and
+		# self.fit_residuals (individuals x 4, residual for starting sizes 1 to 4) for use in diagnostics
+		# rows (boolean mask) limits the fit to some animals, reusing self.series_means and the fits of the rest
+
+		# ASSUMPTION: surveys are roughly a whole number of years apart
+		# (i.e. surveys always take place in summer, but some years may be skipped)
+		# BUG: if we include Wildlife winter grands survey this isn't true around that winter survey
+		years = [0.0]	# whole years from the first survey series to each series
+		for g in self.SurveyGaps():
+			years.append(years[-1] + round(g))
+		years = numpy.array(years)
+
+		if rows is None:	# fitting everybody from scratch
+			self.series_means = self._series_means()
+			rows = numpy.ones(len(self.individuals), dtype=bool)
+			self.first_sight = numpy.zeros(len(self.individuals), dtype=int)
+			self.first_fit = numpy.zeros(len(self.individuals), dtype=int)
+			self.fit_residuals = numpy.zeros((len(self.individuals), 4))
+		means = self.series_means[rows]
+		sized = ~numpy.isnan(means)
+		# an animal never seen with a size falls back to the last series, which has nothing to fit
+		first_sight = numpy.where(sized.any(axis=1), sized.argmax(axis=1), len(self.surveys)-1)
+		start_size = numpy.arange(1.0, 5.0)[:, numpy.newaxis]	# candidate sizes down the first axis
+		residuals = numpy.zeros((4, len(means)))
+		# accumulate from the last series back to the first, adding in the same order as the old recursive fit
+		# so that residuals (and hence ties) come out bit for bit the same
+		for survey in range(len(self.surveys)-1, -1, -1):
+			grown = numpy.minimum(start_size + (years[survey] - years[first_sight]), 4.0)	# size increases with years, capped at 4
+			fitted = sized[:, survey] & (survey >= first_sight)
+			residuals = numpy.where(fitted, numpy.abs(numpy.nan_to_num(means[:, survey]) - grown) + residuals, residuals)
+		fit1, fit2, fit3, fit4 = residuals
+		# pick the best fit, use of < means we will chose larger start size in the event of an x.5 residual
+		self.first_fit[rows] = numpy.select([fit1 < fit2, fit2 < fit3, fit3 < fit4], [1, 2, 3], 4)
+		self.first_sight[rows] = first_sight
+		self.fit_residuals[rows] = residuals.T
+		if verbose:
+			self.DumpFits(rows)
 
 	def ProcessSizes(self):	# apply consistency rules to estimated sizes
 		# best fit (least residuals) of skink growing from size x at first sighting until size 4
 		# with fit of idealised growth curve against arithmetic mean of estimated sizes across survey series in year
 		# ISSUE: mean may not (always) be best (e.g. 1.0, 4.0, 4.0 should probably go to 4.0, not 3.0)
-		for skink in range(len(self.sizes)):	# go through all of the capture histories
-			size_hist = []
-			for survey in self.surveys:	# look through each survey in turn
-				tmp_s = 0
-				tmp_c = 0
-				for date in survey:	# look through each date in the survey
-					if date in self.dates[skink]:	# saw this skink on this day
-						sz = self.sizes[skink][self.dates[skink].index(date)]
-						if sz > 0:	# skip 0 because 0 indicates unsized, not zero size
-							tmp_s += sz
-							tmp_c += 1
-							if verbose:
-								print sz
-				if tmp_c > 0:
-					size_hist.append(tmp_s/tmp_c)
-					if verbose:
-						print
+		# after ExtendFromState only the animals in self.refit are fitted, the rest keep their sizes
+		if self.surveys == []:	# nothing to fit
+			return
+		self.FitSizes(self.refit)
+		rows = self.refit
+		if rows is None:
+			rows = numpy.ones(len(self.individuals), dtype=bool)
+		# first_sight is now the first survey year in which each skink was seen
+		# and first_fit the size class when it was first seen; size increases by one a year from there until we hit 4
+		for survey in range(len(self.surveys)):
+			derived_size = numpy.minimum(self.first_fit + (survey - self.first_sight), 4)[:, numpy.newaxis]
+			series = self.history[:, self.series_start[survey]:self.series_start[survey] + len(self.surveys[survey])]
+			moderate = ~numpy.isnan(series) & ((survey >= self.first_sight) & rows)[:, numpy.newaxis]	# saw this skink on these days
+			series[...] = numpy.where(moderate, derived_size, series)
+		self.refit = None
+
+	def SaveState(self, path):	# keep the fitted sizes of this export, so the next one can be incremental
+		f = open(path + ".tmp", "wb")	# written aside and renamed into place, as the outputs are
+		numpy.savez(f, dates=numpy.array(self.dates, dtype=int).reshape(-1, 3),
+			series_start=numpy.array(self.series_start, dtype=int),
+			keep_size_one=numpy.array(bool(self.keep_size_one)),
+			skink_ids=numpy.array([animal.skink_id for animal in self.individuals], dtype=str),
+			history=self.history, series_means=self.series_means,
+			first_sight=self.first_sight, first_fit=self.first_fit, fit_residuals=self.fit_residuals)
+		f.close()
+		os.rename(path + ".tmp", path)
+
+	def StateMatches(self, state):	# can this calendar be had by appending survey series to the saved one?
+		old_dates = [tuple(d) for d in state["dates"]]
+		old_series = list(state["series_start"])
+		if bool(self.keep_size_one) != bool(state["keep_size_one"]):
+			return False
+		if len(old_series) == 0 or len(old_series) > len(self.surveys):
+			return False
+		if self.dates[:len(old_dates)] != old_dates or self.series_start[:len(old_series)] != old_series:
+			return False
+		# the last saved series mustn't have gained surveys
+		return len(old_series) == len(self.surveys) or self.series_start[len(old_series)] == len(old_dates)
+
+	def ExtendFromState(self, state, source):	# rebuild from a saved export plus sightings in the series added since
+		# animals seen before keep their rows (and sizes) from the saved export
+		# only the new series' dates are queried, and only animals that might fit differently are marked for ProcessSizes:
+		# those seen in the new series, new animals, and those never seen with a size (which are fitted to the last series)
+		old_occasions = len(state["dates"])
+		old_series = len(state["series_start"])
+		new = MarkSeries(self.site, self.keep_size_one)
+		for survey in self.surveys:
+			for date in survey:
+				new.AddSurvey(date)
+			new.EndSeries()
+		query_skinks(source, new, self.site, self.dates[old_occasions:])	# just the new series' dates
+		new.BuildHistory()
+
+		row_of = {}	# skink id -> row, for animals with an id
+		for skink_id in state["skink_ids"]:
+			skink_id = str(skink_id)
+			if skink_id != "SINGLETON_SO_FAR":	# anonymous singletons never pick up new sightings
+				row_of[skink_id] = len(self.individuals)
+				self.FindIndividual(skink_id)
+			else:
+				self.NewIndividual(skink_id)
+		old_count = len(self.individuals)
+		rows = []
+		for animal in new.individuals:	# new series' sightings go on existing rows, new animals on the end
+			row = row_of.get(animal.skink_id)
+			if row is None:
+				row = len(self.individuals)
+				if animal.skink_id == "SINGLETON_SO_FAR":
+					self.NewIndividual(animal.skink_id)
 				else:
-					size_hist.append("")
-			# now have sequence of mean estimated sizes for this skink over the years
-
-			# ASSUMPTION: surveys are roughly a whole number of years apart
-			# (i.e. surveys always take place in summer, but some years may be skipped)
-			# BUG: if we include Wildlife winter grands survey this isn't true around that winter survey
-
-			# build a list of inter-series time gaps for use in size fitting
-			years_to_next = []
-			spare_gap = 0.0
-			for g in self.SurveyGaps():
-				years_to_next.append(round(g))
-			# years_to_next will be empty list if there is only one survey series
-
-			if verbose:
-				print size_hist
-			for first_sight in range(len(size_hist)):
-				if size_hist[first_sight] != "":
-					break	# we know there is a first sighting
-			# now get the fits for each possible starting size class, based on sightings and survey spacings from first sighting
-			# size class is float because residual calculation is floating point
-			fit1 = self._try_fit(size_hist[first_sight:], years_to_next[first_sight:], 1.0)
-			fit2 = self._try_fit(size_hist[first_sight:], years_to_next[first_sight:], 2.0)
-			fit3 = self._try_fit(size_hist[first_sight:], years_to_next[first_sight:], 3.0)
-			fit4 = self._try_fit(size_hist[first_sight:], years_to_next[first_sight:], 4.0)
-			# pick the best fit, use of < means we will chose larger start size in the event of an x.5 residual
-			if fit1 < fit2:
-				first_fit = 1
-			elif fit2 < fit3:
-				first_fit = 2
-			elif fit3 < fit4:
-				first_fit = 3
+					row_of[animal.skink_id] = row
+					self.FindIndividual(animal.skink_id)
+			rows.append(row)
+		rows = numpy.array(rows, dtype=int)
+
+		self.history = numpy.empty((len(self.individuals), self.OccasionCount()))
+		self.history.fill(numpy.nan)
+		self.history[:old_count, :old_occasions] = state["history"]
+		self.history[rows, old_occasions:] = new.history[:, old_occasions:]
+		self.series_means = self._series_means(old_series)
+		self.series_means[:old_count, :old_series] = state["series_means"]
+		self.first_sight = numpy.zeros(len(self.individuals), dtype=int)
+		self.first_sight[:old_count] = state["first_sight"]
+		self.first_fit = numpy.zeros(len(self.individuals), dtype=int)
+		self.first_fit[:old_count] = state["first_fit"]
+		self.fit_residuals = numpy.zeros((len(self.individuals), 4))
+		self.fit_residuals[:old_count] = state["fit_residuals"]
+
+		self.refit = numpy.zeros(len(self.individuals), dtype=bool)
+		self.refit[rows] = True
+		self.refit[old_count:] = True
+		# animals never seen with a size were fitted to what was then the last series, so the sizes saved for
+		# their sightings there are fitted ones; put them back to unsized (the only thing they can have been)
+		unsized = numpy.zeros(len(self.individuals), dtype=bool)
+		unsized[:old_count] = numpy.isnan(state["series_means"]).all(axis=1)
+		self.history[unsized] = numpy.where(numpy.isnan(self.history[unsized]), numpy.nan, 0.0)
+		self.refit |= unsized
+		if verbose:
+			print "incremental:", self.OccasionCount() - old_occasions, "new occasions,", self.refit.sum(), "of", len(self.individuals), "animals to fit"
+
+	def FoldOccasions(self):	# output column of each occasion, with split surveys folded into one occasion
+		# BEWARE: horrible special case to fold together Airport split surveys on 5th and 6th April in 2006
+		# safe to recognise via date as that's the only site that was surveyed then, and we can't go back and survey other sites now
+		# a survey on one of the split_survey_dates shares the output column of the survey before it
+		columns = []
+		for occasion, date in enumerate(self.dates):
+			if occasion > 0 and date in split_survey_dates:
+				columns.append(columns[-1])
 			else:
-				first_fit = 4
-			if verbose:
-				print first_fit, fit1, fit2, fit3, fit4
-				print
-			# first_sight is now the first survey year in which the skink was seen
-			# and first_fit the size class when it was first seen
-			derived_size = first_fit
-			for s in self.surveys[first_sight:]:	# can now look through from the first survey the skink was seen
-				for d in s:	# look through each date in the survey
-					if d in self.dates[skink]:	# saw this skink on this day, so set size to moderated value
-						self.sizes[skink][self.dates[skink].index(d)] = derived_size
-				if derived_size< 4:
-					derived_size += 1	# increase size for next year, until we hit 4
-
-			
-
-	# local helper function
-	def _survey_count(self):
-		count = 0
-		for s in self.surveys:
-			count += len(s)
-		return count
+				columns.append(columns[-1] + 1 if columns else 0)
+		# end BEWARE special case
+		return numpy.array(columns, dtype=int)
+
+	def Fold(self, columns, combine):	# fold an individuals x occasions matrix into individuals x output occasions
+		# uses the mapping from FoldOccasions, combine gives the folded value of two columns
+		starts = numpy.flatnonzero(numpy.diff(numpy.r_[-1, self.fold]))	# first occasion of each output column
+		folded = columns[:, starts]
+		for occasion in numpy.flatnonzero(numpy.diff(self.fold) == 0) + 1:
+			column = self.fold[occasion]
+			folded[:, column] = combine(folded[:, column], columns[:, occasion])
+		return folded
+
+	def MarkSeen(self):	# individuals x output occasions, True where MARK should count the animal as seen
+		# either it's a size 2 or bigger, or we're including size 1 animals at this site
+		if self.keep_size_one:
+			seen = ~numpy.isnan(self.history)
+		else:
+			seen = numpy.nan_to_num(self.history) > 1	# we're ignoring size 1 animals for this site (not seen counts as 0)
+		return self.Fold(seen, numpy.logical_or)	# "or" the split surveys into a single occasion
+
+	def Emit(self, sinks):	# one pass over the individuals feeds every output sink
+		self.fold = self.FoldOccasions()
+		for sink in sinks:
+			with sloop_stats.span("write_" + sink.__class__.__name__):
+				sink.Begin(self)
+		with sloop_stats.span("write_rows"):
+			for row, animal in enumerate(self.individuals):
+				for sink in sinks:
+					sink.Row(row, animal)
+		for sink in sinks:
+			with sloop_stats.span("write_" + sink.__class__.__name__):
+				sink.End()
 
 	def WriteMetadata(self, f):	# write out metadata describing major/minor survey series
-		# first line of output file is inter-survey times for reading into Rmark (one less value than there are surveys)
-		gaps = self.SurveyGaps();	# get the gaps between survey years for use below
-		for yr in self.surveys:		# go through the surveys for each year
-			for z in range(len(yr)-1):	# write 0.0 gaps between the surveys for the year
-				f.write("0.0 ")
-			f.write(str(next(gaps, "")) + " ")		# write the between-year gap to the first survey of the next series
-							# empty string when we run out of between-year gaps (i.e. after last survey)
-		f.write("\r\n")		# job done...
-
-		# now output human-readable form
-		f.write(str(self._survey_count()) + " encounter occasions (total surveys)\r\n")
-		f.write(str(len(self.surveys)) + " primary occasions (survey years)\r\n")
-		f.write("Secondary occasions (surveys per year):")
-		for s in self.surveys:
-			f.write(" " + str(len(s)))
-		f.write("\r\n")
-		if len(self.surveys) > 1:	# only pull out the inter-series gaps if we have more than one survey series
-			f.write("Years between survey series: ")
-			for g in self.SurveyGaps():
-				f.write(str(g) + " ")
-			f.write("\r\n")
-
-
-	def WriteMetadataAirport(self, f):	# write out metadata for Airport, allowing for 5/6 April 2006 split survey
-						# take off one survey from total count and in first year of surveys
-		# first line of output file is inter-survey times for reading into Rmark (one less value than there are surveys)
-		gaps = self.SurveyGaps();	# get the gaps between survey years for use below
-		adjust_for_2006 = -1	# lose the apparent extra survey from the 5/6 April 2006 split: nasty, but we know it's in the first year
-		for yr in self.surveys:		# go through the surveys for each year
-			for z in range(len(yr)-1 + adjust_for_2006):	# write 0.0 gaps between the surveys for the year
-				f.write("0.0 ")
-			f.write(str(next(gaps, "")) + " ")		# write the between-year gap to the first survey of the next series
-							# empty string when we run out of between-year gaps (i.e. after last survey)
-			adjust_for_2006 = 0	# fixed up 5/6 April 2006 split first time through so cancel adjustment
-		f.write("\r\n")		# job done...
-
-		# now output human-readable form
-		f.write(str(self._survey_count()-1) + " encounter occasions (total surveys)\r\n")
-		f.write(str(len(self.surveys)) + " primary occasions (survey years)\r\n")
-		f.write("Secondary occasions (surveys per year):")
-		adjust_for_2006 = -1	# lose the apparent extra survey from the 5/6 April 2006 split: nasty, but we know it's in the first year
-		for s in self.surveys:
-			f.write(" " + str(len(s) + adjust_for_2006))
-			adjust_for_2006 = 0
-		f.write("\r\n")
-		if len(self.surveys) > 1:	# only pull out the inter-series gaps if we have more than one survey series
-			f.write("Years between survey series: ")
-			for g in self.SurveyGaps():
-				f.write(str(g) + " ")
-			f.write("\r\n")
-
+		self.Emit([MetadataSink(f)])
 
 	def WriteMarkINP(self, f):		# write out MARK input file
-		for i in range(len(self.dates)):	# go through all of the capture histories we've built up
-			output_sighting = False	# Mark doesn't like all-zero histories, and we may only have seen at size 1
-			output_string = ""
-			for date in self.SurveyDates():	# build output string for all surveys in series
-				if date in self.dates[i]:	# was this animal seen on this survey date?
-					if self.keep_size_one or self.sizes[i][self.dates[i].index(date)] > 1:
-						# either it's a size 2 or bigger
-						# or we're including size 1 animals at this site
-						output_string = output_string + "1"
-						output_sighting = True
-					else:
-						# we're ignoring size 1 animals for this site
-						output_string = output_string + "0"
-				else:
-					output_string = output_string + "0"	# didn't see this animal on this day
-				# BEWARE: horrible special case to fold together Airport split surveys on 5th and 6th April in 2006
-				# safe to recognise via date as that's the only site that was surveyed then, and we can't go back and survey other sites now
-				if date == (2006, 4, 6):
-					# "or" the last two entries into a single character
-					if output_string[-2:] == "00":
-						output_string = output_string[:-2] + "0"	# replace pair of zeros with zero
-					else:
-						output_string = output_string[:-2] + "1"	# replace anything else with a one
-				# end BEWARE special case
-			output_string = output_string + " 1;"	# tell Mark that there is one animal with this capture history
-			if output_sighting:	# at least one sighting bigger than size 1?
-				f.write(output_string + "\r\n")	# output capture history with Windows end of line characters
-				if verbose:
-					print output_string
-					print self.skinks[i]
-				
+		self.Emit([MarkInpSink(f)])
 
 	def WriteMarkCohorts(self, f):		# write out MARK input file for multi-state analysis
-		# derive this from WriteMarkINP, but convert size classes to Mark cohort letter codes
-		mark_cohort_class = "0ABCD"
-		if not self.keep_size_one:
-			mark_cohort_class = "00ABC"
-		for i in range(len(self.dates)):	# go through all of the capture histories we've built up
-			output_sighting = False	# Mark doesn't like all-zero histories, and we may only have seen at size 1
-			output_string = ""
-			for date in self.SurveyDates():	# build output string for all surveys in series
-				if date in self.dates[i]:	# was this animal seen on this survey date?
-					output_string = output_string + mark_cohort_class[self.sizes[i][self.dates[i].index(date)]]
-					if output_string[-1] != "0":	# if stripping size one we might have added a zero to the history 
-						output_sighting = True
-				else:
-					output_string = output_string + "0"	# didn't see this animal on this day
-				# BEWARE: horrible special case to fold together Airport split surveys on 5th and 6th April in 2006
-				# safe to recognise via date as that's the only site that was surveyed then, and we can't go back and survey other sites now
-				if date == (2006, 4, 6):
-					# "or" the last two entries into a single character; ASSUMPTION: size will be the same on each day (forced by ProcessSizes)
-					first_char = output_string[-2]
-					second_char = output_string[-1]
-					if first_char == "A" or second_char == "A":
-						output_string = output_string[:-2] + "A"
-					elif first_char == "B" or second_char == "B":
-						output_string = output_string[:-2] + "B"
-					elif first_char == "C" or second_char == "C":
-						output_string = output_string[:-2] + "C"
-					elif first_char == "D" or second_char == "D":
-						output_string = output_string[:-2] + "D"
-					else:
-						output_string = output_string[:-2] + "0"	# didn't see it either time
-				# end BEWARE special case
-			output_string = output_string + " 1;"	# tell Mark that there is one animal with this capture history
-			if output_sighting:	# at least one sighting bigger than size 1?
-				f.write(output_string + "\r\n")	# output capture history with Windows end of line characters
-				if verbose:
-					print output_string
-					print self.skinks[i]
+		self.Emit([CohortSink(f)])
 
+	def DumpFits(self, rows):	# debug function to dump series mean sizes and size fits
+		for i in numpy.flatnonzero(rows):
+			print self.individuals[i].skink_id, list(self.series_means[i])
+			print self.first_fit[i], list(self.fit_residuals[i])
+			print
 
+	def DumpSkinks(self):	# debug function to dump the sizes held in the capture history matrix
+		for animal, hist_row in zip(self.individuals, self.history):
+			seen = numpy.flatnonzero(~numpy.isnan(hist_row))
+			print animal.skink_id, [self.dates[o] for o in seen], list(hist_row[seen])
 
 
-	def DumpSurveys(self):	# debug function to dump assembled survey series
-		for i in self.surveys:
-			print i
 
-	def DumpSkinks(self):	# debug function to dump list of skinks in surveys
-		for i in range(len(self.skinks)):
-			print self.skinks[i], self.dates[i], self.sizes[i]
 
+# output sinks fed by MarkSeries.Emit: Begin gets the series, Row gets each individual in turn, End writes out
+# each sink holds its output until End, so every file gets a single write
 
+# smallest non-zero size/cohort code wins when folding split surveys together
+# ASSUMPTION: size will be the same on each day of the split survey (forced by ProcessSizes)
+def smallest_class(a, b):
+	return numpy.where((a == 0) | ((b != 0) & (b < a)), b, a)
 
 
+class OutputSink(object):
+	'Base class for an output file written by MarkSeries.Emit'
 
-# complain and quit
-def usage_exit():
-	print >> sys.stderr, "usage: sloop_to_mark.py [-v] species site surveyfile.xls"
-	sys.exit()
-
-# find the column headed by a cell containing the supplied string, complain and exit if we don't find it
-def find_column(sheet,header):
-	for col in range(sheet.ncols):
-		if sheet.cell(0,col).value == header:
-			return col
-	# if we got to here, we ran out of columns without finding the heading
-	# should perhaps raise an exception and let the caller deal with the problem?
-	print >> sys.stderr, "Error: No surveys found for site ", header, " for requested species"
-	sys.exit()
-
-# pull the survey out of the supplied column and assemble the object that will hold the sightings data
-def extract_surveys(book,sheet,site):
-	column = find_column(sheet,site)
-	keep_size_one = sheet.cell(1,column).value	# is this site closed to size 1 births?
-	survey = SurveySeries(site,keep_size_one)
-	in_survey = False	# just consume blank cells until we hit a date
-	for row in range(2, sheet.nrows):
-		if sheet.cell(row,column).value == "":	# consume blank cells, delimit survey series
-			if in_survey:	# first blank cell after date(s) delimits survey series
-				survey.EndSeries()
-				in_survey = False	# just consume blank cells until we hit another date
-		else:	# slice pulls out year, month, day from datetime tuple
-			survey.AddSurvey(xlrd.xldate_as_tuple(sheet.cell(row,column).value,book.datemode)[0:3])
-			in_survey = True	# put dates into a survey series until we hit blank cell(s)
-	if in_survey:	# if last cell was a date we've just hit the end of the last series
-		survey.EndSeries()
-	return survey
+	def __init__(self, f):
+		self.f = f		# where the output goes
+		self.lines = []		# output held until End
 
-# convert date tuple to string format for SQL query
-# this isn't pretty, but it works which is enough for now...
-def make_query_date(date):
-	dt=datetime.datetime(date[0],date[1],date[2])
-	return dt.strftime("%Y-%m-%d")
+	def Begin(self, series):	# called once before the pass over the individuals
+		self.series = series
 
-# pull the skinks out of the survey records in the database, add them to the local survey object
-def query_skinks(db_conn, db_cur, surveys, site):
-	for date in surveys.SurveyDates():	# work through all of the survey dates
-		# note that postgres requires quoting to prevent identifiers being folded to lower case
-		# query is built in a string with " round db identifiers and ' round string literals in SQL, all \ quoted for Python
-		# pick out ID and estimated size for all skinks photo-surveyed at the site on the day
-		my_query="SELECT \"INDIVIDUAL_ID\", \"EST_SIZE_CLASS\" FROM \"CAPTURE\" WHERE \"EVENT\"=\'PhotoID\' AND \"SITE\"=\'"+site+"\' AND date_trunc(\'day\', \"CAPTURE_TIME\")=\'"+make_query_date(date)+"\'"
-		db_cur.execute(my_query)
-		for record in db_cur:	# loop over all photo-id skinks in the survey, noting them
-			surveys.AddSkink(date, record[0], record[1])
-			# ASSUMPTION: each date is queried once, so multiple adds of same skink on same date
-			#             will not be separated by other dates (but may be separated by other skinks on same date)
-		db_conn.rollback()	# do this as soon as practical to complete transaction and release lock
-
-
-
-
-#execution starts here
-arg_offset = 0
-if (len(sys.argv) < 4) or (len(sys.argv) > 5): usage_exit()
-if sys.argv[1] == "-v":
-	if len(sys.argv) == 5:
-		verbose = True
-		arg_offset = 1
-	else:
-		usage_exit()
-species = sys.argv[1+arg_offset]
-site = sys.argv[2+arg_offset]
-survey_file = sys.argv[3+arg_offset]
-
-if verbose:
-	print species, site, survey_file
-	print
-
-if species == "otago":
-	sp_database = "otagolive"
-elif species == "grand":
-	sp_database = "grandlive"
-else:
-	print >> sys.stderr, "Error: unknown species ", species 
-	usage_exit()
-
-# do all the spreadsheet stuff before we touch the database
-# for now, assume that process exit will clean up all the spreadsheet stuff
-book = xlrd.open_workbook(survey_file)	# how do we check if this worked???
-sheet = book.sheet_by_name(species)
-sightings = extract_surveys(book,sheet,site)
-
-if verbose:
-	sightings.DumpSurveys()
-	print
-	
-try:	# connect to the database for the species; no password seems to be required
-	conn=psycopg2.connect(database=sp_database,user="skuser")
-except Exception, e:
-	print >> sys.stderr, e.pgerror
-	sys.exit()
-conn.set_session(readonly=True)	# to be safe, prevent us from accidentally damaging the database
-cur=conn.cursor()
+	def Row(self, row, animal):	# called for each individual, row is its row in the capture history matrix
+		pass
 
-# now pull the skink sightings out of the database
-query_skinks(conn, cur, sightings, site)
+	def End(self):		# called once after the pass
+		self.f.write("".join(self.lines))
 
-# finished with database, so we can close the cursor and connection
-cur.close()
-conn.close()
 
-if verbose:
-	sightings.DumpSkinks()
-	print
+class MetadataSink(OutputSink):
+	'Survey metadata describing major/minor survey series, allowing for folded split surveys'
 
-# now process the estimated size classes to consistent values
-sightings.ProcessSizes()
+	def Begin(self, series):
+		OutputSink.Begin(self, series)
+		# surveys in each series, counting folded split surveys once
+		counts = [len(set(series.fold[series.SeriesOccasions(i)])) for i in range(len(series.surveys))]
 
-if verbose:
-	sightings.DumpSkinks()
-	print
+		# first line of output file is inter-survey times for reading into Rmark (one less value than there are surveys)
+		gaps = series.SurveyGaps();	# get the gaps between survey years for use below
+		line = ""
+		for count in counts:		# go through the surveys for each year
+			line += "0.0 " * (count-1)	# write 0.0 gaps between the surveys for the year
+			line += str(next(gaps, "")) + " "	# write the between-year gap to the first survey of the next series
+							# empty string when we run out of between-year gaps (i.e. after last survey)
+		self.lines.append(line + "\r\n")	# job done...
 
-# now output .inp files and major/minor survey series information
-outfile_name=site+"_"+species
-metafile=open(outfile_name+"_surveys.txt", 'w')	# write mode will overwrite any existing file
-inpfile=open(outfile_name+".inp", 'w')	# write mode will overwrite any existing file
-cohortinpfile=open(outfile_name+"_cohort.inp", 'w')	# write mode will overwrite any existing file
+		# now output human-readable form
+		self.lines.append(str(sum(counts)) + " encounter occasions (total surveys)\r\n")
+		self.lines.append(str(len(series.surveys)) + " primary occasions (survey years)\r\n")
+		self.lines.append("Secondary occasions (surveys per year):" + "".join([" " + str(c) for c in counts]) + "\r\n")
+		if len(series.surveys) > 1:	# only pull out the inter-series gaps if we have more than one survey series
+			self.lines.append("Years between survey series: " + "".join([str(g) + " " for g in series.SurveyGaps()]) + "\r\n")
+
+
+class HistorySink(OutputSink):
+	'MARK input file, one capture history per animal; subclasses provide the code for each output occasion'
+	letters = "01"	# character for each code, code 0 is "0"
+
+	def Begin(self, series):
+		OutputSink.Begin(self, series)
+		codes = self.Codes(series)
+		self.output_rows = (codes != 0).any(axis=1)	# Mark doesn't like all-zero histories, so those rows are dropped
+		self.chars = numpy.frombuffer(self.letters, dtype=numpy.uint8)[codes]
+
+	def Codes(self, series):	# individuals x output occasions matrix of indexes into letters
+		raise NotImplementedError
+
+	def Row(self, row, animal):
+		if self.output_rows[row]:
+			line = self.chars[row].tobytes() + " 1;"	# one animal with each capture history
+			self.lines.append(line + "\r\n")	# Windows end of line characters
+			if verbose:
+				print line
+				print animal.skink_id
+
+
+class MarkInpSink(HistorySink):
+	'MARK input file: 1 where the animal was seen'
+
+	def Codes(self, series):
+		return series.MarkSeen().astype(numpy.uint8)
+
+
+# individuals x output occasions matrix of size classes as MARK cohort codes (0 for unsized or not seen),
+# stripping size one animals to 0 unless the site keeps them
+def cohort_codes(series):
+	mark_cohort_class = numpy.array([0, 1, 2, 3, 4], dtype=numpy.uint8)
+	if not series.keep_size_one:
+		mark_cohort_class = numpy.array([0, 0, 1, 2, 3], dtype=numpy.uint8)
+	seen = ~numpy.isnan(series.history)
+	cohorts = numpy.zeros(series.history.shape, dtype=numpy.uint8)	# didn't see this animal on this day
+	cohorts[seen] = mark_cohort_class[series.history[seen].astype(int)]
+	return series.Fold(cohorts, smallest_class)
+
+# series, survey within series (both counting from 1) and date tuple of each output occasion
+# (the date of a folded split survey is its first day)
+def output_occasions(series):
+	starts = numpy.flatnonzero(numpy.diff(numpy.r_[-1, series.fold]))
+	primary = numpy.searchsorted(series.series_start, starts, side="right")
+	first_column = dict([(p, c) for c, p in reversed(list(enumerate(primary)))])
+	secondary = [c - first_column[p] + 1 for c, p in enumerate(primary)]
+	return primary, secondary, [series.dates[o] for o in starts]
+
+
+class CohortSink(HistorySink):
+	'MARK input file for multi-state analysis, size classes as Mark cohort letter codes'
+	letters = "0ABCD"	# index for each size 0 (unsized) to 4, stripping size one leaves a zero in the history
+
+	def Codes(self, series):
+		return cohort_codes(series)
+
+
+class LongCsvSink(OutputSink):
+	'Long-format table for R/RMark: one line per animal per output occasion it counts as seen on'
+	# ch is the animal's line number in the .inp file; occasion, primary and secondary count from 1
+	# size is the processed size class (0 if unsized), taken before any stripping of size one animals
+
+	def Begin(self, series):
+		OutputSink.Begin(self, series)
+		self.seen = series.MarkSeen()
+		self.output_rows = self.seen.any(axis=1)	# same animals as the .inp file
+		self.sizes = series.Fold(numpy.nan_to_num(series.history).astype(int), smallest_class)
+		self.primary, self.secondary, dates = output_occasions(series)
+		self.date = ["%04d-%02d-%02d" % date for date in dates]
+		self.ch = 0
+		self.lines.append("ch,skink_id,occasion,primary,secondary,date,size\r\n")
+
+	def Row(self, row, animal):
+		if self.output_rows[row]:
+			self.ch += 1
+			for c in numpy.flatnonzero(self.seen[row]):
+				self.lines.append("%d,%s,%d,%d,%d,%s,%d\r\n" % (self.ch, animal.skink_id, c+1, self.primary[c],
+					self.secondary[c], self.date[c], self.sizes[row, c]))
+
+
+class ColumnsSink(OutputSink):
+	'Binary columnar file for R: capture and cohort histories, fitted sizes and survey layout, read by R/read_sloop_columns.txt'
+	# one row per animal in the .inp file, in the same order; all numbers little-endian, in this order:
+	# header      - "SLOOPCOL", then int32s: format version (1), animals, output occasions, survey series,
+	#               width of the INDIVIDUAL_ID field, whether size 1 animals are kept (1) or stripped (0)
+	# occasions   - int32 series[occasions], int32 survey within series[occasions], int32 date as yyyymmdd[occasions]
+	#               (series and survey count from 1)
+	# intervals   - float64 time.intervals[occasions - 1] (as in site_species_surveys.txt)
+	#               float64 years between the first surveys of successive series[series - 1] (SurveyGaps)
+	# animals     - INDIVIDUAL_ID[animals], each NUL padded to the ID width
+	#               int32 first series seen[animals] (the first series with a 1 in the .inp history)
+	#               capture history[animals], occasions characters each, as in the .inp file
+	#               cohort history[animals], occasions characters each, as in the _cohort.inp file
+	#               uint8 size class[animals][occasions] (0 if not seen or unsized, taken before any stripping of size one)
+
+	def Begin(self, series):
+		OutputSink.Begin(self, series)
+		self.seen = series.MarkSeen()
+		self.output_rows = self.seen.any(axis=1)	# same animals as the .inp file
+		self.ids = []
+
+	def Row(self, row, animal):
+		if self.output_rows[row]:
+			self.ids.append(animal.skink_id)
+
+	def End(self):
+		series = self.series
+		rows = self.output_rows
+		seen = self.seen[rows]
+		primary, secondary, dates = output_occasions(series)
+		counts = [len(set(series.fold[series.SeriesOccasions(i)])) for i in range(len(series.surveys))]
+		gaps = list(series.SurveyGaps())
+		intervals = []
+		for i, count in enumerate(counts):	# as MetadataSink's first line
+			intervals += [0.0] * (count - 1) + gaps[i:i+1]
+		first = numpy.zeros(len(self.ids), dtype=int)	# first column seen of each animal
+		if seen.shape[1] > 0:	# (argmax can't cope with no occasions, when there are no animals either)
+			first = seen.argmax(axis=1)
+		id_width = max([len(skink_id) for skink_id in self.ids] + [1])
+		self.lines = ["SLOOPCOL",
+			numpy.array([1, len(self.ids), len(primary), len(counts), id_width, bool(series.keep_size_one)], dtype="<i4").tobytes(),
+			numpy.array(primary, dtype="<i4").tobytes(), numpy.array(secondary, dtype="<i4").tobytes(),
+			numpy.array([d[0] * 10000 + d[1] * 100 + d[2] for d in dates], dtype="<i4").tobytes(),
+			numpy.array(intervals, dtype="<f8").tobytes(), numpy.array(gaps, dtype="<f8").tobytes(),
+			"".join([skink_id.ljust(id_width, "\0") for skink_id in self.ids]),
+			numpy.array(primary, dtype="<i4")[first].tobytes(),
+			numpy.frombuffer(HistorySink.letters, dtype=numpy.uint8)[seen.astype(numpy.uint8)].tobytes(),
+			numpy.frombuffer(CohortSink.letters, dtype=numpy.uint8)[cohort_codes(series)[rows]].tobytes(),
+			series.Fold(numpy.nan_to_num(series.history).astype(int), smallest_class)[rows].astype(numpy.uint8).tobytes()]
+		OutputSink.End(self)
+
+
+# output formats: name -> (file name suffix, sink)
+output_formats = {"surveys": ("_surveys.txt", MetadataSink), "inp": (".inp", MarkInpSink),
+	"cohort": ("_cohort.inp", CohortSink), "long": ("_long.csv", LongCsvSink), "columns": ("_columns.bin", ColumnsSink)}
+default_formats = "surveys,inp,cohort"	# what --formats gives unless told otherwise
+
+
+
+usage = "sloop_to_mark.py [-v] species site surveyfile.xls\n       sloop_to_mark.py [-v] [-j jobs] --all-sites species[,species...] surveyfile.xls\n       options: [--refresh | --offline] [--cache-dir dir] [--incremental | --verify-incremental] [--formats format[,format...]]\n       [--stats json|text] [--stats-file file] [--profile file] [--legacy-sizes] [--changed-only [--dry-run]]"
 
-sightings.WriteMetadata(metafile)
-sightings.WriteMarkINP(inpfile)
-sightings.WriteMarkCohorts(cohortinpfile)
+# complain and quit
+def usage_exit():
+	print >> sys.stderr, "usage: " + usage
+	sys.exit()
 
-# BEWARE: horrible bodge to deal with Airport split survey on 5/6 April 2006
-if site == "Airport":
-	metafile.close()
-	metafile=open(outfile_name+"_surveys.txt", 'w')	# write mode will overwrite the existing file
-	sightings.WriteMetadataAirport(metafile)
-# end BEWARE horrible bodge
+# pull the site's survey calendar out of the workbook and assemble the object that will hold the sightings data
+# complain and exit if the species sheet has no column for the site
+def extract_surveys(book,species,site):
+	calendar = book.Calendar(species,site)
+	if calendar is None:
+		print >> sys.stderr, "Error: No surveys found for site ", site, " for requested species"
+		sys.exit()
+	keep_size_one, series = calendar	# is this site closed to size 1 births?
+	survey = MarkSeries(site,keep_size_one)
+	for dates in series:	# each series of dates was delimited by blank cell(s) in the sheet
+		for date in dates:
+			survey.AddSurvey(date)
+		survey.EndSeries()
+	return survey
 
-metafile.close()
-inpfile.close()
-cohortinpfile.close()
+# pull the skinks out of the survey records in the database (or the local cache), add them to the local survey object
+# dates limits the query to some of the survey dates
+def query_skinks(source, surveys, site, dates=None):
+	if dates is None:
+		dates = surveys.SurveyDates()
+	days = [datetime.date(d[0],d[1],d[2]) for d in dates]
+	if not legacy_sizes:
+		# one row for each skink photo-surveyed at the site on each survey day, with its sizes that day averaged
+		for date, skink, size, count in source.DailySizes(site, days):
+			surveys.AddDay(date, skink, size, count)
+		return
+	# pick out ID and estimated size for all skinks photo-surveyed at the site on any survey day
+	for date, skink, value in source.Sightings(site, days, "EST_SIZE_CLASS"):
+		surveys.AddSkink(date, skink, value)
+		# ASSUMPTION: rows come back in time order, so multiple adds of same skink on same date
+		#             will not be separated by other dates (but may be separated by other skinks on same date)
+
+# where the fitted state of a site's export is kept for the next incremental export
+def state_path(site, species):
+	return site+"_"+species+"_state.npz"
+
+# saved state from the last export, or None if there isn't one that the current calendar extends
+def load_state(sightings, site, species):
+	path = state_path(site, species)
+	if not os.path.exists(path):
+		return None
+	saved = numpy.load(path)
+	state = dict([(name, saved[name]) for name in saved.files])
+	saved.close()
+	if not sightings.StateMatches(state):
+		if verbose:
+			print "incremental: survey calendar for", site, "no longer extends the saved one, doing a full rebuild"
+		return None
+	return state
+
+# pull everything we need for one site out of the workbook and the database
+# with incremental set, the saved state of the last export means only survey series added since are queried
+# with verify set as well, a full rebuild is loaded alongside so that export_site can check the two agree
+# returns the sightings, and the full rebuild (or None)
+def load_site(book, species, site, source, incremental=False, verify=False):
+	sightings = extract_surveys(book,species,site)
+
+	if verbose:
+		sightings.DumpSurveys()
+		print
+
+	if incremental:
+		with sloop_stats.span("load_state"):
+			state = load_state(sightings, site, species)
+		if state is not None:
+			with sloop_stats.span("query_skinks"):
+				sightings.ExtendFromState(state, source)
+			full = None
+			if verify:
+				full = load_site(book, species, site, source)[0]
+			return sightings, full
+
+	# now pull the skink sightings out of the database
+	with sloop_stats.span("query_skinks"):
+		query_skinks(source, sightings, site)
+
+	# every sighting is in, so lay them out as a matrix of sizes
+	with sloop_stats.span("build_history"):
+		sightings.BuildHistory()
+
+	if verbose:
+		sightings.DumpSkinks()
+		print
+	return sightings, None
+
+# names of the output files for a site, formats is a list of output_formats names
+def output_names(site, species, formats):
+	outfile_name=site+"_"+species
+	return [outfile_name + output_formats[name][0] for name in formats]
+
+# output files for a site as a list of (file name, contents)
+def render_outputs(sightings, site, species, formats):
+	buffers = [cStringIO.StringIO() for name in formats]
+	sightings.Emit([output_formats[name][1](f) for name, f in zip(formats, buffers)])
+	return zip(output_names(site, species, formats), [f.getvalue() for f in buffers])
+
+# fit sizes and write the MARK files for one site; returns the counts and time taken for the summary
+# and whether an incremental export matched the full rebuild (None if not checked)
+def export_site(job):
+	species, site, sightings, full, incremental, formats = job
+	start = time.time()
+
+	# now process the estimated size classes to consistent values
+	with sloop_stats.span("fit_sizes"):
+		sightings.ProcessSizes()
+
+	if verbose:
+		sightings.DumpSkinks()
+		print
+
+	# now output .inp files and major/minor survey series information
+	outputs = render_outputs(sightings, site, species, formats)
+	verified = None
+	if full is not None:	# check the incremental export against a full rebuild
+		with sloop_stats.span("fit_sizes"):
+			full.ProcessSizes()
+		expected = render_outputs(full, site, species, formats)
+		verified = outputs == expected
+		if not verified:
+			for (name, contents), (same_name, expected_contents) in zip(outputs, expected):
+				if contents != expected_contents:
+					print >> sys.stderr, "Error: incremental export differs from full rebuild in", name
+			print >> sys.stderr, "Writing full rebuild for", site, species, "instead"
+			sightings = full
+			outputs = expected
+	with sloop_stats.span("write_files"):
+		for name, contents in outputs:
+			sloop_build.write_atomic(name, contents)	# replaces any existing file, but only once it's all written
+			sloop_stats.count("files_written")
+			sloop_stats.count("bytes_written", len(contents))
+	if incremental and sightings.surveys != []:
+		with sloop_stats.span("save_state"):
+			sightings.SaveState(state_path(site, species))
+	sloop_stats.count("sites")
+	sloop_stats.count("individuals", len(sightings.individuals))
+	sloop_stats.count("occasions", sightings.OccasionCount())
+	return (len(sightings.individuals), sightings.OccasionCount(), time.time() - start, verified)
+
+# export_site in a pool worker: hands the worker's stats back with the result
+def export_site_worker(job):
+	sloop_stats.collect()	# drop anything inherited from the main process
+	result = export_site(job)
+	return result, sloop_stats.collect()
+
+# print a table of what was done for each site, and how long it took
+def print_summary(summary):
+	print "%-8s %-16s %8s %10s %8s %8s %8s" % ("species", "site", "animals", "occasions", "fetch s", "fit s", "verify")
+	for species, site, fetch_time, result in summary:
+		animals, occasions, fit_time, verified = result
+		print "%-8s %-16s %8d %10d %8.2f %8.2f %8s" % (species, site, animals, occasions, fetch_time, fit_time,
+			{None: "-", True: "ok", False: "FAILED"}[verified])
+
+
+def main():
+	global verbose, legacy_sizes
+	parser = argparse.ArgumentParser(usage=usage)
+	parser.add_argument("-v", action="store_true", dest="verbose")
+	parser.add_argument("--all-sites", action="store_true")
+	parser.add_argument("-j", "--jobs", type=int, default=None)
+	parser.add_argument("--refresh", action="store_true")
+	parser.add_argument("--offline", action="store_true")
+	parser.add_argument("--cache-dir", default=None)
+	parser.add_argument("--incremental", action="store_true")
+	parser.add_argument("--verify-incremental", action="store_true")
+	parser.add_argument("--formats", default=default_formats)
+	parser.add_argument("--stats", choices=["json", "text"], default=None)
+	parser.add_argument("--stats-file", default=None)
+	parser.add_argument("--profile", default=None)
+	parser.add_argument("--legacy-sizes", action="store_true")
+	parser.add_argument("--changed-only", action="store_true")
+	parser.add_argument("--dry-run", action="store_true")
+	parser.add_argument("args", nargs="+")
+	options = parser.parse_args()
+	verbose = options.verbose
+	legacy_sizes = options.legacy_sizes
+	sloop_stats.instrument(lambda: run(options), options.stats, options.stats_file, options.profile)
+
+
+# everything after the command line is parsed
+def run(options):
+	if options.all_sites:
+		if len(options.args) != 2: usage_exit()
+		species_list = options.args[0].split(",")
+		sites = None	# every site in each species sheet
+		survey_file = options.args[1]
+	else:
+		if len(options.args) != 3: usage_exit()
+		species_list = [options.args[0]]
+		sites = [options.args[1]]
+		survey_file = options.args[2]
+
+	if options.refresh and options.offline: usage_exit()
+	incremental = options.incremental or options.verify_incremental
+	if options.changed_only and (incremental or not options.all_sites): usage_exit()	# saved state isn't hashed
+	if options.dry_run and not options.changed_only: usage_exit()
+	formats = options.formats.split(",")
+	for name in formats:
+		if name not in output_formats:
+			print >> sys.stderr, "Error: unknown output format ", name
+			usage_exit()
+
+	if verbose:
+		print " ".join(options.args)
+		print
+
+	for species in species_list:
+		if species not in sloop_db.species_database:
+			print >> sys.stderr, "Error: unknown species ", species 
+			usage_exit()
+
+	# do all the spreadsheet stuff before we touch the database
+	# (the calendars of all the species' sites are read, or taken from the cache, the first time we ask for one)
+	book = sloop_workbook.SurveyBook(survey_file, options.cache_dir)
+
+	if sites is not None:	# just the one site, no need for a pool of workers
+		species = species_list[0]
+		source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+		sightings, full = load_site(book, species, sites[0], source, incremental, options.verify_incremental)
+		# finished with database, so we can close the connection
+		source.Close()
+		if export_site((species, sites[0], sightings, full, incremental, formats))[3] == False:
+			sys.exit(1)
+		return
+
+	# batch mode: one connection per species feeds sites to a pool of workers that fit sizes and write the files
+	# with --changed-only the rows fetched for each site are hashed, and sites whose outputs are up to date are left alone
+	record = None
+	if options.changed_only:
+		record = sloop_build.BuildRecord(build_file)
+		code = sloop_build.code_hash([sys.modules[__name__], sloop_sightings])
+	pool = multiprocessing.Pool(options.jobs)
+	summary = []
+	built = {}	# (species, site) -> (output names, inputs hash) of the sites being redone
+	for species in species_list:
+		source = sloop_cache.open_source(species, options.refresh, options.offline, options.cache_dir, verbose)
+		if record is not None:
+			source = sloop_build.HashingSource(source)
+		for site in book.Sites(species):
+			start = time.time()
+			sightings, full = load_site(book, species, site, source, incremental, options.verify_incremental)
+			if record is not None:
+				names = output_names(site, species, formats)
+				inputs = sloop_build.inputs_hash(code, formats, legacy_sizes, split_survey_dates, book.Calendar(species, site),
+					source.Rows(site))
+				reason = record.Plan(names, inputs)
+				sloop_build.print_plan(species, site, reason)
+				if reason is None or options.dry_run:
+					continue
+				built[(species, site)] = (names, inputs)
+			summary.append((species, site, time.time() - start, pool.apply_async(export_site_worker, [(species, site, sightings, full, incremental, formats)])))
+		source.Close()
+	pool.close()
+	pool.join()
+	results = []
+	for species, site, fetch_time, pending in summary:
+		result, stats = pending.get()
+		sloop_stats.merge(stats)
+		results.append((species, site, fetch_time, result))
+		if (species, site) in built:
+			record.Record(*built[(species, site)])
+	if options.dry_run:
+		return
+	if record is not None:
+		record.Save()
+	print_summary(results)
+	if False in [entry[3][3] for entry in results]:	# any site that failed --verify-incremental
+		sys.exit(1)
 
 
+#execution starts here
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,206 @@
+# workbook access shared by the scripts: survey workbooks (one sheet per species, one column per site)
+# and Sloop upload workbooks (photos and sightings sheets)
+
+# workbooks are opened on demand, so only the sheets asked for are loaded, and columns are read whole rather than cell by cell
+# .xlsx workbooks are streamed with openpyxl's read-only mode if it's installed, otherwise xlrd reads them too
+# survey calendars are cached in the sightings cache directory, keyed by the workbook's path, size and modification time,
+# so batch runs and repeat runs on an unchanged workbook don't read it at all
+# a sheet's header row is read for its list of sites, but a site's column is only parsed when that site is asked for,
+# so columns that aren't survey calendars (notes, say) don't get in the way of the sites that are; the list of sites
+# for a batch run leaves out (with a warning) any column that doesn't parse as a calendar
+
+import xlrd	# .xls decoder package
+import os	# file times and sizes
+import sys	# so we can get at stderr
+import json	# calendar cache format
+import datetime	# openpyxl gives dates as datetimes
+import sloop_cache	# the calendar cache lives in the sightings cache directory
+import sloop_stats	# timing for --stats
+try:
+	import openpyxl	# streaming .xlsx reader
+except ImportError:
+	openpyxl = None
+
+calendar_cache_name = "survey_calendars.json"	# file in the cache directory holding parsed survey calendars
+calendar_cache_version = 3	# bumped when what is cached changes, older entries are parsed again
+
+
+class Workbook(object):
+	'A workbook read a sheet and a column at a time'
+
+	def __init__(self, path):
+		self.path = path
+		self.xlsx = None	# openpyxl workbook, for .xlsx when we have openpyxl
+		self.book = None	# xlrd workbook otherwise
+		if path.endswith(".xlsx") and openpyxl is not None:
+			self.xlsx = openpyxl.load_workbook(path, read_only=True, data_only=True)
+		else:
+			self.book = xlrd.open_workbook(path, on_demand=True)
+
+	def Column(self, sheet_name, column, start_row=0):	# values in a column from start_row down, "" for empty cells
+		if self.xlsx is not None:
+			rows = self.xlsx[sheet_name].iter_rows(min_row=start_row+1, min_col=column+1, max_col=column+1)
+			return [_xlsx_value(row[0].value) for row in rows]
+		return self.book.sheet_by_name(sheet_name).col_values(column, start_row)
+
+	def Row(self, sheet_name, row):	# values across a row, "" for empty cells
+		if self.xlsx is not None:
+			for cells in self.xlsx[sheet_name].iter_rows(min_row=row+1, max_row=row+1):
+				return [_xlsx_value(cell.value) for cell in cells]
+			return []
+		return self.book.sheet_by_name(sheet_name).row_values(row)
+
+	def DateTuple(self, value):	# (year, month, day) of a date cell, ValueError if it isn't one
+		if isinstance(value, datetime.date):	# openpyxl gives dates as datetimes
+			return (value.year, value.month, value.day)
+		if self.xlsx is not None or not isinstance(value, float):	# anything else from openpyxl isn't a date cell
+			raise ValueError("%r is not a date" % (value,))
+		try:
+			return xlrd.xldate_as_tuple(value, self.book.datemode)[0:3]	# slice pulls out year, month, day from datetime tuple
+		except xlrd.XLDateError, e:
+			raise ValueError("%r is not a date (%s)" % (value, e))
+
+	def Close(self):
+		if self.xlsx is not None:
+			self.xlsx.close()
+		else:
+			self.book.release_resources()
+
+
+# an openpyxl cell value as xlrd would give it
+def _xlsx_value(value):
+	if value is None:
+		return ""
+	return value
+
+
+# the survey calendar held in one site's column below the header: whether the site is closed to size 1 births
+# (second row), then series of dates separated by blank cells
+# returns (keep size one flag, list of series, each a list of (year, month, day))
+# raises ValueError naming the cell if anything below the flag isn't a date
+def parse_calendar(book, sheet_name, column):
+	values = book.Column(sheet_name, column, 1)
+	if values == []:
+		return "", []
+	series = []
+	current = []
+	for row, value in enumerate(values[1:]):
+		if value == "":	# consume blank cells, delimit survey series
+			if current != []:	# first blank cell after date(s) delimits survey series
+				series.append(current)
+				current = []
+		else:
+			try:
+				current.append(book.DateTuple(value))
+			except ValueError:
+				raise ValueError("%s sheet, column %d, row %d: %r is not a date" % (sheet_name, column + 1, row + 3, value))
+	if current != []:	# if last cell was a date we've just hit the end of the last series
+		series.append(current)
+	return values[0], series
+
+
+class SurveyBook(object):
+	'Survey calendars for each species sheet and site of a survey workbook, cached between runs'
+
+	def __init__(self, path, cache_dir=None):
+		self.path = path
+		st = os.stat(path)
+		self.key = (os.path.abspath(path), st.st_size, st.st_mtime)
+		self.cache_file = os.path.join(sloop_cache.cache_directory(cache_dir), calendar_cache_name)
+		self.book = None	# the workbook itself, only opened if the cache doesn't have what we want
+		# species -> {"sites": [site, ...], "columns": {site: column}, "calendars": {site: [keep size one flag, series]},
+		#             "errors": {site: why its column isn't a calendar}}
+		self.sheets = {}
+		self.warned = set()	# (species, site) of columns we've warned aren't calendars
+		with sloop_stats.span("workbook_cache"):
+			cached = self._read_cache().get(self.key[0])
+		if cached is not None and cached.get("version") == calendar_cache_version and \
+				cached["size"] == self.key[1] and cached["mtime"] == self.key[2]:
+			self.sheets = cached["sheets"]
+
+	def _read_cache(self):
+		try:
+			f = open(self.cache_file)
+			cache = json.load(f)
+			f.close()
+			return cache
+		except (IOError, ValueError):	# no cache yet, or a broken one we'll replace
+			return {}
+
+	def _save(self):	# put this workbook's calendars in the cache file, replacing any for an older version of it
+		cache = self._read_cache()
+		cache[self.key[0]] = {"version": calendar_cache_version, "size": self.key[1], "mtime": self.key[2], "sheets": self.sheets}
+		try:
+			if not os.path.isdir(os.path.dirname(self.cache_file)):
+				os.makedirs(os.path.dirname(self.cache_file))
+			tmp_file = self.cache_file + ".%d.tmp" % os.getpid()
+			f = open(tmp_file, "w")
+			json.dump(cache, f)
+			f.close()
+			os.rename(tmp_file, self.cache_file)
+		except (IOError, OSError):
+			pass	# not being able to cache is no reason to stop
+
+	def _open(self):
+		if self.book is None:
+			self.book = Workbook(self.path)
+		return self.book
+
+	def _sheet(self, species):	# the header of a species sheet: its sites and their columns, read if the cache doesn't have it
+		if species not in self.sheets:
+			with sloop_stats.span("workbook_parse"):
+				sites = []
+				columns = {}
+				for column, header in enumerate(self._open().Row(species, 0)):
+					if header != "" and header not in columns:	# the first column headed by a site is the one used
+						sites.append(header)
+						columns[header] = column
+				self.sheets[species] = {"sites": sites, "columns": columns, "calendars": {}, "errors": {}}
+			with sloop_stats.span("workbook_cache"):
+				self._save()
+		return self.sheets[species]
+
+	def _parse(self, species, site):	# parse a site's column into the sheet's calendars, or note why it isn't one
+		sheet = self.sheets[species]
+		with sloop_stats.span("workbook_parse"):
+			try:
+				sheet["calendars"][site] = parse_calendar(self._open(), species, sheet["columns"][site])
+			except ValueError, e:
+				sheet["errors"][site] = str(e)
+
+	# the sites in a species sheet: every non-empty cell in the header row whose column is a survey calendar
+	# (the others get a warning, once)
+	def Sites(self, species):
+		sheet = self._sheet(species)
+		parsed = False
+		sites = []
+		for site in sheet["sites"]:
+			if site not in sheet["calendars"] and site not in sheet["errors"]:
+				self._parse(species, site)
+				parsed = True
+			if site in sheet["errors"]:
+				if (species, site) not in self.warned:
+					print >> sys.stderr, "Warning: column " + site + " is not a survey calendar, skipping it:", sheet["errors"][site]
+					self.warned.add((species, site))
+			else:
+				sites.append(site)
+		if parsed:
+			with sloop_stats.span("workbook_cache"):
+				self._save()
+		return sites
+
+	# (keep size one flag, list of series of (year, month, day)), None if no such site
+	# a site's column is only parsed when it's asked for, so a column of notes in the sheet only matters if it's asked for;
+	# raises ValueError if the site's column isn't a calendar
+	def Calendar(self, species, site):
+		sheet = self._sheet(species)
+		if site not in sheet["columns"]:
+			return None
+		if site not in sheet["calendars"] and site not in sheet["errors"]:
+			self._parse(species, site)
+			with sloop_stats.span("workbook_cache"):
+				self._save()
+		if site in sheet["errors"]:
+			raise ValueError(sheet["errors"][site])
+		keep_size_one, series = sheet["calendars"][site]
+		return keep_size_one, [[tuple(date) for date in dates] for dates in series]	# the JSON cache gives lists